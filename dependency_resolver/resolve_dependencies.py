@@ -0,0 +1,108 @@
+import json
+import os
+
+from artifact_cache import get_source_hash
+from aur import get_aur_info
+from aws import send_batch_to_queue
+from common import return_code
+from packages import parse_dependency
+
+NEXT_QUEUE = os.environ.get('NEXT_QUEUE')
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    messages = [run(record['body']) for record in event['Records']]
+
+    # Send to next function
+    print(f"NEXT_QUEUE: {NEXT_QUEUE}")
+    send_batch_to_queue(NEXT_QUEUE, messages)
+    return return_code(200, {'status': 'Dependencies resolved'})
+
+
+def _get_build_dependencies(aur_package):
+    """ Gets the names of every package needed to build an AUR package """
+    deps = aur_package.get('Depends', []) \
+        + aur_package.get('MakeDepends', []) \
+        + aur_package.get('CheckDepends', [])
+    return set(parse_dependency(x)[0] for x in deps)
+
+
+def get_aur_packages(dependencies):
+    """ Resolves the AUR dependencies of the packages specified transitively.
+
+    The AUR is queried one level of the dependency tree at a time, with every
+    package in a level requested in the same batch. Dependencies which aren't
+    found in the AUR are assumed to come from the official repositories and
+    aren't followed any further.
+
+    Args:
+        dependencies (list): The dependencies of the metapackage, optionally
+                             including version constraints
+
+    Returns:
+        (dict): The AUR details of every AUR package required
+    """
+
+    packages = {}
+    to_check = set(parse_dependency(x)[0] for x in dependencies)
+    seen = set(to_check)
+
+    while to_check:
+        aur_packages = get_aur_info(to_check)
+        packages.update(aur_packages)
+
+        to_check = set()
+        for pkg in aur_packages.values():
+            deps = _get_build_dependencies(pkg)
+            to_check.update(deps.difference(seen))
+            seen.update(deps)
+
+    return packages
+
+
+def get_dependency_graph(aur_packages):
+    """ Gets the graph of dependencies between the AUR packages required.
+
+    Args:
+        aur_packages (dict): The AUR details of every AUR package required
+
+    Returns:
+        (dict): Every AUR package required, mapped to the list of other AUR
+                packages it depends on or needs to be built
+    """
+
+    # Only keep the edges between AUR packages
+    return {name: sorted(_get_build_dependencies(pkg).intersection(aur_packages))
+            for name, pkg in aur_packages.items()}
+
+
+def run(message_body):
+    """ Adds the AUR packages required by the metapackage's dependencies, the
+    graph of dependencies between them, their latest versions and the
+    sources they're built from to the message.
+
+    Args:
+        message_body (str): JSON message containing the dependencies
+
+    Returns:
+        str: The message for the next function
+    """
+
+    msg = json.loads(message_body)
+    aur_packages = get_aur_packages(msg['dependencies'])
+    graph = get_dependency_graph(aur_packages)
+    print(f"Found {len(graph)} AUR packages: {json.dumps(graph)}")
+
+    # Add any AUR packages only required by other AUR packages
+    direct = set(parse_dependency(x)[0] for x in msg['dependencies'])
+    msg['dependencies'] = msg['dependencies'] \
+        + sorted(set(graph).difference(direct))
+    msg['graph'] = graph
+    msg['versions'] = {name: pkg['Version'] for name, pkg in aur_packages.items()}
+    msg['sources'] = {name: {'PackageBase': pkg.get('PackageBase', name),
+                             'Version': pkg['Version'],
+                             'SourceHash': get_source_hash(pkg)}
+                      for name, pkg in aur_packages.items()}
+
+    return json.dumps(msg)
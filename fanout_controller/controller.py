@@ -1,186 +1,814 @@
 import json
 import os
+import time
+
+from botocore.exceptions import ClientError
 
 from boto3.dynamodb.conditions import Key
 
-from aws import get_dynamo_resource, send_to_queue
+from artifact_cache import cache_artifact
+from aws import batch_delete_items, batch_get_items, get_dynamo_resource
+from aws import query_items
+from aws import send_to_queue
+from build_history import record_build
 from common import return_code
 from enums import Status
 
 FANOUT_STATUS = os.environ.get('FANOUT_STATUS')
 METAPACKAGE_QUEUE = os.environ.get('METAPACKAGE_QUEUE')
 PACKAGE_UPDATE_QUEUE = os.environ.get('PACKAGE_UPDATE_QUEUE')
+BUILD_FUNCTION_QUEUE = os.environ.get('BUILD_FUNCTION_QUEUE')
+PKGBUILD_CACHE = os.environ.get('PKGBUILD_CACHE')
+BUILD_HISTORY = os.environ.get('BUILD_HISTORY')
+ARTIFACT_CACHE = os.environ.get('ARTIFACT_CACHE')
+
+# Number of seconds items are kept in the fanout table before DynamoDB
+# expires them. If unset, finished fanouts are deleted instead.
+FANOUT_TTL = int(os.environ.get('FANOUT_TTL') or 0)
+
+# The metapackage item, which also holds the counters of the whole fanout
+FANOUT_RECORD = 'GIT_REPO'
 
 
 def lambda_handler(event, context):
+    """ Handles a batch of fanout status messages.
+
+    Every message within the batch is applied before deciding whether any
+    of the fanouts they belong to have finished, so the metapackage of each
+    fanout is checked once per batch rather than once per message. Messages
+    which couldn't be processed are reported as batch item failures, so only
+    those are retried rather than the whole batch.
+
+    Args:
+        event (dict): The SQS batch of fanout status messages
+        context (object): Lambda context runtime methods and attributes
+
+    Returns:
+        (dict): HTTP response containing the status of the fanout process,
+                along with the IDs of any messages which failed
+    """
+
     print(json.dumps(event))
 
-    # Set default return message
-    return_message = return_code(200, {"status": "No package found"})
+    # The dynamoDB table containing the running status of each package
+    dynamo = get_dynamo_resource()
+    fanout_table = dynamo.Table(FANOUT_STATUS)
 
-    # Loop through each message received
+    # Set default return message
+    status = "No package found"
+    failures = []
+    fanouts = {}
     for message in event['Records']:
-
-        # If the metapackage has been built the message will simply contain
-        # {'FanoutStatus': 'Complete'}, so we can clear the fanout status
-        # table and update all packages in the package table.
-        msg_body = json.loads(message['body'])
-        if msg_body.get("FanoutStatus") == "Complete":
-            print("Fanout status complete")
-            clear_table()
-            print("Updating package table")
-            pkg_msg = {
-                'repository': msg_body['RepoName'],
-                'url': msg_body['RepoUrl']
-            }
-            send_to_queue(PACKAGE_UPDATE_QUEUE, json.dumps(pkg_msg))
-            return return_code(200, {"status": "Fanout status complete"})
-
-        # Handle the message and set the final status, including updating
-        # the fanout status table
-        return_message = handle_fanout_status(message)
+        try:
+            msg_body = json.loads(message['body'])
+
+            # Build containers older than per-run fanouts don't send the ID,
+            # and their messages can't be matched to any fanout
+            if 'FanoutId' not in msg_body:
+                raise ValueError("Message has no FanoutId, the build container "
+                                 "needs updating to send it")
+
+            # If the metapackage has been built the message will simply
+            # contain {'FanoutStatus': 'Complete'}, so we can clear the fanout
+            # and update all packages in the package table.
+            if msg_body.get("FanoutStatus") == "Complete":
+                complete_fanout(fanout_table, msg_body)
+                status = "Fanout status complete"
+            else:
+                fanouts.setdefault(msg_body['FanoutId'], []).append(
+                    (message['messageId'], msg_body))
+        except Exception as e:
+            print(f"Failed to process message {message['messageId']}: {e}")
+            failures.append(message['messageId'])
+
+    # Handle the messages of each fanout and set the final status, including
+    # updating the fanout status table
+    for fanout_id, messages in fanouts.items():
+        fanout_status, fanout_failures = handle_fanout_statuses(
+            fanout_table, fanout_id, messages)
+        failures.extend(fanout_failures)
+        if status != "Fanout status complete":
+            status = fanout_status
 
     # Return the final status message
-    return return_message
+    response = return_code(200, {"status": status})
+    response['batchItemFailures'] = [{'itemIdentifier': x} for x in failures]
+    return response
 
 
-def clear_table():
-    """ Clears the fanout status table completely on completion. """
-    print("Clearing fanout status table")
-    dynamo = get_dynamo_resource()
-    fanout_table = dynamo.Table(FANOUT_STATUS)
-    resp = fanout_table.scan()
-    to_delete = [x['PackageName'] for x in resp['Items']]
-    print(f"Deleting the following items: {to_delete}")
-    with fanout_table.batch_writer() as batch:
-        for package in to_delete:
-            batch.delete_item(Key={'PackageName': package})
+def complete_fanout(fanout_table, msg_body):
+    """ Clears a fanout once its metapackage has been built and requests the
+    package table to be updated from the repository. The hash of the
+    PKGBUILDs it was started from is cached, along with whether every
+    package was built.
 
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        msg_body (dict): The fanout complete message
+    """
 
-def handle_fanout_status(package_message):
-    """ Handle a single message by updating the package state in the fanout
-    table and, if all have either failed or been built, build the metapackage.
+    print("Fanout status complete")
+    record = fanout_table.get_item(
+        Key=package_key(msg_body['FanoutId'], FANOUT_RECORD)).get('Item')
+    if record:
+        cache_pkgbuild(record, succeeded=not record.get('Failed'))
+
+    if FANOUT_TTL:
+        print(f"Leaving fanout {msg_body['FanoutId']} to expire")
+    else:
+        clear_fanout(fanout_table, msg_body['FanoutId'])
+    print("Updating package table")
+    pkg_msg = {
+        'repository': msg_body['RepoName'],
+        'url': msg_body['RepoUrl']
+    }
+    send_to_queue(PACKAGE_UPDATE_QUEUE, json.dumps(pkg_msg))
+
+
+def package_key(fanout_id, package_name):
+    """ Gets the key of a package within the fanout status table
 
     Args:
-        package_message (dict): JSON message containing hte package state 
-                                within the 'body' key, ie. Complete or Failed
+        fanout_id (str): ID of the fanout run the package is part of
+        package_name (str): Name of the package
 
     Returns:
-        (dict): HTTP return code containing the status of the fanout process
+        (dict): The primary key of the package's item
     """
-    package_state = json.loads(package_message['body'])
+    return {'FanoutId': fanout_id, 'PackageName': package_name}
 
-    # The dynamoDB table containing the running status of each package
-    dynamo = get_dynamo_resource()
-    fanout_table = dynamo.Table(FANOUT_STATUS)
-    update_package_state(fanout_table, package_state)
 
-    # Delete failed items - this doesn't end the process as we still want
-    # a new metapackage to be built regardless of the failed packages.
-    delete_failed(fanout_table)
+def with_expiry(update_expression, values):
+    """ Adds the expiry time of the item to an update expression, if items
+    within the fanout table expire. Items keep the expiry time of when they
+    were first written.
+
+    Args:
+        update_expression (str): The update expression
+        values (dict): The ExpressionAttributeValues of the update, which the
+                       expiry time is added to
+
+    Returns:
+        (str): The update expression, setting the expiry time if needed
+    """
+
+    if not FANOUT_TTL:
+        return update_expression
+
+    values[':exp'] = int(time.time()) + FANOUT_TTL
+    expiry = "ExpiresAt = if_not_exists(ExpiresAt, :exp)"
+    if update_expression.lower().startswith('set '):
+        return f"set {expiry}, {update_expression[4:]}"
+    return f"set {expiry} {update_expression}"
+
 
-    # Check remaining items
-    resp = fanout_table.scan()
-    still_building = packages_still_building(resp['Items'])
-    if still_building > 0:
-        print(f"{still_building} items still in table")
-        return return_code(200, {"status": "Items are still running"})
+def clear_fanout(fanout_table, fanout_id):
+    """ Clears the items of a single fanout run from the fanout status table
+    on completion, leaving any other runs in progress untouched. The items
+    are deleted by parallel batch writes rather than one at a time.
 
-    # If the metapackage build failed, we're done
-    if still_building < 0:
-        print(f"Metapackage build failed, exiting")
-        return return_code(200, {"status", "Metapackage failed"})
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run to clear
+    """
+
+    print(f"Clearing fanout {fanout_id} from the status table")
+    items = query_items(fanout_table,
+                        projection=['PackageName'],
+                        KeyConditionExpression=Key('FanoutId').eq(fanout_id))
+    to_delete = [x['PackageName'] for x in items]
+    print(f"Deleting the following items: {to_delete}")
+    batch_delete_items(fanout_table,
+                       [package_key(fanout_id, x) for x in to_delete])
+
+
+def handle_fanout_statuses(fanout_table, fanout_id, messages):
+    """ Handles the messages of a single fanout by updating the package
+    states in the fanout table and, if all have either failed or been built,
+    build the metapackage.
+
+    Rather than scanning the table after every message, the fanout record
+    (the GIT_REPO item) keeps atomic counters of the packages pending,
+    complete and failed. All of the packages built within the batch are
+    counted with a single write, and completion is detected from the last
+    write made to the record.
+
+    The other states are still written one message at a time, as batch
+    writes can only replace whole items and can't be conditional:
+    - Building updates merge into items which a Complete message may have
+      already written, so a replaced item could go back to Building
+    - Waiting items are only stored if the package isn't already being
+      handled, so redelivered messages don't add to Remaining again
+    - Failed packages are deleted with ReturnValues to find their
+      dependents, which a batch delete doesn't return
 
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the messages are part of
+        messages (list): The message ID and package state of each message
+
+    Returns:
+        (tuple): The status of the fanout process, and the IDs of any
+                 messages which failed
+    """
+
+    failures = []
+    record = None
+    complete = []
+
+    def apply(message_id, handler, *args):
+        nonlocal record
+        try:
+            record = handler(fanout_table, fanout_id, *args) or record
+        except Exception as e:
+            print(f"Failed to process message {message_id}: {e}")
+            failures.append(message_id)
+
+    # Start the fanout before counting any packages within it
+    messages = sorted(messages, key=lambda x: not x[1].get('IsMeta'))
+    for message_id, package_state in messages:
+        status = package_state['BuildStatus']
+        if package_state.get('IsMeta'):
+            apply(message_id, start_fanout, package_state)
+        elif status == Status.Waiting.name:
+            apply(message_id, wait_for_dependencies, package_state)
+        elif status == Status.Failed.name:
+            apply(message_id, fail_package, package_state['PackageName'])
+        elif status == Status.Complete.name:
+            complete.append((message_id, package_state))
+        else:
+            apply(message_id, update_package_state, package_state)
+
+    record_build_history([
+        x[1] for x in messages
+        if not x[1].get('IsMeta') and not x[1].get('Promoted')
+        and x[1]['BuildStatus'] in (Status.Complete.name, Status.Failed.name)])
+
+    if complete:
+        try:
+            record = complete_packages(
+                fanout_table, fanout_id, [x[1] for x in complete]) or record
+        except Exception as e:
+            print(f"Failed to process built packages: {e}")
+            failures.extend(x[0] for x in complete)
+
+    if not is_fanout_complete(record):
+        print("Items are still running")
+        return "Items are still running", failures
 
     # Otherwise if everything has completed, invoke the meta-package 
     # building function
-    build_metapackage(fanout_table)
-    return return_code(200, {"status": "All packages built"})
+    if build_metapackage(fanout_table, fanout_id):
+        return "All packages built", failures
+    return "Metapackage already started", failures
+
 
+def record_build_history(package_states):
+    """ Stores the outcome and metrics of each package build sent by the
+    package builder, for sizing and ordering later builds.
 
-def packages_still_building(fanout_list):
-    """ Checks how many packages are being built or are in the queue to be 
-    built, so we can decide whether to move forward with the process.
+    The history only guides later builds, so any errors storing it are
+    logged rather than failing the messages.
 
     Args:
-        fanout_list (list): All items within the fanout status table
+        package_states (list): The Complete and Failed messages of each
+                               package
+    """
+
+    if not BUILD_HISTORY or not package_states:
+        return
+
+    dynamo = get_dynamo_resource()
+    history_table = dynamo.Table(BUILD_HISTORY)
+    for package_state in package_states:
+        try:
+            record_build(history_table, package_state)
+        except Exception as e:
+            print(f"Unable to record the build of "
+                  f"{package_state['PackageName']}: {e}")
+
+
+def is_fanout_complete(record):
+    """ Checks whether every package within a fanout has either been built or
+    failed, according to the counters on the fanout record.
+
+    Args:
+        record (dict): The fanout record after the latest update, or None if
+                       it wasn't updated
 
     Returns:
-        (int): The number of packages (excluding metapackages) building or
-               queued to be built
+        (bool): Whether the metapackage can be built
     """
 
-    # Check how many metapackages are yet to be built, as these are done at
-    # the later stage
-    meta_package_count = len([x for x in fanout_list
-                              if x.get('IsMeta')])  # Should only be one
-
-    # See how many total packages are in the build or init status
-    incomplete_count = len([x for x in fanout_list
-                            if x['BuildStatus'] == Status.Initialized.name
-                            or x['BuildStatus'] == Status.Building.name])
+    if not record or 'GitUrl' not in record:
+        return False
 
-    # Ignore the metapackages
-    return incomplete_count - meta_package_count
+    print(f"{record.get('Pending', 0)} pending, "
+          f"{record.get('Complete', 0)} complete, "
+          f"{record.get('Failed', 0)} failed")
+    return record.get('Pending', 0) == 0
 
 
-def update_package_state(fanout_table, package_state):
+def update_package_state(fanout_table, fanout_id, package_state):
     """ Updates the state of the package being built within the fanout status
     table argument.
 
     Args:
         fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
         package_state (dict): Name and state of the package to update
+
+    Returns:
+        (dict): The fanout record if the package had already failed,
+                otherwise None
     """
 
     print(f"Updating state:")
     print(json.dumps(package_state))
+    update_expression = "set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, GitBranch = :b"
+    values = {
+        ':s': package_state['BuildStatus'],
+        ':m': package_state.get('IsMeta'),
+        ':g': package_state.get('GitUrl'),
+        ':r': package_state.get('repo'),
+        ':b': package_state.get('GitBranch'),
+    }
+
+    # Packages built after this one is finished
+    if package_state.get('Dependents'):
+        update_expression += ", Dependents = :dp"
+        values[':dp'] = package_state['Dependents']
+
+    # The sources the package is built from, for caching the build
+    if package_state.get('SourceKey'):
+        update_expression += ", SourceKey = :k"
+        values[':k'] = package_state['SourceKey']
+
     fanout_table.update_item(
-        Key={'PackageName': package_state['PackageName']},
-        UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, GitBranch = :b",
-        ExpressionAttributeValues={
-            ':s': package_state['BuildStatus'],
-            ':m': package_state.get('IsMeta'),
-            ':g': package_state.get('GitUrl'),
-            ':r': package_state.get('repo'),
-            ':b': package_state.get('GitBranch'),
-        }
+        Key=package_key(fanout_id, package_state['PackageName']),
+        UpdateExpression=with_expiry(update_expression, values),
+        ExpressionAttributeValues=values
     )
 
+    # If the package failed before its dependents were stored, there was
+    # nothing to cascade the failure to at the time
+    if package_state.get('Dependents'):
+        return fail_if_counted(fanout_table, fanout_id,
+                               package_state['PackageName'])
+    return None
+
 
-def delete_failed(fanout_table):
-    """ Deletes any failed items from the fanout table, as these packages can
-    be ignored when processing the metapackage.
+def fail_if_counted(fanout_table, fanout_id, package_name):
+    """ Fails a package again if it has already been counted as failed, so
+    the failure cascades to the dependents stored since.
 
     Args:
         fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
+        package_name (str): Name of the package
+
+    Returns:
+        (dict): The fanout record if the package had already failed,
+                otherwise None
     """
 
-    all_items = fanout_table.scan()
-    deleted_items = [item for item in all_items['Items']
-                     if item['BuildStatus'] == Status.Failed.name]
-    print(f"Removing {len(deleted_items)} failed items from the fanout table")
-    for item in deleted_items:
-        print(f"Removing item {item['PackageName']}")
-        fanout_table.delete_item(Key={"PackageName": item['PackageName']})
+    record = fanout_table.get_item(
+        Key=package_key(fanout_id, FANOUT_RECORD),
+        ProjectionExpression='FailedPackages').get('Item', {})
+    if package_name not in record.get('FailedPackages', set()):
+        return None
+
+    print(f"{package_name} has already failed")
+    return fail_package(fanout_table, fanout_id, package_name)
+
+
+def start_fanout(fanout_table, fanout_id, package_state):
+    """ Stores the metapackage details on the fanout record and adds the
+    number of packages being built to its pending counter.
 
+    Packages may finish before this message arrives, in which case they
+    have already taken the counter below zero. The counter is only added
+    once, so redelivered messages are ignored.
 
-def build_metapackage(fanout_table):
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run being started
+        package_state (dict): The metapackage message from the fanout starter
+
+    Returns:
+        (dict): The fanout record after the update, or None if it had
+                already been started
+    """
+
+    print(f"Starting fanout of {package_state.get('PackageCount', 0)} packages")
+    values = {
+        ':s': package_state['BuildStatus'],
+        ':m': True,
+        ':g': package_state.get('GitUrl'),
+        ':r': package_state.get('repo'),
+        ':b': package_state.get('GitBranch'),
+        ':n': package_state.get('PackageCount', 0),
+        ':h': package_state.get('PkgbuildHash')
+    }
+    update_expression = with_expiry(
+        "set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, "
+        "GitBranch = :b, PkgbuildHash = :h ADD #pending :n", values)
+    try:
+        resp = fanout_table.update_item(
+            Key=package_key(fanout_id, FANOUT_RECORD),
+            UpdateExpression=update_expression,
+            ConditionExpression="attribute_not_exists(GitUrl)",
+            ExpressionAttributeNames={'#pending': 'Pending'},
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print("Fanout already started, ignoring")
+        return None
+    return resp['Attributes']
+
+
+def record_results(fanout_table, fanout_id, package_names, status):
+    """ Counts packages as complete or failed on the fanout record.
+
+    The names of the packages are added to a set of finished packages within
+    the same write, and the write is conditional on none of them already
+    being in either set, so each package is only counted once. If any of
+    them have already been counted, the rest are counted one at a time.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the packages are part of
+        package_names (list): Names of the packages which have finished
+        status (str): Either Complete or Failed
+
+    Returns:
+        (tuple): The fanout record after the last update, or None if every
+                 package had already been counted, and the set of names of
+                 the packages counted by this call
+    """
+
+    names = {f":p{i}": name for i, name in enumerate(package_names)}
+    condition = " AND ".join(
+        f"NOT contains(CompletePackages, {x}) AND NOT contains(FailedPackages, {x})"
+        for x in names)
+    values = dict(names, **{
+        ':dec': -len(names),
+        ':inc': len(names),
+        ':names': set(package_names)
+    })
+    update_expression = with_expiry(
+        "ADD #pending :dec, #count :inc, #names :names", values)
+    try:
+        resp = fanout_table.update_item(
+            Key=package_key(fanout_id, FANOUT_RECORD),
+            UpdateExpression=update_expression,
+            ConditionExpression=condition,
+            ExpressionAttributeNames={
+                '#pending': 'Pending',
+                '#count': status,
+                '#names': f"{status}Packages"
+            },
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if len(package_names) == 1:
+            print(f"{package_names[0]} has already been counted, ignoring")
+            return None, set()
+
+        record = None
+        counted = set()
+        for name in package_names:
+            name_record, name_counted = record_results(
+                fanout_table, fanout_id, [name], status)
+            record = name_record or record
+            counted |= name_counted
+        return record, counted
+    return resp['Attributes'], set(package_names)
+
+
+def complete_packages(fanout_table, fanout_id, package_states):
+    """ Handles the packages which have been built within a batch.
+
+    The items of the packages are read in a single batch, so their status
+    can be updated with a single batch write while keeping their dependents.
+    Built packages are kept in the table for the metapackage, and any
+    packages waiting on them have their count of remaining dependencies
+    decreased once per batch. Only the packages counted by this batch do so,
+    so a redelivered message doesn't release its dependents early. The
+    builds are added to the artifact cache, so later fanouts can reuse them.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the packages are part of
+        package_states (list): Name and final state of each package built
+
+    Returns:
+        (dict): The fanout record after the update, or None if every package
+                had already been counted
+    """
+
+    states = {x['PackageName']: x for x in package_states}
+    keys = [package_key(fanout_id, name) for name in states]
+    items = {x['PackageName']: x for x in batch_get_items(fanout_table, keys)}
+
+    print(f"Marking {len(states)} packages as built")
+    with fanout_table.batch_writer() as batch:
+        for name, package_state in states.items():
+            item = dict(items.get(name, package_key(fanout_id, name)))
+            if FANOUT_TTL and 'ExpiresAt' not in item:
+                item['ExpiresAt'] = int(time.time()) + FANOUT_TTL
+            item.update({
+                'BuildStatus': package_state['BuildStatus'],
+                'IsMeta': package_state.get('IsMeta'),
+                'GitUrl': package_state.get('GitUrl'),
+                'repo': package_state.get('repo'),
+                'GitBranch': package_state.get('GitBranch')
+            })
+            if package_state.get('Promoted'):
+                item['Promoted'] = True
+                item['Version'] = package_state.get('Version')
+            batch.put_item(Item=item)
+
+    # Redelivered messages have already been counted, and have already
+    # released their dependents
+    record, counted = record_results(fanout_table, fanout_id, list(states),
+                                     Status.Complete.name)
+    if not counted:
+        return None
+
+    cache_artifacts([items[name] for name in counted
+                     if name in items and not states[name].get('Promoted')])
+
+    # Count how many dependencies of each waiting package have been built
+    failed = record.get('FailedPackages', set())
+    built = {}
+    for item in (items[x] for x in counted if x in items):
+        for dependent in item.get('Dependents', []):
+            if dependent not in failed:
+                built[dependent] = built.get(dependent, 0) + 1
+    for dependent, count in built.items():
+        dependency_built(fanout_table, fanout_id, dependent, count)
+    return record
+
+
+def cache_artifacts(items):
+    """ Adds the packages which have been built to the artifact cache, along
+    with the bucket they were built into, so the fanout starter can reuse
+    them rather than building the same sources again.
+
+    The cache only saves later builds, so any errors storing it are logged
+    rather than failing the messages.
+
+    Args:
+        items (list): The fanout table items of the packages built
+    """
+
+    items = [x for x in items if x.get('SourceKey') and x.get('repo')]
+    if not ARTIFACT_CACHE or not items:
+        return
+
+    dynamo = get_dynamo_resource()
+    cache_table = dynamo.Table(ARTIFACT_CACHE)
+    for item in items:
+        try:
+            cache_artifact(cache_table, item['PackageName'], item['SourceKey'],
+                           item['repo'])
+        except Exception as e:
+            print(f"Unable to cache the build of {item['PackageName']}: {e}")
+
+
+def fail_package(fanout_table, fanout_id, package_name):
+    """ Removes a failed package from the table and counts it as failed,
+    cascading the failure to every package depending on it as they can no
+    longer be built.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
+        package_name (str): Name of the package which failed
+
+    Returns:
+        (dict): The fanout record after the last update, or None if every
+                package had already been counted
+    """
+
+    print(f"Removing failed item {package_name}")
+    record, _ = record_results(fanout_table, fanout_id, [package_name],
+                               Status.Failed.name)
+    resp = fanout_table.delete_item(
+        Key=package_key(fanout_id, package_name),
+        ReturnValues='ALL_OLD')
+
+    # Always cascade, as the dependents of a package which was failed before
+    # its own status arrived are only known once it does
+    for dependent in resp.get('Attributes', {}).get('Dependents', []):
+        print(f"Dependency {package_name} of {dependent} failed")
+        record = fail_package(fanout_table, fanout_id, dependent) or record
+    return record
+
+
+def wait_for_dependencies(fanout_table, fanout_id, package_state):
+    """ Stores a package which is waiting for its dependencies to be built,
+    along with the number of dependencies remaining.
+
+    Dependencies which finished before this message arrived have already
+    decreased the count, so the package is released straight away if none
+    are left, or failed if any of them have failed.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
+        package_state (dict): Name, state and dependencies of the package
+
+    Returns:
+        (dict): The fanout record if the package failed, otherwise None
+    """
+
+    name = package_state['PackageName']
+    depends_on = package_state.get('DependsOn', [])
+    update_expression = "set BuildStatus = :s, IsMeta = :m, repo = :r, DependsOn = :d"
+    values = {
+        ':s': Status.Waiting.name,
+        ':m': False,
+        ':r': package_state.get('repo'),
+        ':d': depends_on,
+        ':n': len(depends_on)
+    }
+    if package_state.get('Dependents'):
+        update_expression += ", Dependents = :dp"
+        values[':dp'] = package_state['Dependents']
+
+    # The lane the package is built within once it's released
+    if package_state.get('Lane'):
+        update_expression += ", Lane = :l"
+        values[':l'] = package_state['Lane']
+
+    # The sources the package is built from, for caching the build
+    if package_state.get('SourceKey'):
+        update_expression += ", SourceKey = :k"
+        values[':k'] = package_state['SourceKey']
+
+    try:
+        resp = fanout_table.update_item(
+            Key=package_key(fanout_id, name),
+            UpdateExpression=with_expiry(update_expression + " ADD Remaining :n",
+                                         values),
+            ConditionExpression="attribute_not_exists(BuildStatus)",
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"{name} is already being handled, ignoring")
+        return None
+
+    record = fanout_table.get_item(
+        Key=package_key(fanout_id, FANOUT_RECORD),
+        ProjectionExpression='FailedPackages').get('Item', {})
+    if set(depends_on).intersection(record.get('FailedPackages', set())):
+        print(f"A dependency of {name} has already failed")
+        return fail_package(fanout_table, fanout_id, name)
+
+    if resp['Attributes']['Remaining'] <= 0:
+        release_package(fanout_table, fanout_id, name)
+    return None
+
+
+def dependency_built(fanout_table, fanout_id, package_name, count=1):
+    """ Decreases the number of dependencies a waiting package is waiting
+    on, releasing it to be built once there are none remaining.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
+        package_name (str): Name of the waiting package
+        count (int): The number of its dependencies which have been built
+    """
+
+    values = {':dec': -count}
+    resp = fanout_table.update_item(
+        Key=package_key(fanout_id, package_name),
+        UpdateExpression=with_expiry("ADD Remaining :dec", values),
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
+    )
+    item = resp['Attributes']
+    if item['Remaining'] <= 0 and item.get('BuildStatus') == Status.Waiting.name:
+        release_package(fanout_table, fanout_id, package_name)
+
+
+def release_package(fanout_table, fanout_id, package_name):
+    """ Sends a waiting package to the build queue once all of its
+    dependencies have been built. The status is changed conditionally so the
+    package is only sent once.
+
+    Args:
+        fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run the package is part of
+        package_name (str): Name of the package to build
+    """
+
+    try:
+        resp = fanout_table.update_item(
+            Key=package_key(fanout_id, package_name),
+            UpdateExpression="set BuildStatus = :s",
+            ConditionExpression="BuildStatus = :w",
+            ExpressionAttributeValues={
+                ':s': Status.Building.name,
+                ':w': Status.Waiting.name
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return
+
+    print(f"Dependencies of {package_name} built, releasing to build")
+    build_msg = {
+        "PackageName": package_name,
+        "Repo": resp['Attributes'].get('repo'),
+        "FanoutId": fanout_id
+    }
+    if resp['Attributes'].get('Lane'):
+        build_msg['Lane'] = resp['Attributes']['Lane']
+    send_to_queue(BUILD_FUNCTION_QUEUE, json.dumps(build_msg))
+
+
+def build_metapackage(fanout_table, fanout_id):
     """ Adds the metapackage to the build queue.
 
+    The fanout record is marked as started with a conditional update, so
+    only the first message to see the fanout complete starts the metapackage
+    build. The record is kept until the metapackage has been built.
+
     Args:
         fanout_table (Table): Table containing the status of each package
+        fanout_id (str): ID of the fanout run which has finished
+
+    Returns:
+        (bool): Whether the metapackage was added to the build queue
     """
 
     print("All packages finished - invoking the metapackage builder")
-    resp = fanout_table.query(
-            KeyConditionExpression=Key('PackageName').eq("GIT_REPO"))
+    try:
+        resp = fanout_table.update_item(
+            Key=package_key(fanout_id, FANOUT_RECORD),
+            UpdateExpression="set MetapackageStarted = :t",
+            ConditionExpression="attribute_exists(GitUrl) AND #pending = :z "
+                                "AND attribute_not_exists(MetapackageStarted)",
+            ExpressionAttributeNames={'#pending': 'Pending'},
+            ExpressionAttributeValues={':z': 0, ':t': True},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print("Metapackage already started")
+        return False
+
+    record = resp['Attributes']
     msg = {
-        "git_url": resp['Items'][0]['GitUrl'],
-        "repo": resp['Items'][0]['repo'],
-        "git_branch": resp['Items'][0]['GitBranch'],
+        "git_url": record['GitUrl'],
+        "repo": record['repo'],
+        "git_branch": record['GitBranch'],
+        "fanout_id": fanout_id
     }
     send_to_queue(METAPACKAGE_QUEUE, json.dumps(msg))
-    print("Removing the metapackage from the fanout table")
-    fanout_table.delete_item(Key={"PackageName": "GIT_REPO"})
+    return True
+
+
+def cache_pkgbuild(record, succeeded):
+    """ Stores the hash of the PKGBUILDs a fanout was started from once its
+    metapackage has been built, so the retriever can skip pushes of the same
+    PKGBUILDs to the branch.
 
+    Fanouts with failed packages still replace the metapackage, so their hash
+    is stored too. Otherwise reverting to the PKGBUILDs of the last fanout
+    without failures would be skipped, leaving the partial build in place.
+
+    Args:
+        record (dict): The fanout record of the finished fanout
+        succeeded (bool): Whether every package within the fanout was built
+    """
+
+    if not PKGBUILD_CACHE or not record.get('PkgbuildHash'):
+        return
+
+    print(f"Caching PKGBUILD hash {record['PkgbuildHash']}, succeeded: {succeeded}")
+    dynamo = get_dynamo_resource()
+    cache_table = dynamo.Table(PKGBUILD_CACHE)
+    cache_table.put_item(Item={
+        'GitUrl': record['GitUrl'],
+        'GitBranch': record['GitBranch'],
+        'PkgbuildHash': record['PkgbuildHash'],
+        'Succeeded': succeeded,
+        'UpdatedAt': int(time.time())
+    })
@@ -1,21 +1,26 @@
 import json
 import os
 
-from boto3.dynamodb.conditions import Key
-from concurrent.futures import ThreadPoolExecutor
-from urllib.request import urlopen
-from urllib.parse import urlencode
-
-from aws import get_dynamo_resource, send_to_queue
+from artifact_cache import cache_artifact, get_cached_artifacts
+from artifact_cache import get_source_key, is_repo_signed, promote_artifacts
+from aws import batch_get_items, get_client, get_dynamo_resource
+from aws import send_batch_to_queue
+from build_history import LONG_BUILD_DURATION
+from build_history import get_build_history, get_predicted_duration
 from common import return_code
-from enums import Status
+from enums import Lane, Status
+from packages import parse_dependency, provides_partition, satisfies, vercmp
 
 FANOUT_QUEUE = os.environ.get('FANOUT_QUEUE')
 PACKAGE_TABLE = os.environ.get('PACKAGE_TABLE')
 BUILD_FUNCTION_QUEUE = os.environ.get('BUILD_FUNCTION_QUEUE')
 PERSONAL_REPO = os.environ.get('PERSONAL_REPO')
 DEV_REPO = os.environ.get('DEV_REPO')
-OFFICIAL_PKG_API = "https://www.archlinux.org/packages/search/json/"
+OFFICIAL_REPOS = os.environ.get('OFFICIAL_REPOS', 'core,extra,multilib')
+BUILD_HISTORY = os.environ.get('BUILD_HISTORY')
+ARTIFACT_CACHE = os.environ.get('ARTIFACT_CACHE')
+REPO_ARCH = os.environ.get('REPO_ARCH', 'x86_64')
+REPO_NAME = os.environ.get('REPO_NAME')
 
 
 def lambda_handler(event, context):
@@ -33,91 +38,389 @@ def lambda_handler(event, context):
         git_url = json_record['git_url']
         git_branch = json_record['git_branch']
         stage = json_record['stage']
+        graph = json_record.get('graph', {})
+        aur_versions = json_record.get('versions', {})
+        pkgbuild_hash = json_record.get('pkgbuild_hash')
+        sources = json_record.get('sources', {})
+
+        # Each push gets its own fanout run, so that separate pushes can be
+        # built at the same time. The SQS message ID is used so a redelivered
+        # message reuses the same run.
+        fanout_id = record['messageId']
 
         # Put each one in the FANOUT_STATUS table with an "Initialized"
         # status and add it to the queue
-        build_packages = get_packages_to_build(package_table, deps, stage)
+        build_packages = get_packages_to_build(package_table, deps, stage,
+                                               aur_versions)
+
+        # Copy any packages built from the same sources before rather than
+        # building them again
+        repo = PERSONAL_REPO if git_branch == 'master' else DEV_REPO
+        promoted = promote_cached_packages(build_packages, graph, sources, repo)
+        build_packages = [x for x in build_packages if x not in promoted]
 
         if len(build_packages) > 0:
             print(f"Building the following packages: {build_packages}")
         else:
             print("No new packages to build")
 
-        process_packages(build_packages, git_url, git_branch, stage)
+        process_packages(build_packages, git_url, git_branch, stage, fanout_id,
+                         graph, pkgbuild_hash, sources, promoted)
 
     return return_code(200, {'packages': build_packages})
 
 
-def get_packages_to_build(package_table, pkgbuild_packages, stage):
+def get_packages_to_build(package_table, pkgbuild_packages, stage,
+                          aur_versions=None):
     """ Compare the packages contained within the PKGBUILD to those already
     available in various repositories, returning only those which need to be
     built.
 
+    The official repositories are indexed within the package table by the
+    package updater, so every package is checked against them and the
+    personal repository in a single batch lookup. Any dependencies not found
+    by name are then checked against the virtual packages provided by those
+    repositories, taking version constraints into account. Packages which
+    are available but older than the latest version in the AUR are rebuilt.
+
     Args:
         package_table (Table):    The table containing all packages already
                                   available.
         pkgbuild_packages (list): The collection of packages to check against
-                                  those available.
+                                  those available, optionally including a
+                                  version constraint, eg. 'foo>=1.2'
         stage (str):              Whether the dev or prod repo is in use.
+        aur_versions (dict):      The latest version of each AUR package
 
     Returns:
         (list): A list of packages to send to the build queue.
     """
 
-    print("Check packages against official repositories")
-    initial_to_build = []
-    with ThreadPoolExecutor() as executor:
-        pkgs = [x for x in \
-                executor.map(check_packages_against_official, pkgbuild_packages) \
-                if x is not None]
-        initial_to_build.extend(pkgs)
-
-    print("Getting all current and new items in the table")
-
     # Get the list of repositories we're pulling from
     repo_name = PERSONAL_REPO if stage == 'prod' else DEV_REPO
-
-    # Pull the list of packages within those repos
-    resp = package_table.query(KeyConditionExpression=Key('Repository').eq(repo_name))
-    aur_packages = [x['PackageName'] for x in resp['Items']]
+    repos = [repo_name] + get_official_repos()
+
+    print(f"Checking packages against {repos}")
+    dependencies = [parse_dependency(x) for x in pkgbuild_packages]
+    available = get_available_packages(
+        package_table, repos, [x[0] for x in dependencies])
+    unresolved = [(name, op, version) for name, op, version in dependencies
+                  if not _is_satisfied(available.get(name), op, version,
+                                       allow_unknown=True)]
+
+    # Check whether any other packages provide those not found
+    print(f"Checking providers of {len(unresolved)} packages")
+    providers = get_providers(
+        package_table, repos, [x[0] for x in unresolved])
+    to_build = set(name for name, op, version in unresolved
+                   if not _is_satisfied(providers.get(name), op, version))
+
+    # Rebuild any packages with a newer version in the AUR
+    aur_versions = aur_versions or {}
+    outdated = [name for name, _, _ in dependencies
+                if _is_outdated(available.get(name), aur_versions.get(name))]
+    if outdated:
+        print(f"Rebuilding outdated packages: {outdated}")
+    to_build.update(outdated)
 
     # Retrieve those packages that aren't available yet
-    to_build = list(set(initial_to_build).difference(aur_packages))
-    return to_build
+    return list(to_build)
+
+
+def _is_satisfied(versions, op, required, allow_unknown=False):
+    """ Checks whether any of the versions available meets a dependency's
+    version constraint.
+
+    Args:
+        versions (list): The versions available, or None if there are none
+        op (str): The constraint operator, or None if unversioned
+        required (str): The version required by the constraint
+        allow_unknown (bool): Whether a missing version should be treated as
+                              meeting the constraint, for table entries
+                              which predate versions being stored
+
+    Returns:
+        (bool): Whether the dependency is satisfied
+    """
+
+    if not versions:
+        return False
+
+    return any(satisfies(v, op, required)
+               or (allow_unknown and v is None)
+               for v in versions)
+
+
+def _is_outdated(versions, aur_version):
+    """ Checks whether every known version of a package available is older
+    than its latest version in the AUR.
+
+    Args:
+        versions (list): The versions available, or None if there are none
+        aur_version (str): The latest version in the AUR, or None if the
+                           package isn't in the AUR
+
+    Returns:
+        (bool): Whether the package needs to be rebuilt
+    """
+
+    known = [v for v in versions or [] if v is not None]
+    if not known or aur_version is None:
+        return False
+    return all(vercmp(aur_version, v) > 0 for v in known)
 
 
-def check_packages_against_official(pkgbuild_package):
-    """ Check which packages are already contained within the official repos
+def get_official_repos():
+    """ Gets the names of the official repositories indexed in the table """
+    return [x.strip() for x in OFFICIAL_REPOS.split(',') if x.strip()]
+
+
+def get_available_packages(package_table, repos, packages):
+    """ Finds which of the packages are already contained within any of the
+    repositories specified.
+
+    Args:
+        package_table (Table): The table containing all packages available
+        repos (list):          The repositories to search
+        packages (list):       Names of the packages to search for
+
+    Returns:
+        (dict): The versions of each package found within the repositories
+    """
+
+    keys = [{'Repository': repo, 'PackageName': pkg}
+            for repo in repos
+            for pkg in set(packages)]
+    items = batch_get_items(package_table, keys,
+                            projection=['PackageName', 'Version'])
+
+    available = {}
+    for item in items:
+        available.setdefault(item['PackageName'], []).append(item.get('Version'))
+    return available
+
+
+def get_providers(package_table, repos, packages):
+    """ Finds the versions of each virtual package provided by any package
+    within the repositories specified.
+
+    Args:
+        package_table (Table): The table containing the provides index
+        repos (list):          The repositories to search
+        packages (list):       Names of the virtual packages to search for
+
+    Returns:
+        (dict): The versions provided for each virtual package found, with
+                None for unversioned providers
+    """
+
+    if not packages:
+        return {}
+
+    keys = [{'Repository': provides_partition(repo), 'PackageName': pkg}
+            for repo in repos
+            for pkg in set(packages)]
+    items = batch_get_items(package_table, keys,
+                            projection=['PackageName', 'Providers'])
+
+    providers = {}
+    for item in items:
+        for provider in item['Providers']:
+            print(f"{item['PackageName']} is provided by {provider['Name']}")
+            providers.setdefault(item['PackageName'], []).append(provider['Version'])
+    return providers
+
+
+def get_build_layers(build_packages, graph):
+    """ Orders the packages to build into layers, where each package only
+    depends on packages within earlier layers.
+
+    Only dependencies which are also being built are taken into account, as
+    the rest are already available. Any packages within a dependency cycle
+    are placed in a final layer together.
 
     Args:
-        pkgbuild_package (str): Name of package to check repository for
+        build_packages (list): Names of the packages to build
+        graph (dict):          The AUR packages each package depends on
 
     Returns:
-        list: List of packages not already contained in official repos
+        (list): Lists of package names, one per layer
     """
 
-    params = urlencode({'name': pkgbuild_package})
-    url = f"{OFFICIAL_PKG_API}?{params}"
-    print(f"Checking official packages from {url}")
-    with urlopen(url) as resp:
-        data = json.loads(resp.read())
-        distinct_pkgs = len(set([x['pkgname'] for x in data['results']]))
+    prerequisites = get_prerequisites(build_packages, graph)
+    remaining = set(build_packages)
+    layers = []
+
+    while remaining:
+        layer = sorted(x for x in remaining
+                       if not prerequisites[x].intersection(remaining))
+        if not layer:
+            print(f"Dependency cycle found between {sorted(remaining)}")
+            layer = sorted(remaining)
+        layers.append(layer)
+        remaining.difference_update(layer)
+
+    return layers
+
+
+def get_prerequisites(build_packages, graph):
+    """ Gets the packages which need to be built before each package.
+
+    Args:
+        build_packages (list): Names of the packages to build
+        graph (dict):          The AUR packages each package depends on
+
+    Returns:
+        (dict): The set of packages being built that each package depends on
+    """
+
+    to_build = set(build_packages)
+    return {pkg: set(graph.get(pkg, [])).intersection(to_build) - {pkg}
+            for pkg in build_packages}
+
+
+def get_predicted_durations(build_packages):
+    """ Predicts how long each package will take to build from the build
+    history.
+
+    Args:
+        build_packages (list): Names of the packages to build
+
+    Returns:
+        (dict): The predicted duration in seconds of each package built
+                before
+    """
+
+    if not BUILD_HISTORY or not build_packages:
+        return {}
+
+    dynamo = get_dynamo_resource()
+    history = get_build_history(dynamo.Table(BUILD_HISTORY), build_packages)
+    durations = {name: get_predicted_duration(x) for name, x in history.items()}
+    return {name: x for name, x in durations.items() if x is not None}
+
+
+def get_build_lanes(layers, depends_on, dependents, durations):
+    """ Chooses the lane each package is built within.
+
+    Packages predicted to take a long time are built within the long lane,
+    so they don't hold up the quicker builds. So are the packages on the
+    critical path, the chain of dependencies taking the longest to build,
+    if the path takes a long time, as the metapackage can't be built
+    before it finishes.
+
+    Args:
+        layers (list):      Lists of package names, one per build layer
+        depends_on (dict):  The packages each package waits on
+        dependents (dict):  The packages waiting on each package
+        durations (dict):   The predicted duration of each package built
+                            before
+
+    Returns:
+        (dict): The name of the lane of each package
+    """
+
+    # The longest time taken to build each package including everything it
+    # waits on, and including everything waiting on it
+    before = {}
+    for layer in layers:
+        for pkg in layer:
+            before[pkg] = durations.get(pkg, 0) + max(
+                (before[x] for x in depends_on[pkg]), default=0)
+    after = {}
+    for layer in reversed(layers):
+        for pkg in layer:
+            after[pkg] = durations.get(pkg, 0) + max(
+                (after[x] for x in dependents[pkg]), default=0)
+
+    paths = {pkg: before[pkg] + after[pkg] - durations.get(pkg, 0)
+             for pkg in before}
+    critical = max(paths.values(), default=0)
+    if critical >= LONG_BUILD_DURATION:
+        print(f"Critical path takes {critical} seconds")
+
+    lanes = {}
+    for pkg, path in paths.items():
+        long_build = durations.get(pkg, 0) >= LONG_BUILD_DURATION
+        critical_path = critical >= LONG_BUILD_DURATION and path >= critical - 1
+        lanes[pkg] = Lane.Long.name if long_build or critical_path \
+            else Lane.Default.name
+    return lanes
+
+
+def promote_cached_packages(build_packages, graph, sources, repo):
+    """ Promotes the packages which have already been built from the same
+    sources into the repository, rather than building them again.
+
+    The artifact cache records which repository buckets hold the packages
+    built from each package base, version and hash of the sources. Packages
+    found within the other bucket are copied within S3.
+
+    Promoted packages aren't added to the repository database until the
+    metapackage is built, so only those which no other package being built
+    depends on are promoted. Any which can't be promoted are built instead.
+    The repo DB writer can't sign the database, so nothing is promoted into
+    a repository with a signed database.
+
+    Args:
+        build_packages (list): Names of the packages to build
+        graph (dict):          The AUR packages each package depends on
+        sources (dict):        The PackageBase, Version and SourceHash of
+                               each AUR package
+        repo (str):            The bucket of the repository being built
+
+    Returns:
+        (list): Names of the packages promoted
+    """
+
+    if not ARTIFACT_CACHE or not build_packages:
+        return []
+
+    prerequisites = get_prerequisites(build_packages, graph or {})
+    needed = set().union(*prerequisites.values())
+    source_keys = {name: get_source_key(sources[name])
+                   for name in build_packages
+                   if name in sources and name not in needed}
+    if not source_keys:
+        return []
+
+    dynamo = get_dynamo_resource()
+    cache_table = dynamo.Table(ARTIFACT_CACHE)
+    cached = get_cached_artifacts(cache_table, source_keys)
+    print(f"Found cached builds of {sorted(cached)}")
+    if not cached:
+        return []
+
+    s3 = get_client('s3')
+    if is_repo_signed(s3, repo, REPO_ARCH, REPO_NAME):
+        print(f"The database of {repo} is signed, building instead")
+        return []
+
+    promoted = []
+    for name, item in cached.items():
         try:
-            assert distinct_pkgs <= 1
-        except AssertionError:
-            print(f"URL {url} contained more than one package:")
-            print(json.dumps(data))
-            raise
-        if len(data['results']) == 0:
-            return pkgbuild_package
+            if promote_artifacts(s3, REPO_ARCH, name, sources[name]['Version'],
+                                 item.get('Buckets', set()), repo):
+                cache_artifact(cache_table, name, source_keys[name], repo)
+                promoted.append(name)
+        except Exception as e:
+            print(f"Unable to promote {name}, building instead: {e}")
 
-    return None
+    return sorted(promoted)
 
 
-def process_packages(build_packages, metapackage_url, branch, stage):
+def process_packages(build_packages, metapackage_url, branch, stage, fanout_id,
+                     graph=None, pkgbuild_hash=None, sources=None,
+                     promoted=None):
     """ Add packages to be built to a build queue including the metapackage
     URL for building after completion.
 
+    The status and build messages for every package are collected and sent in
+    batches, rather than making two SQS calls per package. Only packages with
+    no dependencies left to build are sent to the build queue, and the rest
+    wait in the fanout status table until the fanout controller releases them
+    once their dependencies have been built.
+
     Args:
         build_packages (list): The collection of packages to build as a list 
                                of package names
@@ -125,51 +428,129 @@ def process_packages(build_packages, metapackage_url, branch, stage):
                                to build after the rest
         branch (str):          Branch of the triggering git commit
         stage (str):           Whether the commit is from a prod or dev branch
+        fanout_id (str):       ID of the fanout run building the packages
+        graph (dict):          The AUR packages each package depends on
+        pkgbuild_hash (str):   Hash of the PKGBUILDs the packages are from
+        sources (dict):        The PackageBase, Version and SourceHash of
+                               each AUR package
+        promoted (list):       Packages copied from the artifact cache, which
+                               are counted as built straight away
     """
 
+    fanout_messages = []
+    build_messages = []
+    sources = sources or {}
+    promoted = promoted or []
+    layers = get_build_layers(build_packages, graph or {})
+    prerequisites = get_prerequisites(build_packages, graph or {})
+
+    # Only wait on packages in earlier layers so those within a dependency
+    # cycle don't wait on each other
+    depends_on = {}
+    dependents = {pkg: set() for pkg in build_packages}
+    earlier = set()
+    for i, layer in enumerate(layers):
+        print(f"Build layer {i}: {layer}")
+        for pkg in layer:
+            depends_on[pkg] = prerequisites[pkg].intersection(earlier)
+            for dep in depends_on[pkg]:
+                dependents[dep].add(pkg)
+        earlier.update(layer)
+
+    lanes = get_build_lanes(layers, depends_on, dependents,
+                            get_predicted_durations(build_packages))
+
     # Build the other packages
-    for pkg in build_packages:
-        process_package(pkg, branch, stage)
+    for layer in layers:
+        for pkg in layer:
+            source_key = get_source_key(sources[pkg]) if pkg in sources else None
+            fanout_msg, build_msg = process_package(
+                pkg, branch, stage, fanout_id, depends_on[pkg], dependents[pkg],
+                lanes[pkg], source_key)
+            fanout_messages.append(json.dumps(fanout_msg))
+            if not depends_on[pkg]:
+                build_messages.append(json.dumps(build_msg))
 
-    # Store the metapackage URL for building on completion
     repo = PERSONAL_REPO if branch == 'master' else DEV_REPO
+
+    # Packages copied from the artifact cache have already been built
+    for pkg in promoted:
+        fanout_messages.append(json.dumps({
+            "PackageName": pkg,
+            "FanoutId": fanout_id,
+            "BuildStatus": Status.Complete.name,
+            "repo": repo,
+            "IsMeta": False,
+            "Promoted": True,
+            "Version": sources[pkg]['Version']
+        }))
+
+    # Store the metapackage URL for building on completion
     metapackage_msg = {
         "PackageName": "GIT_REPO",
+        "FanoutId": fanout_id,
         "BuildStatus": Status.Initialized.name,
         "IsMeta": True,
         "GitUrl": metapackage_url,
         "GitBranch": branch,
-        "repo": repo
+        "repo": repo,
+        "PackageCount": len(build_packages) + len(promoted),
+        "PkgbuildHash": pkgbuild_hash
     }
-    send_to_queue(FANOUT_QUEUE, json.dumps(metapackage_msg))
+    fanout_messages.append(json.dumps(metapackage_msg))
+
+    # Update the status of each package before adding them to the build queue
+    send_batch_to_queue(FANOUT_QUEUE, fanout_messages)
+    send_batch_to_queue(BUILD_FUNCTION_QUEUE, build_messages)
 
 
-def process_package(package, branch, stage):
-    """ Adds packages to the build queue and updates their status
+def process_package(package, branch, stage, fanout_id, depends_on=None,
+                    dependents=None, lane=Lane.Default.name, source_key=None):
+    """ Creates the messages used to add a package to the build queue and
+    update its status
 
     Args:
-        package (str): The package to check
-        branch (str):  Branch of the triggering git commit
-        stage (str):   Whether the commit is from a prod or dev branch
+        package (str):      The package to check
+        branch (str):       Branch of the triggering git commit
+        stage (str):        Whether the commit is from a prod or dev branch
+        fanout_id (str):    ID of the fanout run building the package
+        depends_on (set):   Packages which need to be built first, if any
+        dependents (set):   Packages waiting on this one to be built, if any
+        lane (str):         The lane the package is built within
+        source_key (str):   Key of the package's sources within the artifact
+                            cache, if known
+
+    Returns:
+        (tuple): The fanout status message and the build queue message
     """
 
     print(f"Building package: {package}")
 
     repo = PERSONAL_REPO if branch == 'master' else DEV_REPO
 
-    # Update the status to say the package is building
+    # Update the status to say the package is building, or waiting on its
+    # dependencies to be built
     message = {
         "PackageName": package,
+        "FanoutId": fanout_id,
         "BuildStatus": Status.Building.name,
         "repo": repo,
-        "IsMeta": False
+        "IsMeta": False,
+        "Lane": lane
     }
-    send_to_queue(FANOUT_QUEUE, json.dumps(message))
+    if depends_on:
+        message["BuildStatus"] = Status.Waiting.name
+        message["DependsOn"] = sorted(depends_on)
+    if dependents:
+        message["Dependents"] = sorted(dependents)
+    if source_key:
+        message["SourceKey"] = source_key
 
     # Add them to the build queue and start the build VM
     build_msg = {
         "PackageName": package,
-        "Repo": repo
+        "Repo": repo,
+        "FanoutId": fanout_id,
+        "Lane": lane
     }
-    send_to_queue(BUILD_FUNCTION_QUEUE, json.dumps(build_msg))
-
+    return message, build_msg
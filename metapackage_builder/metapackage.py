@@ -1,11 +1,14 @@
 import json
 import os
 
-from aws import send_to_queue, get_dynamo_resource
+from boto3.dynamodb.conditions import Key
+
+from aws import send_to_queue, get_dynamo_resource, query_items
 from common import return_code
 from enums import Status
 
 BUILD_FUNCTION_QUEUE = os.environ.get('BUILD_FUNCTION_QUEUE')
+REPO_DB_QUEUE = os.environ.get('REPO_DB_QUEUE')
 FANOUT_STATUS = os.environ.get('FANOUT_STATUS')
 
 
@@ -16,25 +19,56 @@ def lambda_handler(event, context):
         msg = json.loads(record['body'])
         pkgbuild_url = msg['git_url']
         git_branch = msg['git_branch']
-        built_packages = get_built_packages()
+        fanout_id = msg['fanout_id']
+        built_packages, promoted_packages = get_built_packages(fanout_id)
         repo = msg['repo']
         build_event = {
             "PackageName": "GIT_REPO",
             "Repo": repo,
+            "FanoutId": fanout_id,
             "git_url": pkgbuild_url,
             "git_branch": git_branch,
             "built_packages": built_packages
         }
-        send_to_queue(BUILD_FUNCTION_QUEUE, json.dumps(build_event))
+
+        # Packages promoted from the artifact cache are added to the
+        # repository database before the metapackage is built
+        if promoted_packages:
+            print(f"Adding promoted packages to {repo}: {promoted_packages}")
+            db_msg = {
+                "bucket": repo,
+                "add": promoted_packages,
+                "build_event": build_event
+            }
+            send_to_queue(REPO_DB_QUEUE, json.dumps(db_msg))
+        else:
+            send_to_queue(BUILD_FUNCTION_QUEUE, json.dumps(build_event))
 
     return return_code(200, {'status': 'Metapackage sent to build queue'})
 
 
-def get_built_packages():
+def get_built_packages(fanout_id):
+    """ Gets the packages completed within a fanout, along with the name and
+    version of those promoted from the artifact cache rather than built,
+    which still need adding to the repository database.
+
+    Args:
+        fanout_id (str): ID of the fanout run which has finished
+
+    Returns:
+        (tuple): Names of the packages completed, and the PackageName and
+                 Version of those promoted
+    """
+
     dynamo = get_dynamo_resource()
     fanout_table = dynamo.Table(FANOUT_STATUS)
-    resp = fanout_table.scan()
-    return [x['PackageName'] 
-            for x in resp['Items'] 
-            if x['BuildStatus'] == Status.Complete.name]
+    items = query_items(fanout_table,
+                        projection=['PackageName', 'BuildStatus', 'Promoted',
+                                    'Version'],
+                        KeyConditionExpression=Key('FanoutId').eq(fanout_id))
+    complete = [x for x in items
+                if x.get('BuildStatus') == Status.Complete.name]
+    return ([x['PackageName'] for x in complete],
+            [{'PackageName': x['PackageName'], 'Version': x.get('Version')}
+             for x in complete if x.get('Promoted')])
 
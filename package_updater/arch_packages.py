@@ -1,109 +1,333 @@
-import lzma
 import gzip
+import hashlib
+import io
+import lzma
+import tarfile
+import urllib.error
 import urllib.request
 
-from io import BytesIO
-from tarfile import TarFile
+from collections import namedtuple
+
 from zstandard import ZstdDecompressor
 
+# Size of each chunk read from the mirror when streaming the DB file
+STREAM_BUFFER_SIZE = 64 * 1024
 
-def _extract_archive_from_stream(stream):
-    """Extracts a TarFile from the byte stream specified.
+# Offset and value of the magic bytes within an uncompressed tar header
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b'ustar'
+
+# Registry of supported compression formats, mapping the leading magic bytes
+# of a stream to a function which wraps it in a streaming decompressor
+CODECS = {}
 
-    The byte-stream should be a downloaded LZMA or gzip compressed tarfile.
+
+def register_codec(magic, opener):
+    """Registers a decompressor for streams starting with the magic bytes.
 
     Args:
-        stream (BytesIO): The byte stream containing the compressed archive.
+        magic (bytes): The leading bytes identifying the compression format
+        opener (function): Takes a readable binary stream and returns a
+                           readable file object of the decompressed data
+    """
+
+    CODECS[magic] = opener
+
+
+register_codec(b'\x1f\x8b', lambda s: gzip.GzipFile(fileobj=s, mode='rb'))
+register_codec(b'\xfd7zXZ\x00', lambda s: lzma.LZMAFile(s, mode='rb'))
+# Databases compressed with several zstd frames are read as a single stream
+register_codec(b'\x28\xb5\x2f\xfd',
+               lambda s: ZstdDecompressor().stream_reader(s, read_across_frames=True))
+
+
+class _PrefixedStream(io.RawIOBase):
+    """A raw stream which replays bytes already read from the front of a
+    non-seekable stream before continuing with the rest of it."""
+
+    def __init__(self, prefix, stream):
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.prefix) > 0:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.stream.readinto(b)
+
+
+class _HashingStream(io.RawIOBase):
+    """A raw stream which calculates the SHA-256 digest of the bytes read
+    through it, so the DB file can be hashed while it's being streamed."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.stream.readinto(b)
+        if n:
+            self.sha256.update(memoryview(b)[:n])
+        return n
+
+
+def _read_magic(stream, size):
+    """Reads up to `size` bytes from the start of the stream, only returning
+    fewer if the stream ends first."""
+
+    magic = b''
+    while len(magic) < size:
+        chunk = stream.read(size - len(magic))
+        if not chunk:
+            break
+        magic += chunk
+    return magic
+
+
+def _open_decompressed_stream(stream):
+    """Wraps a compressed byte stream in a streaming decompressor.
+
+    The compression format is looked up in the codec registry using the
+    leading magic bytes of the stream, so the right decoder is picked in a
+    single pass and the stream never needs to be rewound. Uncompressed tar
+    files are passed through as-is.
+
+    Args:
+        stream (file): A readable binary stream containing the compressed
+                       archive. It does not need to be seekable.
 
     Returns:
-        TarFile: The decompressed TarFile object
+        file: A readable, non-seekable file object of the decompressed data
     """
 
-    try:
-        tar = TarFile(fileobj=gzip.open(stream), mode='r')
-    except OSError:
-        stream.seek(0)
-        try:
-            tar = TarFile(fileobj=lzma.open(stream), mode='r')
-        except lzma.LZMAError:
-            stream.seek(0)
-            d = ZstdDecompressor()
-            decompressed = BytesIO()
-            d.copy_stream(stream, decompressed)
-            decompressed.seek(0)
-            tar = TarFile(fileobj=decompressed, mode='r')
-
-    return tar
-
-
-def _extract_pkg_name(tar, files):
+    magic = _read_magic(stream, TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+    stream = io.BufferedReader(_PrefixedStream(magic, stream),
+                               buffer_size=STREAM_BUFFER_SIZE)
+
+    for codec_magic, opener in CODECS.items():
+        if magic.startswith(codec_magic):
+            return opener(stream)
+
+    if magic[TAR_MAGIC_OFFSET:] == TAR_MAGIC:
+        return stream
+
+    raise ValueError(f"Unknown compression format with magic bytes {magic[:6].hex()}")
+
+
+def _extract_archive_from_stream(stream):
+    """Opens a TarFile in stream mode from the byte stream specified.
+
+    The byte-stream should be a downloaded tarfile, either uncompressed or
+    compressed with one of the formats within the codec registry. Members are
+    decompressed and read as they arrive, so the full archive is never held
+    in memory.
+
+    Args:
+        stream (file): The byte stream containing the compressed archive.
+
+    Returns:
+        TarFile: A TarFile object which must be iterated sequentially
     """
-    Extracts a list of package names from the tarfile and list of paths for
-    each 'desc' file within the archive.
+
+    fileobj = _open_decompressed_stream(stream)
+    return tarfile.open(fileobj=fileobj, mode='r|')
+
+
+# Compact record of the details of a single package within a repo DB
+Package = namedtuple('Package', [
+    'name', 'base', 'version', 'provides', 'replaces', 'depends',
+    'makedepends', 'csize', 'isize', 'builddate', 'sha256sum'
+])
+
+# Mapping of the headers within a 'desc' file to the Package fields they fill
+DESC_FIELDS = {
+    '%NAME%': 'name',
+    '%BASE%': 'base',
+    '%VERSION%': 'version',
+    '%PROVIDES%': 'provides',
+    '%REPLACES%': 'replaces',
+    '%DEPENDS%': 'depends',
+    '%MAKEDEPENDS%': 'makedepends',
+    '%CSIZE%': 'csize',
+    '%ISIZE%': 'isize',
+    '%BUILDDATE%': 'builddate',
+    '%SHA256SUM%': 'sha256sum',
+}
+LIST_FIELDS = frozenset(['provides', 'replaces', 'depends', 'makedepends'])
+INT_FIELDS = frozenset(['csize', 'isize', 'builddate'])
+
+
+def parse_desc(desc):
+    """Parses the contents of a single 'desc' file into a Package record.
+
+    Each property within the file is a header surrounded with % (eg. %NAME%)
+    followed by one value per line, and properties are separated by a blank
+    line. The file is read in a single pass line by line, keeping only the
+    fields within DESC_FIELDS.
 
     Args:
-        tar (TarFile): The archive containing package details
-        files (list): A list of paths to every 'desc' file within the archive
+        desc (str): The contents of the 'desc' file
 
     Returns:
-        list: A list of strings containing the package names for each package
-              within the archive
+        Package: The details of the package described by the file
     """
 
-    filenames = []
+    fields = {}
+    key = None
+    header = True
+
+    for line in desc.split('\n'):
+
+        # A blank line ends the current property
+        if not line:
+            header = True
+            continue
+
+        # The first line of each property is the header
+        if header:
+            key = DESC_FIELDS.get(line)
+            header = False
+            continue
+
+        if key is None:
+            continue
+
+        if key in LIST_FIELDS:
+            fields.setdefault(key, []).append(line)
+        elif key in INT_FIELDS:
+            fields[key] = int(line)
+        else:
+            fields[key] = line
 
-    for desc_file in files:
+    return Package(
+        name=fields.get('name'),
+        base=fields.get('base', fields.get('name')),
+        version=fields.get('version'),
+        provides=tuple(fields.get('provides', ())),
+        replaces=tuple(fields.get('replaces', ())),
+        depends=tuple(fields.get('depends', ())),
+        makedepends=tuple(fields.get('makedepends', ())),
+        csize=fields.get('csize'),
+        isize=fields.get('isize'),
+        builddate=fields.get('builddate'),
+        sha256sum=fields.get('sha256sum'),
+    )
 
-        # Extract and read the "desc" file
-        desc = tar.extractfile(desc_file.path).read().decode('utf-8')
 
-        # Each property is split out by two newlines
-        desc_list = list(filter(None, desc.split('\n\n')))
+def iter_packages(tar):
+    """Yields a Package record for each 'desc' file within the archive as it
+    is streamed.
 
-        desc_dict = {}
-        for x in desc_list:
+    Args:
+        tar (TarFile): The archive containing package details, opened in
+                       stream mode
+
+    Yields:
+        Package: The details of each package within the archive
+    """
+
+    for member in tar:
+
+        # Only the "desc" files contain the details we're interested in
+        if not member.isfile() or not member.name.endswith("desc"):
+            continue
 
-            # The header is the first line, and is surrounded with % (eg. %NAME%)
-            splits = x.split('\n')
-            key = splits[0]
+        desc = tar.extractfile(member).read().decode('utf-8')
+        yield parse_desc(desc)
 
-            # There can be multiple values per header
-            value = splits[1:]
-            desc_dict[key] = value
 
-        # We only want the list of names, which should only have one value
-        filenames.append(desc_dict['%NAME%'][0])
+def _get_conditional_headers(cache):
+    """Builds the HTTP headers used to only download the DB file if it has
+    changed since it was last retrieved.
 
-    return filenames
+    Args:
+        cache (dict): The ETag and Last-Modified values of the previous
+                      download, if any
+
+    Returns:
+        dict: The conditional request headers
+    """
 
+    headers = {}
+    if cache.get('etag'):
+        headers['If-None-Match'] = cache['etag']
+    if cache.get('last_modified'):
+        headers['If-Modified-Since'] = cache['last_modified']
+    return headers
 
-def get_packages(repo):
+
+def get_packages(repo, cache=None):
     """Gets a collection of packages contained within the repository URL
     specified.
 
+    The DB file is streamed from the mirror straight through the decompressor
+    and into the tar reader, so peak memory doesn't grow with the DB size.
+
+    If the cache details of a previous download are passed, a conditional
+    request is made and the DB isn't parsed at all if the mirror responds with
+    304 Not Modified. The SHA-256 of the downloaded DB is also compared to the
+    cached one, so mirrors without conditional request support can still be
+    checked for changes.
+
     Args:
         repo (dict): The mirror name and URI to download from, in the format:
                      { 'repo': `repo_name`, 'mirror': `uri` }
+        cache (dict): The 'etag', 'last_modified' and 'sha256' values of the
+                      previous download of the DB file, if any
 
     Returns:
-        dict: The repo name with a collection of package names
+        dict: The repo name with a collection of Package records, whether the
+              DB has been modified, and the cache details of this download.
+              The packages are None if the DB hasn't been modified.
     """
 
-    # Pull the DB file from the URI
-    print(f"Pulling package database from {repo['mirror']}")
-    with urllib.request.urlopen(repo['mirror']) as h:
-        stream = BytesIO(h.read())
+    cache = cache or {}
+    request = urllib.request.Request(
+        repo['mirror'],
+        headers=_get_conditional_headers(cache))
+
+    # Stream the DB file from the URI
+    print(f"Streaming package database from {repo['mirror']}")
+    try:
+        with urllib.request.urlopen(request) as h:
+
+            # Decompress and unpack the DB file as it arrives
+            stream = _HashingStream(h)
+            with _extract_archive_from_stream(stream) as tar:
+                packages = list(iter_packages(tar))
+
+            # Read any trailing padding so the whole file is hashed
+            while stream.read(STREAM_BUFFER_SIZE):
+                pass
+
+            headers = getattr(h, 'headers', None) or {}
+            new_cache = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'sha256': stream.sha256.hexdigest()
+            }
 
-    # Decompress and unpack the DB file
-    print("Decompressing downloaded DB file")
-    tar = _extract_archive_from_stream(stream)
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        print(f"Package database at {repo['mirror']} has not been modified")
+        return {'repo': repo['repo'], 'packages': None,
+                'modified': False, 'cache': cache}
 
-    # Get a list of all "desc" files within the archive
-    print("Extracting files...")
-    files = [x for x in tar.getmembers() if x.isfile() and x.name.endswith("desc")]
-    print(f"{len(files)} desc files found")
+    if new_cache['sha256'] == cache.get('sha256'):
+        print(f"Package database at {repo['mirror']} has the same hash")
+        return {'repo': repo['repo'], 'packages': None,
+                'modified': False, 'cache': new_cache}
 
-    # Extract the package names from their desc files
-    filenames = _extract_pkg_name(tar, files)
+    print(f"{len(packages)} desc files found")
 
-    return {'repo': repo['repo'], 'packages': filenames}
+    return {'repo': repo['repo'], 'packages': packages,
+            'modified': True, 'cache': new_cache}
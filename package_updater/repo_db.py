@@ -0,0 +1,426 @@
+import base64
+import gzip
+import io
+import json
+import lzma
+import os
+import tarfile
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+from zstandard import ZstdCompressor
+
+from arch_packages import STREAM_BUFFER_SIZE, _HashingStream
+from arch_packages import _extract_archive_from_stream, parse_desc
+from artifact_cache import find_artifacts, is_repo_signed
+from aws import get_client, send_to_queue
+from common import return_code
+
+REPO_NAME = os.environ.get('REPO_NAME')
+REPO_ARCH = os.environ.get('REPO_ARCH', 'x86_64')
+BUILD_FUNCTION_QUEUE = os.environ.get('BUILD_FUNCTION_QUEUE')
+
+# Extension of the compressed repository databases, matching the one used by
+# repo-add when the repository was created
+DB_EXTENSION = os.environ.get('REPO_DB_EXTENSION') or '.tar.zst'
+
+# Databases kept for each repository, along with whether each one must exist.
+# The files database is only updated if repo-add created one.
+DATABASES = (('db', True), ('files', False))
+
+# Databases larger than this are written to disk rather than kept in memory
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Number of times a database is read and written again if it was changed by
+# another writer while it was being updated
+DB_WRITE_ATTEMPTS = 5
+
+# Error codes returned by S3 when a conditional write doesn't match the
+# object, or another conditional write to it is in progress
+WRITE_CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+# Registry of compression formats the databases can be written with, mapping
+# the extension to a function which wraps a writable binary stream in a
+# streaming compressor
+COMPRESSORS = {}
+
+
+def register_compressor(extension, opener):
+    """Registers a compressor for databases with the extension specified.
+
+    Args:
+        extension (str): The extension of the database, eg. '.tar.zst'
+        opener (function): Takes a writable binary stream and returns a
+                           writable file object which compresses into it
+    """
+
+    COMPRESSORS[extension] = opener
+
+
+register_compressor('.tar', lambda s: s)
+register_compressor('.tar.gz', lambda s: gzip.GzipFile(fileobj=s, mode='wb'))
+register_compressor('.tar.xz', lambda s: lzma.LZMAFile(s, mode='wb'))
+register_compressor('.tar.zst', lambda s: ZstdCompressor().stream_writer(s, closefd=False))
+
+# Headers of a 'desc' file in the order written by repo-add, along with the
+# .PKGINFO key each is taken from. Headers without a key are calculated from
+# the package file itself.
+DESC_HEADERS = (
+    ('%FILENAME%', None),
+    ('%NAME%', 'pkgname'),
+    ('%BASE%', 'pkgbase'),
+    ('%VERSION%', 'pkgver'),
+    ('%DESC%', 'pkgdesc'),
+    ('%GROUPS%', 'group'),
+    ('%CSIZE%', None),
+    ('%ISIZE%', 'size'),
+    ('%SHA256SUM%', None),
+    ('%PGPSIG%', None),
+    ('%URL%', 'url'),
+    ('%LICENSE%', 'license'),
+    ('%ARCH%', 'arch'),
+    ('%BUILDDATE%', 'builddate'),
+    ('%PACKAGER%', 'packager'),
+    ('%REPLACES%', 'replaces'),
+    ('%CONFLICTS%', 'conflict'),
+    ('%PROVIDES%', 'provides'),
+    ('%DEPENDS%', 'depend'),
+    ('%OPTDEPENDS%', 'optdepend'),
+    ('%MAKEDEPENDS%', 'makedepend'),
+    ('%CHECKDEPENDS%', 'checkdepend'),
+)
+
+
+def lambda_handler(event, context):
+    """ Applies changes to the database of a repository, adding and removing
+    packages without rebuilding the rest of the database.
+
+    An example of the message passed to this function is as follows:
+    {
+        'bucket': 'personal-prod',
+        'add': [{'PackageName': 'foo', 'Version': '1.0-1'}],
+        'remove': ['bar'],
+        'build_event': {...}
+    }
+    The files of the packages added must already be within the bucket. If a
+    build event is included, it's sent to the build queue once the database
+    has been updated. Signed databases can't be signed again here, so the
+    message fails rather than leaving a signature which no longer matches.
+
+    Args:
+        event (dict): The SQS batch of database changes
+        context (object): Lambda context runtime methods and attributes
+
+    Returns:
+        dict: HTTP response containing the changes made to each database
+    """
+
+    print(json.dumps(event))
+    retval = {}
+    for record in event['Records']:
+        msg = json.loads(record['body'])
+        bucket = msg['bucket']
+        retval[bucket] = update_repo_db(bucket, msg.get('add', []),
+                                        msg.get('remove', []))
+
+        if msg.get('build_event'):
+            send_to_queue(BUILD_FUNCTION_QUEUE, json.dumps(msg['build_event']))
+
+    return return_code(200, retval)
+
+
+def update_repo_db(bucket, add, remove):
+    """ Adds and removes packages from the databases of the repository within
+    the bucket specified.
+
+    Args:
+        bucket (str): The bucket containing the repository
+        add (list): The PackageName and Version of each package to add
+        remove (list): Names of the packages to remove
+
+    Returns:
+        dict: The number of packages added, removed and kept in each database
+
+    Raises:
+        ValueError: If the database is signed, or the files of a package to
+                    add aren't within the bucket
+    """
+
+    s3 = get_client('s3')
+    if is_repo_signed(s3, bucket, REPO_ARCH, REPO_NAME):
+        raise ValueError(f"The {REPO_NAME} database in {bucket} is signed, "
+                         "so it can only be updated by repo-add")
+
+    entries = []
+    for package in add:
+        keys = find_artifacts(s3, bucket, REPO_ARCH, package['PackageName'],
+                              package['Version'])
+        package_key = next((x for x in keys if not x.endswith('.sig')), None)
+        if package_key is None:
+            raise ValueError(f"No files found for {package['PackageName']} "
+                             f"{package['Version']} in {bucket}")
+        signature_key = f"{package_key}.sig" if f"{package_key}.sig" in keys else None
+        entries.append(read_package(s3, bucket, package_key, signature_key))
+
+    results = {}
+    for kind, required in DATABASES:
+        results[kind] = update_database(
+            s3, bucket, kind, required,
+            [(x['path'], x[kind]) for x in entries], remove)
+    return results
+
+
+def read_package(s3, bucket, package_key, signature_key=None):
+    """ Creates the database entries of a package from its package file.
+
+    The package is streamed from S3, hashing it and listing its files as it
+    arrives, so it's never held in memory.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        bucket (str): The bucket containing the package
+        package_key (str): The key of the package file
+        signature_key (str): The key of the package's signature, if signed
+
+    Returns:
+        dict: The name of the entry's directory, along with the contents of
+              its 'desc' file in the db database and 'files' file in the
+              files database
+    """
+
+    print(f"Reading s3://{bucket}/{package_key}")
+    resp = s3.get_object(Bucket=bucket, Key=package_key)
+    stream = _HashingStream(resp['Body'])
+    info = {}
+    files = []
+    with _extract_archive_from_stream(stream) as tar:
+        for member in tar:
+            if member.name == '.PKGINFO':
+                info = parse_pkginfo(tar.extractfile(member).read().decode('utf-8'))
+            elif not member.name.startswith('.'):
+                files.append(member.name + ('/' if member.isdir() else ''))
+
+    # Read any trailing padding so the whole file is hashed
+    while stream.read(STREAM_BUFFER_SIZE):
+        pass
+
+    calculated = {
+        '%FILENAME%': [package_key.rsplit('/', 1)[-1]],
+        '%CSIZE%': [str(resp['ContentLength'])],
+        '%SHA256SUM%': [stream.sha256.hexdigest()],
+    }
+    if signature_key:
+        signature = s3.get_object(Bucket=bucket, Key=signature_key)['Body'].read()
+        calculated['%PGPSIG%'] = [base64.b64encode(signature).decode('ascii')]
+
+    desc = format_desc(info, calculated)
+    return {
+        'path': f"{info['pkgname'][0]}-{info['pkgver'][0]}",
+        'db': {'desc': desc},
+        'files': {'desc': desc, 'files': format_section('%FILES%', files)},
+    }
+
+
+def parse_pkginfo(pkginfo):
+    """ Parses the .PKGINFO file of a package, where each line is a key and
+    value separated by ' = '. Keys may be repeated for lists of values.
+
+    Args:
+        pkginfo (str): The contents of the .PKGINFO file
+
+    Returns:
+        dict: Every value of each key, in the order found
+    """
+
+    info = {}
+    for line in pkginfo.split('\n'):
+        if not line or line.startswith('#') or ' = ' not in line:
+            continue
+        key, value = line.split(' = ', 1)
+        info.setdefault(key, []).append(value)
+    return info
+
+
+def format_section(header, values):
+    """ Formats a single property of a database entry, with its header
+    followed by one value per line and a blank line. """
+    return f"{header}\n" + ''.join(f"{x}\n" for x in values) + "\n"
+
+
+def format_desc(info, calculated):
+    """ Formats the 'desc' file of a package in the same way as repo-add.
+
+    Args:
+        info (dict): The parsed .PKGINFO of the package
+        calculated (dict): The values of the properties taken from the
+                           package file rather than its .PKGINFO
+
+    Returns:
+        str: The contents of the 'desc' file
+    """
+
+    info = dict(info)
+    info.setdefault('pkgbase', info.get('pkgname'))
+    desc = []
+    for header, key in DESC_HEADERS:
+        values = calculated.get(header) if key is None else info.get(key)
+        if values:
+            desc.append(format_section(header, values))
+    return ''.join(desc)
+
+
+def _entry_directory(member):
+    """ Gets the directory of the entry a member of a database is within,
+    ignoring any leading './' """
+    name = member.name[2:] if member.name.startswith('./') else member.name
+    return name.split('/', 1)[0]
+
+
+def _entry_name(members):
+    """ Gets the name of the package an entry within a database describes,
+    from its 'desc' file. """
+    for member, data in members:
+        if member.name.endswith('/desc') and data is not None:
+            return parse_desc(data.decode('utf-8')).name
+    return None
+
+
+def _add_member(tar, member, data):
+    """ Writes a member to the archive as it was read """
+    tar.addfile(member, io.BytesIO(data) if data is not None else None)
+
+
+def _add_entry(tar, path, files, mtime):
+    """ Writes a new entry to the archive, a directory containing the files
+    specified. """
+    directory = tarfile.TarInfo(path)
+    directory.type = tarfile.DIRTYPE
+    directory.mode = 0o755
+    directory.mtime = mtime
+    tar.addfile(directory)
+
+    for name, content in files.items():
+        data = content.encode('utf-8')
+        member = tarfile.TarInfo(f"{path}/{name}")
+        member.size = len(data)
+        member.mode = 0o644
+        member.mtime = mtime
+        tar.addfile(member, io.BytesIO(data))
+
+
+def apply_changes(source, target, extension, add, remove):
+    """ Streams a repository database into a new one, adding and removing
+    packages along the way.
+
+    Each entry within the existing database is only parsed to find which
+    package it describes, and every entry which isn't changing is copied
+    across as it was read. Entries of packages being added replace any
+    existing entry of the same package.
+
+    Args:
+        source (file): The existing database, or None to start a new one
+        target (file): Writable binary stream the new database is written to
+        extension (str): The extension of the database within COMPRESSORS
+        add (list): The directory name and files of each entry to add
+        remove (list): Names of the packages to remove
+
+    Returns:
+        dict: The number of packages added, removed and kept
+    """
+
+    added = {path.rsplit('-', 2)[0] for path, _ in add}
+    dropped = added.union(remove)
+    counts = {'added': len(add), 'removed': 0, 'kept': 0}
+
+    compressed = COMPRESSORS[extension](target)
+    with tarfile.open(fileobj=compressed, mode='w|', format=tarfile.GNU_FORMAT) as out:
+
+        def flush(members):
+            if not members:
+                return
+            name = _entry_name(members)
+            if name in dropped:
+                print(f"Removing {members[0][0].name} from the database")
+                counts['removed'] += name not in added
+                return
+            counts['kept'] += 1
+            for member, data in members:
+                _add_member(out, member, data)
+
+        if source is not None:
+            members = []
+            with _extract_archive_from_stream(source) as tar:
+                for member in tar:
+                    directory = _entry_directory(member)
+                    if members and _entry_directory(members[0][0]) != directory:
+                        flush(members)
+                        members = []
+                    data = tar.extractfile(member).read() if member.isfile() else None
+                    members.append((member, data))
+            flush(members)
+
+        mtime = int(time.time())
+        for path, files in add:
+            print(f"Adding {path} to the database")
+            _add_entry(out, path, files, mtime)
+
+    if compressed is not target:
+        compressed.close()
+    return counts
+
+
+def update_database(s3, bucket, kind, required, add, remove):
+    """ Updates one of the databases of the repository within the bucket.
+
+    The database is only written if it hasn't changed since it was read, as
+    the update tasks may be running repo-add against it at the same time. If
+    it has changed, the changes are applied again to the new database.
+
+    The database is written under both its full name and the short name
+    pacman downloads, eg. 'repo.db.tar.zst' and 'repo.db', as repo-add does
+    with a symlink.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        bucket (str): The bucket containing the repository
+        kind (str): Either 'db' or 'files'
+        required (bool): Whether to create the database if it doesn't exist
+        add (list): The directory name and files of each entry to add
+        remove (list): Names of the packages to remove
+
+    Returns:
+        dict: The number of packages added, removed and kept, or None if the
+              database doesn't exist
+    """
+
+    key = f"{REPO_ARCH}/{REPO_NAME}.{kind}{DB_EXTENSION}"
+    for attempt in range(1, DB_WRITE_ATTEMPTS + 1):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key)
+            source, condition = response['Body'], {'IfMatch': response['ETag']}
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            if not required:
+                print(f"No {kind} database found in {bucket}, skipping")
+                return None
+            print(f"No {kind} database found in {bucket}, creating it")
+            source, condition = None, {'IfNoneMatch': '*'}
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as target:
+            counts = apply_changes(source, target, DB_EXTENSION, add, remove)
+            target.seek(0)
+            try:
+                s3.put_object(Bucket=bucket, Key=key, Body=target, **condition)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in WRITE_CONFLICT_CODES \
+                        or attempt == DB_WRITE_ATTEMPTS:
+                    raise
+                print(f"{key} in {bucket} changed while it was updated, retrying")
+                continue
+
+        print(f"Updated {key} in {bucket}: {counts}")
+        s3.copy_object(Bucket=bucket, Key=f"{REPO_ARCH}/{REPO_NAME}.{kind}",
+                       CopySource={'Bucket': bucket, 'Key': key})
+        return counts
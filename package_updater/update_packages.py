@@ -6,20 +6,29 @@ from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
 from arch_packages import get_packages
-from aws import get_dynamo_resource
+from aws import get_dynamo_resource, query_items, send_batch_to_queue
 from common import return_code
+from packages import parse_dependency, provides_partition
 
 PACKAGE_TABLE = os.environ.get('PACKAGE_TABLE')
+MIRROR_STATE_TABLE = os.environ.get('MIRROR_STATE_TABLE')
+OFFICIAL_REPOS = os.environ.get('OFFICIAL_REPOS', 'core,extra,multilib')
+OFFICIAL_MIRROR = os.environ.get('OFFICIAL_MIRROR')
+PACKAGE_UPDATE_QUEUE = os.environ.get('PACKAGE_UPDATE_QUEUE')
 DYNAMODB_MAX_RETRIES = 12
 
+# Version of the items written for each repository. Increment this whenever
+# a sync starts writing something new, so the next run re-syncs every
+# repository rather than skipping the unchanged DBs.
+MIRROR_STATE_VERSION = 2
+
 
 def lambda_handler(event, context):
     """ Function used to update packages within the packages table.
 
     The package table contains details on the packages within personal
     repository. This table is updated each run so as to keep track of when
-    new packages need to be built, or they already exist. The official repo's
-    do not need to be included as they can be queried from the API.
+    new packages need to be built, or they already exist.
 
     An example of the event passed to this function is as follows:
     {
@@ -28,6 +37,12 @@ def lambda_handler(event, context):
     }
     This is wrapped in an SQS message.
 
+    When triggered by the schedule instead, a message is sent back to this
+    function's queue for each of the official repositories within
+    OFFICIAL_REPOS, pointing at OFFICIAL_MIRROR. Each one is then downloaded
+    into its own partition by its own invocation, so they can be checked
+    without calling the archlinux.org API.
+
     Args:
         event (dict): Contains packages to be updated from SNS
         context (object): Lambda context runtime methods and attributes
@@ -37,6 +52,9 @@ def lambda_handler(event, context):
     """
 
     print(json.dumps(event))
+    if 'Records' not in event:
+        return return_code(200, queue_official_repositories())
+
     retval = {}
     for record in event['Records']:
         msg = json.loads(record['body'])
@@ -47,76 +65,261 @@ def lambda_handler(event, context):
     return return_code(200, retval)
 
 
-def update_repository(repo_name, url):
-    response_body = {}
+def queue_official_repositories():
+    """ Queues an update of the partition of each official repository from
+    the official mirror.
+
+    The first sync of a repository writes every package within it, which
+    can take most of an invocation for the larger repositories, so each one
+    is synced by an invocation of its own.
+
+    Returns:
+        dict: The names of the official repositories queued
+    """
+
+    repos = get_official_repos()
+    send_batch_to_queue(PACKAGE_UPDATE_QUEUE, [json.dumps({
+        'repository': repo_name,
+        'url': f"{OFFICIAL_MIRROR.rstrip('/')}/{repo_name}/os/x86_64/{repo_name}.db"
+    }) for repo_name in repos])
+    return {'queued': repos}
+
 
+def get_official_repos():
+    """ Gets the names of the official repositories to index """
+    return [x.strip() for x in OFFICIAL_REPOS.split(',') if x.strip()]
+
+
+def update_repository(repo_name, url):
     # The dynamoDB table containing the packages
     dynamo = get_dynamo_resource()
     table = dynamo.Table(PACKAGE_TABLE)
-
-    # Get any new packages that have been added to the repositories and upload them
-    print("Getting all current items in the table")
-    response_body['current'] = get_current_package_count(table, repo_name)
-
-    new_packages = add_new_packages(repo_name, url, table)
-    print(f"Adding new packages to {repo_name}")
-    new_pkg_count = len(new_packages['packages'])
-    new_diff = new_pkg_count - response_body['current']
-    new_diff = new_diff if new_diff > 0 else 0
-    print(f"Added {new_diff} items to {repo_name}")
-    response_body['new'] = new_diff
-
-    # Remove any packages no longer contained within the repositories
-    print(f"Removing packages from {repo_name}")
-    resp = table.query(KeyConditionExpression=Key('Repository').eq(repo_name))
-    all_packages = [x['PackageName'] for x in resp['Items']]
-    to_delete = delete_old_packages(repo_name, all_packages, new_packages['packages'], table)
-    print(f"Removed {len(to_delete)} items from {repo_name}")
-    response_body['deleted'] = len(to_delete)
+    state_table = dynamo.Table(MIRROR_STATE_TABLE)
+
+    # Only download and parse the DB file if it has changed since last time
+    cache = get_mirror_state(state_table, repo_name)
+    new_packages = get_packages({'repo': repo_name, 'mirror': url}, cache)
+    if not new_packages['modified']:
+        print(f"No changes to {repo_name}")
+        if new_packages['cache'] != cache:
+            put_mirror_state(state_table, repo_name, new_packages['cache'])
+        return {'modified': False, 'new': 0, 'changed': 0, 'deleted': 0}
+
+    # Compare the packages in the DB to those in the table and only write
+    # the differences
+    response_body = sync_packages(table, repo_name, new_packages['packages'])
+    response_body['provides'] = sync_provides(
+        table, repo_name, new_packages['packages'])
+
+    # Store the details of this download for the next conditional request
+    put_mirror_state(state_table, repo_name, new_packages['cache'])
+    response_body['modified'] = True
 
     # Return the number of changes being made
     print(json.dumps(response_body))
     return response_body
 
 
-def get_current_package_count(table, repo_name):
-    """ Get the current number of packages within a repository
+def get_mirror_state(table, repo_name):
+    """ Gets the cache details of the last download of the repository DB
+
+    Args:
+        table (dynamodb.Table): Table containing the state of each mirror
+        repo_name (str): Name of the repository the DB file belongs to
+
+    Returns:
+        dict: The 'etag', 'last_modified' and 'sha256' of the last download,
+              or an empty dict if it has not been downloaded before or was
+              synced by an older version
+    """
+
+    item = table.get_item(Key={'Repository': repo_name}).get('Item')
+    if item is None or item.get('SchemaVersion') != MIRROR_STATE_VERSION:
+        return {}
+
+    return {
+        'etag': item.get('ETag'),
+        'last_modified': item.get('LastModified'),
+        'sha256': item.get('Sha256')
+    }
+
+
+def put_mirror_state(table, repo_name, cache):
+    """ Stores the cache details of the latest download of the repository DB
+
+    Args:
+        table (dynamodb.Table): Table containing the state of each mirror
+        repo_name (str): Name of the repository the DB file belongs to
+        cache (dict): The 'etag', 'last_modified' and 'sha256' of the download
+    """
+
+    table.put_item(Item={
+        'Repository': repo_name,
+        'ETag': cache.get('etag'),
+        'LastModified': cache.get('last_modified'),
+        'Sha256': cache.get('sha256'),
+        'SchemaVersion': MIRROR_STATE_VERSION
+    })
+
+
+def sync_packages(table, repo_name, packages):
+    """ Updates the packages within a repository's partition to match those
+    within the repository DB.
+
+    The current partition is read once, and only packages which have been
+    added, changed or removed since then are written to the table.
 
     Args:
         table (dynamodb.Table): Table containing the packages
         repo_name (str): Name of the repository containing the packages
+        packages (list): Package records of all packages within the DB
 
     Returns:
-        int: Number of packages within the repository
+        dict: The number of packages currently in the table, and the number
+              of packages added, changed and deleted
     """
 
-    resp = table.query(KeyConditionExpression=Key('Repository').eq(repo_name))
-    num_packages = len(resp['Items'])
-    print(f"Currently {num_packages} in {repo_name}")
-    return num_packages
+    print("Getting all current items in the table")
+    current = get_current_packages(table, repo_name)
+    print(f"Currently {len(current)} in {repo_name}")
+
+    new_packages = {p.name: p for p in packages}
+    added = [p for name, p in new_packages.items() if name not in current]
+    changed = [p for name, p in new_packages.items()
+               if name in current and _is_changed(current[name], p)]
+    removed = [name for name in current if name not in new_packages]
+
+    print(f"Adding {len(added)} and updating {len(changed)} items in {repo_name}")
+    add_new_packages(repo_name, added + changed, table)
+
+    print(f"Removing {len(removed)} items from {repo_name}")
+    delete_old_packages(repo_name, removed, table)
+
+    return {
+        'current': len(current),
+        'new': len(added),
+        'changed': len(changed),
+        'deleted': len(removed)
+    }
+
 
+def _is_changed(item, package):
+    """ Checks whether a package differs from its item within the table """
+    return item.get('Version') != package.version \
+        or item.get('Sha256') != package.sha256sum
 
-def add_new_packages(repo_name, url, table):
-    """ Add new packages to the database
+
+def get_provides_index(packages):
+    """ Builds an index mapping each virtual package to the packages which
+    provide or replace it.
 
     Args:
-        repo_name (str): Name of the reponew packages are being added for
-        url (str): Mirror of the repository to download the package DB from
-        table (dynamodb.Table): The dynamodb table to update
+        packages (list): Package records of all packages within a repository
 
     Returns:
-        list: A collection of all packages within the mirror.
+        dict: A sorted list of providers for each virtual package name, with
+              each provider containing the package name and the version it
+              provides, or None if it is unversioned
     """
 
-    new_pkgs = get_packages({'repo': repo_name, 'mirror': url})
+    index = {}
+    for p in packages:
+        for provide in p.provides:
+            name, _, version = parse_dependency(provide)
+            index.setdefault(name, []).append({'Name': p.name, 'Version': version})
+
+        # Replaced packages don't have a version, so can only satisfy
+        # unversioned dependencies
+        for replace in p.replaces:
+            name, _, _ = parse_dependency(replace)
+            index.setdefault(name, []).append({'Name': p.name, 'Version': None})
+
+    for providers in index.values():
+        providers.sort(key=lambda x: (x['Name'], x['Version'] or ''))
+    return index
+
+
+def sync_provides(table, repo_name, packages):
+    """ Updates the provides index of a repository to match the %PROVIDES%
+    and %REPLACES% entries of the packages within its DB, only writing the
+    virtual packages which have changed.
+
+    Args:
+        table (dynamodb.Table): Table containing the packages
+        repo_name (str): Name of the repository containing the packages
+        packages (list): Package records of all packages within the DB
+
+    Returns:
+        int: The number of virtual packages within the index
+    """
+
+    partition = provides_partition(repo_name)
+    index = get_provides_index(packages)
+
+    items = query_items(
+        table,
+        projection=['PackageName', 'Providers'],
+        KeyConditionExpression=Key('Repository').eq(partition))
+    current = {x['PackageName']: x['Providers'] for x in items}
+
+    changed = [name for name, providers in index.items()
+               if current.get(name) != providers]
+    removed = [name for name in current if name not in index]
+    print(f"Updating {len(changed)} and removing {len(removed)} virtual packages in {partition}")
+
+    with table.batch_writer() as batch:
+        for name in changed:
+            batch.put_item(Item={
+                'Repository': partition,
+                'PackageName': name,
+                'Providers': index[name]
+            })
+        for name in removed:
+            batch.delete_item(Key={'Repository': partition, 'PackageName': name})
+
+    return len(index)
+
+
+def get_current_packages(table, repo_name):
+    """ Get the current packages within a repository, following every page
+    of the query results.
+
+    Args:
+        table (dynamodb.Table): Table containing the packages
+        repo_name (str): Name of the repository containing the packages
+
+    Returns:
+        dict: The table items of each package keyed by the package name
+    """
+
+    items = query_items(
+        table,
+        projection=['PackageName', 'Version', 'Sha256'],
+        KeyConditionExpression=Key('Repository').eq(repo_name))
+    return {item['PackageName']: item for item in items}
+
+
+def add_new_packages(repo_name, packages, table):
+    """ Add new or changed packages to the database
+
+    Args:
+        repo_name (str): Name of the repository the packages are being added to
+        packages (list): The Package records to write
+        table (dynamodb.Table): The dynamodb table to update
+    """
 
     primary_key = ['Repository', 'PackageName']
     with table.batch_writer(overwrite_by_pkeys=primary_key) as batch:
-        for p in new_pkgs['packages']:
+        for p in packages:
             retry_count = 0
             while retry_count <= DYNAMODB_MAX_RETRIES:
                 try:
-                    item = {'Repository': new_pkgs['repo'], 'PackageName': p}
+                    item = {
+                        'Repository': repo_name,
+                        'PackageName': p.name,
+                        'Version': p.version,
+                        'Sha256': p.sha256sum
+                    }
                     batch.put_item(Item=item)
                 except ClientError:
                     retry_count += 1
@@ -128,25 +331,17 @@ def add_new_packages(repo_name, url, table):
             else:
                 raise RuntimeError("Write operation failed - AWS errors")
 
-    return new_pkgs
-
 
-def delete_old_packages(repo_name, all_packages, new_packages, table):
+def delete_old_packages(repo_name, to_delete, table):
     """ Deletes packages that are no longer within the mirror from the database
 
     Args:
         repo_name (str): Name of the repository containing the packages
-        all_packages (list): Lst of all current packages within the database
-        new_packages (list): Lst of all the new packages within the repository
+        to_delete (list): Names of the packages no longer within the repository
         table (dynamo.Table): The dynamodb table to delete packages from
-
-    Returns:
-        list: The collection of packages removed from the database
     """
 
-    to_delete = set(all_packages).difference(new_packages)
     with table.batch_writer() as batch:
         for package in to_delete:
             key = {'Repository': repo_name, 'PackageName': package}
             batch.delete_item(Key=key)
-    return to_delete
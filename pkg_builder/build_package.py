@@ -1,25 +1,259 @@
 import json
+import math
 import os
 
-from aws import send_to_queue, start_ecs_task, get_running_task_count
+from aws import send_batch_to_queue, start_ecs_task, get_queue_depth
+from aws import get_dynamo_resource, get_task_counts, get_untagged_task_counts
+from build_history import TASK_SIZES
+from build_history import get_build_history, get_predicted_duration, get_task_size
 from common import return_code
+from enums import Lane
 
 BUILD_QUEUE = os.environ.get('BUILD_QUEUE')
+LONG_BUILD_QUEUE = os.environ.get('LONG_BUILD_QUEUE')
+SMALL_BUILD_QUEUE = os.environ.get('SMALL_BUILD_QUEUE')
+MEDIUM_BUILD_QUEUE = os.environ.get('MEDIUM_BUILD_QUEUE')
+BUILD_HISTORY = os.environ.get('BUILD_HISTORY')
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_DEFN = os.environ.get('TASK_DEFN')
 TASK_FAMILY = os.environ.get('TASK_FAMILY')
+BUILD_CONTAINER = os.environ.get('BUILD_CONTAINER', 'aur-pkg-build')
 MAX_TASK_COUNT = int(os.environ.get('MAX_TASK_COUNT'))
+MAX_LONG_TASK_COUNT = int(os.environ.get('MAX_LONG_TASK_COUNT') or 1)
+PACKAGES_PER_TASK = int(os.environ.get('PACKAGES_PER_TASK') or 1)
 
 
 def lambda_handler(event, context):
     print(json.dumps(event))
 
-    # Send the package to the build queue for any ECS instances to consume
-    for package_dict in event['Records']:
-        send_to_queue(BUILD_QUEUE, package_dict['body'])
+    # Each lane has its own queue and its own tasks, so long builds don't
+    # hold up the rest
+    lanes = {}
+    for record in event['Records']:
+        lane = get_lane(json.loads(record['body']).get('Lane'))
+        lanes.setdefault(lane, []).append(record['body'])
 
-    # Start a new task if it's less than the max required
-    if get_running_task_count(ECS_CLUSTER, TASK_FAMILY) < MAX_TASK_COUNT:
-        start_ecs_task(ECS_CLUSTER, TASK_DEFN)
+    for lane, messages in lanes.items():
+        start_lane(lane, messages)
 
     return return_code(200, {'status': 'Package building'})
+
+
+def get_lanes():
+    """ Gets the settings of each lane, including the queue the tasks of the
+    lane build packages from and the maximum number of tasks.
+
+    Packages are only built on tasks smaller than the task definition if
+    the lane has a queue for their size, as tasks take packages of any size
+    from the queue they're given.
+
+    Returns:
+        (dict): The settings of each lane keyed by its name
+    """
+
+    return {
+        Lane.Default.name: {
+            'queue': BUILD_QUEUE,
+            'size_queues': {'small': SMALL_BUILD_QUEUE,
+                            'medium': MEDIUM_BUILD_QUEUE},
+            'max_tasks': MAX_TASK_COUNT,
+            'packages_per_task': PACKAGES_PER_TASK
+        },
+        Lane.Long.name: {
+            'queue': LONG_BUILD_QUEUE,
+            'size_queues': {},
+            'max_tasks': MAX_LONG_TASK_COUNT,
+            'packages_per_task': 1
+        },
+    }
+
+
+def get_lane(name):
+    """ Gets the lane a package is built within, using the default lane if
+    the lane given isn't set up.
+
+    Args:
+        name (str): Name of the lane chosen by the fanout starter, if any
+
+    Returns:
+        (str): Name of the lane to build the package within
+    """
+
+    lanes = get_lanes()
+    if name in lanes and lanes[name]['queue']:
+        return name
+    return Lane.Default.name
+
+
+def start_lane(lane, messages):
+    """ Sends packages to the build queues of a lane and starts enough tasks
+    to build everything waiting in each queue, without the lane going over
+    its maximum number of tasks.
+
+    Each size of task has its own queue, so a package is only ever built on
+    a task of the size it was given. Packages without a queue for their size
+    are built on the lane's queue at the size of the task definition.
+
+    Args:
+        lane (str): Name of the lane the packages are built within
+        messages (list): The build messages of each package
+    """
+
+    settings = get_lanes()[lane]
+    history = get_history(messages)
+    sizes = get_size_classes(settings, messages, history)
+
+    # Tasks are tagged with their lane and size so each queue is scaled on
+    # its own, while the lane's maximum covers all of them
+    started_by = f"pkg-builder-{lane.lower()}"
+    tags = {x: f"{started_by}-{x}"
+            for x, queue in settings['size_queues'].items() if queue}
+    tags[None] = started_by
+    task_counts = {size: get_task_counts(ECS_CLUSTER, started_by=tag)
+                   for size, tag in tags.items()}
+
+    # Tasks started before they were tagged build from the default lane's
+    # queue, so they count towards its maximum until they finish
+    if lane == Lane.Default.name:
+        task_counts['untagged'] = get_untagged_task_counts(
+            ECS_CLUSTER, TASK_FAMILY, 'pkg-builder-')
+
+    for size, (queue, size_messages) in sizes.items():
+        size_messages = order_by_duration(size_messages, history)
+        send_batch_to_queue(queue, size_messages)
+
+        backlog = max(get_queue_depth(queue), len(size_messages))
+        other_active = sum(sum(counts.values())
+                           for other, counts in task_counts.items()
+                           if other != size)
+        task_count = get_tasks_to_start(backlog, task_counts[size], settings,
+                                        other_active)
+        if task_count > 0:
+            overrides = get_task_overrides(size)
+            overrides['containerOverrides'] = [{
+                'name': BUILD_CONTAINER,
+                'environment': [{'name': 'SQS_QUEUE_URL', 'value': queue}]
+            }]
+            start_ecs_task(ECS_CLUSTER, TASK_DEFN, overrides, count=task_count,
+                           started_by=tags[size])
+            task_counts[size] = dict(
+                task_counts[size],
+                PROVISIONING=task_counts[size].get('PROVISIONING', 0) + task_count)
+
+
+def get_size_classes(settings, messages, history):
+    """ Splits the packages of a lane by the size of task they're built on,
+    along with the queue the tasks of that size build packages from.
+
+    Args:
+        settings (dict): The settings of the lane
+        messages (list): The build messages of each package
+        history (dict): The build history of each package built before
+
+    Returns:
+        (dict): The queue and build messages of each task size, keyed by the
+                name of the size, or None for the size of the task definition
+    """
+
+    sizes = {}
+    for message in messages:
+        size = TASK_SIZES[get_task_size(
+            history.get(json.loads(message)['PackageName']))]['name']
+        queue = settings['size_queues'].get(size)
+        if not queue:
+            size, queue = None, settings['queue']
+        sizes.setdefault(size, (queue, []))[1].append(message)
+    return sizes
+
+
+def get_history(messages):
+    """ Retrieves the build history of the packages within the messages
+
+    Args:
+        messages (list): The build messages of each package
+
+    Returns:
+        (dict): The build history of each package built before
+    """
+
+    if not BUILD_HISTORY:
+        return {}
+
+    dynamo = get_dynamo_resource()
+    history_table = dynamo.Table(BUILD_HISTORY)
+    return get_build_history(
+        history_table, [json.loads(x)['PackageName'] for x in messages])
+
+
+def order_by_duration(messages, history):
+    """ Orders the build messages by their predicted duration, longest first,
+    so they're sent to the queue in that order. Packages which haven't been
+    built before are treated as the longest.
+
+    The build queues are standard queues, which don't keep the order
+    messages were sent in, so the longest builds are only likely to be
+    started first rather than guaranteed to be.
+
+    Args:
+        messages (list): The build messages of each package
+        history (dict): The build history of each package built before
+
+    Returns:
+        (list): The build messages, longest first
+    """
+
+    def duration(message):
+        predicted = get_predicted_duration(
+            history.get(json.loads(message)['PackageName']))
+        return math.inf if predicted is None else predicted
+
+    return sorted(messages, key=duration, reverse=True)
+
+
+def get_task_overrides(size):
+    """ Gets the CPU and memory of the tasks started for a size of task.
+
+    Args:
+        size (str): Name of the size within TASK_SIZES, or None for the size
+                    of the task definition
+
+    Returns:
+        (dict): The ECS overrides setting the size of the task, which are
+                empty if the size of the task definition is needed
+    """
+
+    task_size = next((x for x in TASK_SIZES if x['name'] == size), None)
+    if task_size is None:
+        return {}
+
+    print(f"Starting {task_size['name']} tasks")
+    return {'cpu': task_size['cpu'], 'memory': task_size['memory']}
+
+
+def get_tasks_to_start(backlog, task_counts, settings, other_active=0):
+    """ Works out how many tasks are needed to build the packages waiting in
+    a build queue of a lane, without going over the maximum number of tasks
+    of the lane.
+
+    Tasks which are still pending haven't started taking packages from the
+    queue yet, so they're counted towards the packages waiting. Tasks which
+    are running are already building packages no longer in the queue.
+
+    Args:
+        backlog (int):      The number of packages waiting in the build queue
+        task_counts (dict): The number of tasks with each status
+        settings (dict):    The settings of the lane
+        other_active (int): The number of tasks active for the other queues
+                            of the lane
+
+    Returns:
+        (int): The number of tasks to start
+    """
+
+    active = sum(task_counts.values())
+    pending = active - task_counts.get('RUNNING', 0)
+    needed = math.ceil(backlog / settings['packages_per_task']) - pending
+    to_start = max(0, min(needed, settings['max_tasks'] - active - other_active))
+    print(f"{backlog} packages waiting, {active} tasks active ({pending} "
+          f"pending), starting {to_start} tasks")
+    return to_start
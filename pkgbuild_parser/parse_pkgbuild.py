@@ -1,88 +1,82 @@
 import json
 import os
-import re
-import string
 
-from aws import send_to_queue
+from aws import send_batch_to_queue
 from common import return_code
+from pkgbuild import get_dependencies
 
 NEXT_QUEUE = os.environ.get('NEXT_QUEUE')
-ALLOWED_CHARS = set(string.ascii_lowercase + string.digits + '@._+-')
+REPO_ARCH = os.environ.get('REPO_ARCH', 'x86_64')
+
+# Kinds of dependencies which need to be available to build the metapackage
+BUILD_DEPENDENCIES = ('depends', 'makedepends', 'checkdepends')
 
 
 def lambda_handler(event, context):
     print(json.dumps(event))
-    for record in event['Records']:
-        run(record['body'])
+    messages = [run(record['body']) for record in event['Records']]
+
+    # Send to next function
+    print(f"NEXT_QUEUE: {NEXT_QUEUE}")
+    send_batch_to_queue(NEXT_QUEUE, messages)
     return return_code(200, {'status': "PKGBUILD added to queue"})
 
 
 def _get_dependencies(pkgbuild):
-    """ Extracts items from within 'depends()' sections in the PKGBUILD
+    """ Extracts the packages needed to build and install the metapackages
+    within the PKGBUILD
 
-    The PKGBUILD is looped through line by line, noting when we are within a 
-    depends() statement and extracting every word prior to a comment (#) until 
-    the closing bracket. Multiple packages on a single line are handled by 
-    being split by whitespace.
+    Every depends, makedepends and checkdepends array is included, along
+    with those specific to the architecture being built for. Optional
+    dependencies aren't built.
 
     Args:
         pkgbuild (str): The PKGBUILD file
 
     Returns:
-        list: The collection of dependencies for each metapackage
+        list: The collection of dependencies for each metapackage, including
+              any version constraints
     """
 
     print(f"Getting all dependencies within PKGBUILD file")
     dependencies = []
+    for dep in get_dependencies(pkgbuild):
+        if dep.kind in BUILD_DEPENDENCIES and dep.arch in (None, REPO_ARCH):
+            dependencies.append(dep.name + (dep.constraint or ''))
 
-    within_depends = False
-    for line in pkgbuild.split('\n'):
-
-        # Remove any unnecessary whitespace
-        line = line.strip()
-
-        # Search until we find depends
-        if not within_depends and line.startswith('depends'):
-            within_depends = True
-            continue
-
-        # Extract the packages
-        if within_depends and line != ')':
-            # Remove comments
-            pkgs = [pkg for pkg in re.sub('#.*', '', line).strip().split(' ')
-                    if len(pkg) > 0]
-
-            # Ensure there are no issues with the packages by checking if there
-            # are any disallowed characters within the package name.
-            assert(all([set(x) <= ALLOWED_CHARS for x in pkgs]))
-            dependencies.extend(pkgs)
-
-        # Continue until the closing bracket
-        if within_depends and line == ')':
-            within_depends = False
-
+    # Remove duplicates while keeping the order they were found in
+    dependencies = list(dict.fromkeys(dependencies))
     print(f"Pulled {len(dependencies)} dependencies")
     return dependencies
 
 
 def run(pkgbuild_file):
-    """ Extracts metapackages and their dependencies from a PKGBUILD
+    """ Extracts metapackages and their dependencies from the PKGBUILDs
+    changed by a push
+
+    The dependencies of every PKGBUILD are merged so the whole push is built
+    within a single fanout.
 
     Args:
-        pkgbuild_file (json): The PKGBUILD file for the metapackages
+        pkgbuild_file (json): The PKGBUILD files for the metapackages, keyed
+                              by their path, or a single PKGBUILD payload
 
     Returns:
-        list: A list of packages required by the metapackages
+        str: The message for the next function, containing a list of packages
+             required by the metapackages
     """
 
     # Convert the event to JSON
     pkgbuild_json = json.loads(pkgbuild_file)
+    pkgbuilds = pkgbuild_json.pop('pkgbuilds', None) \
+        or {'PKGBUILD': pkgbuild_json.pop('payload')}
 
-    deps = _get_dependencies(pkgbuild_json['payload'])
-    pkgbuild_json['dependencies'] = deps
-    pkgbuild_json.pop('payload', None)
+    deps = []
+    for location, pkgbuild in pkgbuilds.items():
+        print(f"Parsing {location}")
+        deps.extend(_get_dependencies(pkgbuild))
 
-    # Send to next function
-    print(f"NEXT_QUEUE: {NEXT_QUEUE}")
-    send_to_queue(NEXT_QUEUE, json.dumps(pkgbuild_json))
+    pkgbuild_json['dependencies'] = list(dict.fromkeys(deps))
+    pkgbuild_json.pop('payload', None)
 
+    return json.dumps(pkgbuild_json)
@@ -0,0 +1,321 @@
+import re
+import string
+
+from collections import namedtuple
+
+# Characters allowed within package names and version constraints
+ALLOWED_CHARS = set(string.ascii_lowercase + string.digits + '@._+-:<>=')
+
+# Arrays containing dependencies, optionally specific to an architecture,
+# eg. depends, makedepends_x86_64, optdepends+
+DEPENDENCY_ARRAY_RE = re.compile(
+    r'^(depends|makedepends|checkdepends|optdepends)(?:_(\w+))?\+?=$')
+PACKAGE_FUNCTION_RE = re.compile(r'^package(?:_(.+))?$')
+DEPENDENCY_RE = re.compile(r'^([^<>=]+)((?:<=|>=|<|>|=).+)?$')
+
+# Variables which dependencies commonly refer to, and which are expanded if
+# they're set before the dependency array, eg. "${pkgbase}-common=${pkgver}"
+SCALAR_VARIABLES = ('pkgname', 'pkgbase', 'pkgver', 'pkgrel', 'epoch')
+SCALAR_ASSIGNMENT_RE = re.compile(
+    r'^(' + '|'.join(SCALAR_VARIABLES) + r')=(.*)$', re.DOTALL)
+VARIABLE_RE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+# Characters which end an unquoted word in bash
+METACHARACTERS = set(' \t\n;&|()<>')
+
+# Token types
+WORD = 'word'
+ARRAY = 'array'
+OPEN = '('
+CLOSE = ')'
+NEWLINE = '\n'
+
+Dependency = namedtuple('Dependency', ['name', 'constraint', 'kind', 'arch',
+                                       'package', 'description'])
+
+
+class PkgbuildParseError(ValueError):
+    """ Raised when the PKGBUILD can't be parsed """
+
+
+def tokenize(pkgbuild):
+    """ Splits a PKGBUILD into the tokens needed to find its arrays in a
+    single pass, handling quoting, escaping, line continuations, comments
+    and heredocs in the same way as bash.
+
+    Assignments of arrays, such as 'depends=(', are returned as a single
+    ARRAY token containing the name of the array. The bodies of heredocs
+    are skipped, as they're only ever file contents.
+
+    Args:
+        pkgbuild (str): The PKGBUILD file
+
+    Yields:
+        (tuple): The type of each token, its value and the line it is on
+
+    Raises:
+        PkgbuildParseError: If a quote isn't closed
+    """
+
+    i = 0
+    line = 1
+    length = len(pkgbuild)
+    heredocs = []
+    while i < length:
+        c = pkgbuild[i]
+
+        if c == '\n':
+            yield NEWLINE, c, line
+            line += 1
+            i += 1
+            for delimiter, strip_tabs in heredocs:
+                i, line = _skip_heredoc(pkgbuild, i, line, delimiter, strip_tabs)
+            heredocs = []
+        elif c in ' \t':
+            i += 1
+        elif c == '\\' and pkgbuild.startswith('\n', i + 1):
+            line += 1
+            i += 2
+        elif c == '#':
+            end = pkgbuild.find('\n', i)
+            i = length if end < 0 else end
+        elif c in '()':
+            yield c, c, line
+            i += 1
+        elif pkgbuild.startswith('<<', i) and not pkgbuild.startswith('<<<', i):
+            yield WORD, '<<', line
+            i += 2
+            strip_tabs = pkgbuild.startswith('-', i)
+            if strip_tabs:
+                i += 1
+            while i < length and pkgbuild[i] in ' \t':
+                i += 1
+            delimiter, i, line = _read_word(pkgbuild, i, line)
+            heredocs.append((delimiter, strip_tabs))
+        elif c in METACHARACTERS:
+            yield WORD, c, line
+            i += 1
+        else:
+            start_line = line
+            word, i, line = _read_word(pkgbuild, i, line)
+            if word.endswith('=') and pkgbuild.startswith('(', i):
+                yield ARRAY, word, start_line
+                i += 1
+            else:
+                yield WORD, word, start_line
+
+
+def _read_word(pkgbuild, i, line):
+    """ Reads an unquoted word, removing any quotes and escapes within it.
+
+    Args:
+        pkgbuild (str): The PKGBUILD file
+        i (int): The position the word starts at
+        line (int): The line the word starts on
+
+    Returns:
+        (tuple): The word, and the position and line following it
+    """
+
+    length = len(pkgbuild)
+    word = []
+    while i < length and pkgbuild[i] not in METACHARACTERS:
+        c = pkgbuild[i]
+        if c == '\\':
+            if pkgbuild.startswith('\n', i + 1):
+                line += 1
+            else:
+                word.append(pkgbuild[i + 1:i + 2])
+            i += 2
+        elif c in '\'"':
+            end = _find_closing_quote(pkgbuild, c, i + 1)
+            if end < 0:
+                raise PkgbuildParseError(f"Unterminated {c} on line {line}")
+            quoted = pkgbuild[i + 1:end]
+            if c == '"':
+                quoted = re.sub(r'\\(["\\$`])', r'\1', quoted)
+            word.append(quoted)
+            line += quoted.count('\n')
+            i = end + 1
+        else:
+            word.append(c)
+            i += 1
+
+    return ''.join(word), i, line
+
+
+def _find_closing_quote(pkgbuild, quote, start):
+    """ Finds the quote closing a quoted string. Within double quotes, a
+    quote is escaped if it follows an odd number of backslashes.
+
+    Args:
+        pkgbuild (str): The PKGBUILD file
+        quote (str): The quote the string was opened with
+        start (int): The position following the opening quote
+
+    Returns:
+        (int): The position of the closing quote, or -1 if there isn't one
+    """
+
+    if quote == "'":
+        return pkgbuild.find(quote, start)
+
+    i = start
+    length = len(pkgbuild)
+    while i < length:
+        if pkgbuild[i] == '\\':
+            i += 2
+        elif pkgbuild[i] == quote:
+            return i
+        else:
+            i += 1
+    return -1
+
+
+def _skip_heredoc(pkgbuild, i, line, delimiter, strip_tabs):
+    """ Skips the body of a heredoc, up to and including its delimiter.
+
+    Args:
+        pkgbuild (str): The PKGBUILD file
+        i (int): The position of the start of the body
+        line (int): The line the body starts on
+        delimiter (str): The word ending the heredoc
+        strip_tabs (bool): Whether leading tabs are removed, as with <<-
+
+    Returns:
+        (tuple): The position and line following the heredoc
+    """
+
+    length = len(pkgbuild)
+    while i < length:
+        end = pkgbuild.find('\n', i)
+        end = length if end < 0 else end
+        body_line = pkgbuild[i:end]
+        i = end + 1
+        line += 1
+        if (body_line.lstrip('\t') if strip_tabs else body_line) == delimiter:
+            break
+    return min(i, length), line
+
+
+def _expand_variables(value, variables):
+    """ Expands the variables within a word which have been set, leaving any
+    others as they are.
+    """
+
+    def expand(match):
+        name = match.group(1) or match.group(2)
+        return variables.get(name, match.group(0))
+
+    return VARIABLE_RE.sub(expand, value)
+
+
+def _parse_dependency(value, kind, arch, package, line, variables):
+    """ Splits an entry within a dependency array into a Dependency record,
+    separating the description of optional dependencies.
+
+    Any of the SCALAR_VARIABLES set before the array are expanded. Entries
+    which still contain a variable can't be resolved without running bash,
+    so they're skipped with a warning, and None is returned.
+    """
+
+    value = _expand_variables(value, variables)
+    if '$' in value:
+        print(f"Warning: skipping unresolved dependency '{value}' on line {line}")
+        return None
+
+    description = None
+    if kind == 'optdepends' and ':' in value:
+        value, description = value.split(':', 1)
+        value, description = value.strip(), description.strip()
+
+    match = DEPENDENCY_RE.match(value)
+    if match is None or not set(value) <= ALLOWED_CHARS:
+        raise PkgbuildParseError(f"Invalid dependency '{value}' on line {line}")
+
+    name, constraint = match.groups()
+    return Dependency(name, constraint, kind, arch, package, description)
+
+
+def get_dependencies(pkgbuild):
+    """ Extracts every entry within the dependency arrays of a PKGBUILD.
+
+    This covers depends, makedepends, checkdepends and optdepends, including
+    those appended to with +=, specific to an architecture, or set within
+    the package function of a split package, along with any version
+    constraints. The PKGBUILD is only read once, so large PKGBUILDs are
+    parsed in linear time.
+
+    Args:
+        pkgbuild (str): The PKGBUILD file
+
+    Returns:
+        list: Dependency records for each dependency in the order found
+
+    Raises:
+        PkgbuildParseError: If a dependency array isn't valid
+    """
+
+    dependencies = []
+    variables = {}
+    package = None
+    depth = 0
+    previous = []
+    tokens = tokenize(pkgbuild)
+
+    for token, value, line in tokens:
+
+        # Note which package function we're in, for split packages
+        if token == WORD and value == '{':
+            match = PACKAGE_FUNCTION_RE.match(previous[0][1]) \
+                if len(previous) == 3 and previous[0][0] == WORD \
+                and [x[0] for x in previous[1:]] == [OPEN, CLOSE] else None
+            if match and depth == 0:
+                package = match.group(1) or ''
+            depth += 1
+        elif token == WORD and value == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                package = None
+
+        if token != NEWLINE:
+            previous = (previous + [(token, value)])[-3:]
+
+        # Keep the variables set outside of functions for expanding entries
+        assignment = SCALAR_ASSIGNMENT_RE.match(value) \
+            if token == WORD and depth == 0 else None
+        if assignment:
+            name, assigned = assignment.groups()
+            variables[name] = _expand_variables(assigned, variables)
+
+        if token != ARRAY:
+            continue
+
+        match = DEPENDENCY_ARRAY_RE.match(value)
+        entries = []
+        for token, entry, entry_line in tokens:
+            if token == CLOSE:
+                break
+            if token in (OPEN, ARRAY):
+                raise PkgbuildParseError(
+                    f"Unexpected '{entry}' within {value}( on line {entry_line}")
+            if token == WORD:
+                entries.append((entry, entry_line))
+        else:
+            raise PkgbuildParseError(f"Unclosed {value}( on line {line}")
+
+        # Split packages are named by the first package within pkgname
+        if value == 'pkgname=' and depth == 0 and entries:
+            variables['pkgname'] = _expand_variables(entries[0][0], variables)
+
+        if match is None:
+            continue
+
+        kind, arch = match.groups()
+        for entry, entry_line in entries:
+            dependency = _parse_dependency(entry, kind, arch, package or None,
+                                           entry_line, variables)
+            if dependency is not None:
+                dependencies.append(dependency)
+
+    return dependencies
@@ -5,9 +5,27 @@ import os
 
 TOKEN = os.environ.get("GITHUB_WEBHOOK_SECRET")
 
+# Largest webhook body accepted, in bytes. Anything bigger is rejected before
+# it is hashed, as Github push payloads are far smaller than this.
+MAX_BODY_SIZE = int(os.environ.get("MAX_WEBHOOK_SIZE") or 5 * 1024 * 1024)
+
+# Signature headers in order of preference, along with their hash algorithm
+SIGNATURE_HEADERS = (
+    ("X-Hub-Signature-256", "sha256", hashlib.sha256),
+    ("X-Hub-Signature", "sha1", hashlib.sha1),
+)
+
+# The encoded secret, kept between warm invocations
+_KEY = TOKEN.encode('utf-8') if TOKEN is not None else None
+
+
 def validate(event):
     """Validates the payload sent to ensure it comes from a valid Github repository
 
+    The cheap checks on the headers and the size of the body are made first,
+    so invalid requests are turned away without hashing the body. The
+    SHA-256 signature is used if Github sent one, falling back to SHA-1.
+
     Args:
         event (dict): The full payload sent by a Github webhook
 
@@ -15,23 +33,40 @@ def validate(event):
         dict: An HTTP response outlining whether validation passed or threw an error
     """
 
-    headers = event['headers']
-    sig = headers['X-Hub-Signature'].split('=')[1]
-    github_event = headers['X-GitHub-Event']
-    github_id = headers['X-GitHub-Delivery']
-    digest = _get_digest(TOKEN, event['body'])
-
-    if TOKEN is None:
+    if _KEY is None:
         return _get_error(401, "Must provide a 'GITHUB_WEBHOOK_SECRET' env variable")
 
-    if github_event is None:
+    headers = event.get('headers') or {}
+    if not _get_header(headers, 'X-GitHub-Event'):
         return _get_error(422, "No X-GitHub-Event found in request")
 
-    if github_id is None:
+    if not _get_header(headers, 'X-GitHub-Delivery'):
         return _get_error(401, "No X-GitHub-Delivery found in request")
 
-    if sig != digest:
-        return _get_error(401, "X-Hub-Signature is incorrect. Github webhook token doesn't match")
+    for header, prefix, algorithm in SIGNATURE_HEADERS:
+        signature = _get_header(headers, header)
+        if signature:
+            break
+    else:
+        return _get_error(401, "No X-Hub-Signature found in request")
+
+    sig_prefix, _, sig = signature.partition('=')
+    if sig_prefix != prefix or not sig:
+        return _get_error(401, f"{header} is malformed")
+
+    # Each character is at least one byte, so the body can be rejected
+    # before it's encoded
+    body = event.get('body') or ''
+    if len(body) > MAX_BODY_SIZE:
+        return _get_error(413, f"Request body is larger than {MAX_BODY_SIZE} bytes")
+
+    data = body.encode('utf-8')
+    if len(data) > MAX_BODY_SIZE:
+        return _get_error(413, f"Request body is larger than {MAX_BODY_SIZE} bytes")
+
+    digest = hmac.new(_KEY, data, algorithm).hexdigest()
+    if not hmac.compare_digest(digest.encode('ascii'), sig.encode('utf-8')):
+        return _get_error(401, f"{header} is incorrect. Github webhook token doesn't match")
 
     return {
         "statusCode": 200,
@@ -39,17 +74,20 @@ def validate(event):
     }
 
 
-def _get_digest(token, data):
-    """Calculate the digest from the data and Github token
+def _get_header(headers, name):
+    """Gets a header from the request, ignoring the case of its name
 
     Args:
-        token (str): The secret Github token.
-        data (str): The github payload
+        headers (dict): The headers of the request
+        name (str): The name of the header to get
 
     Returns:
-        str: The calculated digest of the data using the token
+        str: The value of the header, or None if it wasn't sent
     """
-    return hmac.new(token.encode('utf-8'), data.encode('utf-8'), hashlib.sha1).hexdigest()
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.lower())
+    return value
 
 
 def _get_error(code, msg):
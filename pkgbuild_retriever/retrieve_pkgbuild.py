@@ -1,14 +1,29 @@
+import hashlib
 import json
 import os
 import sys
-from urllib.parse import unquote
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import urllib3
 
 import github_token_validator
-from aws import send_to_queue
+from aws import get_dynamo_resource, send_to_queue
 from common import return_code
 
 NEXT_QUEUE = os.environ.get("NEXT_QUEUE")
+PKGBUILD_CACHE = os.environ.get("PKGBUILD_CACHE")
+
+# Maximum number of PKGBUILDs downloaded at the same time
+MAX_DOWNLOADS = 10
+
+# Connection pool shared by every download, and between warm invocations, so
+# connections to GitHub are reused rather than set up for each PKGBUILD
+HTTP = urllib3.PoolManager(
+    maxsize=MAX_DOWNLOADS,
+    retries=urllib3.Retry(total=3, backoff_factor=0.5),
+    timeout=urllib3.Timeout(connect=5, read=10))
+
 
 def lambda_handler(event, context):
 
@@ -26,8 +41,8 @@ def lambda_handler(event, context):
     branch = commit_payload['ref'].replace('refs/heads/', '')
     stage = 'prod' if branch == 'master' else 'dev'
 
-    pkgbuild_location = get_pkgbuild_location(commit_payload)
-    if pkgbuild_location is None:
+    pkgbuild_locations = get_pkgbuild_locations(commit_payload)
+    if not pkgbuild_locations:
         print("No PKGBUILD commit found, exiting")
         retval = {
             'headers': { 'Content-Type': 'text/plain' }, 
@@ -35,16 +50,23 @@ def lambda_handler(event, context):
         }
         return return_code(401, retval)
 
-    # Pull latest PKGBUILD
-    print(f"Found PKGBUILD at {pkgbuild_location}")
-    pkgbuild_url = f"https://raw.githubusercontent.com/{full_name}/{branch}/{pkgbuild_location}"
-
-    with urlopen(pkgbuild_url) as resp:
-        pkgbuild = resp.read().decode()
+    # Pull the PKGBUILDs as of the pushed commit, as the branch may be served
+    # stale from GitHub's cache
+    print(f"Found PKGBUILDs at {pkgbuild_locations}")
+    commit = commit_payload.get('after') or branch
+    pkgbuilds = get_pkgbuilds(full_name, commit, pkgbuild_locations)
 
+    # Skip the build if the same PKGBUILDs have already been built
     github_repository = f"https://github.com/{full_name}.git"
+    pkgbuild_hash = get_pkgbuild_hash(pkgbuilds)
+    if is_cached(github_repository, branch, pkgbuild_hash):
+        print(f"PKGBUILDs unchanged since the last build of {branch}, exiting")
+        return return_code(200, {'status': 'PKGBUILD unchanged'})
+
+    # Every PKGBUILD is sent together so the push is built in a single fanout
     payload = json.dumps({
-        "payload": pkgbuild,
+        "pkgbuilds": pkgbuilds,
+        "pkgbuild_hash": pkgbuild_hash,
         "git_url": github_repository,
         "git_branch": branch,
         "stage": stage
@@ -55,15 +77,106 @@ def lambda_handler(event, context):
     return return_code(200, {'status': 'PKGBUILD extracted'})
 
 
-def get_pkgbuild_location(payload):
-    if 'commits' not in payload or len(payload['commits']) == 0:
-        return None
+def get_pkgbuild_locations(payload):
+    """ Finds every PKGBUILD added or modified by the commits within a push.
+
+    The commits are checked in order, so a PKGBUILD removed by a later commit
+    within the same push is left out.
+
+    Args:
+        payload (dict): The push event sent by GitHub
+
+    Returns:
+        (list): The path of each PKGBUILD within the repository, without
+                duplicates
+    """
+
+    locations = {}
+    for commit in payload.get('commits') or []:
+        for path in commit.get('added', []) + commit.get('modified', []):
+            if path.split('/')[-1] == 'PKGBUILD':
+                locations[path] = True
+        for path in commit.get('removed', []):
+            locations.pop(path, None)
+
+    return list(locations)
+
+
+def get_pkgbuilds(full_name, ref, locations):
+    """ Downloads each PKGBUILD from GitHub concurrently.
+
+    Args:
+        full_name (str):  The name of the repository, eg. user/repo
+        ref (str):        The commit SHA or branch to download the PKGBUILDs
+                          from
+        locations (list): The path of each PKGBUILD within the repository
+
+    Returns:
+        (dict): The contents of each PKGBUILD keyed by its path
+    """
+
+    urls = [f"https://raw.githubusercontent.com/{full_name}/{quote(ref)}/{quote(x)}"
+            for x in locations]
+
+    workers = max(1, min(MAX_DOWNLOADS, len(urls)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        contents = list(executor.map(_download, urls))
+
+    return dict(zip(locations, contents))
+
+
+def _download(url):
+    """ Downloads a file using the shared connection pool """
+
+    print(f"Downloading {url}")
+    resp = HTTP.request('GET', url)
+    if resp.status != 200:
+        raise RuntimeError(f"Unable to download {url}: HTTP {resp.status}")
+    return resp.data.decode()
+
+
+def get_pkgbuild_hash(pkgbuilds):
+    """ Hashes the contents of the PKGBUILDs along with their paths, to
+    identify pushes which don't change anything that would be built.
+
+    Args:
+        pkgbuilds (dict): The contents of each PKGBUILD keyed by its path
+
+    Returns:
+        (str): The SHA-256 hex digest of the PKGBUILDs
+    """
+
+    digest = hashlib.sha256()
+    for path in sorted(pkgbuilds):
+        digest.update(path.encode() + b'\0')
+        digest.update(pkgbuilds[path].encode() + b'\0')
+    return digest.hexdigest()
+
+
+def is_cached(git_url, branch, pkgbuild_hash):
+    """ Checks whether the PKGBUILDs are the same as those within the last
+    fanout of the branch to finish, and that fanout built every package.
+
+    Args:
+        git_url (str):       URL of the repository containing the PKGBUILDs
+        branch (str):        The branch the PKGBUILDs were pushed to
+        pkgbuild_hash (str): Hash of the PKGBUILDs pushed
+
+    Returns:
+        (bool): Whether the PKGBUILDs have already been built
+    """
 
-    pkgbuild = [x for xs in [y['modified'] for y in payload['commits']] for x in xs if x.endswith('PKGBUILD')]
-    if len(pkgbuild) == 0:
-        return None
+    if not PKGBUILD_CACHE:
+        return False
 
-    return pkgbuild[0]
+    dynamo = get_dynamo_resource()
+    cache_table = dynamo.Table(PKGBUILD_CACHE)
+    item = cache_table.get_item(
+        Key={'GitUrl': git_url, 'GitBranch': branch},
+        ProjectionExpression='PkgbuildHash, Succeeded'
+    ).get('Item')
+    return item is not None and item.get('PkgbuildHash') == pkgbuild_hash \
+        and item.get('Succeeded') is True
 
 
 def get_full_name(payload):
@@ -1,30 +1,185 @@
 import json
 import os
 
+from boto3.dynamodb.conditions import Key
+
+from artifact_cache import cache_artifact, get_cached_artifacts
+from artifact_cache import get_source_hash, get_source_key, is_repo_signed
+from artifact_cache import promote_artifacts
+from aur import get_aur_info, get_outdated_packages, is_vcs_package
+from aws import get_client, get_dynamo_resource, query_items, send_to_queue
 from aws import start_ecs_task
 from common import return_code
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_DEFN = os.environ.get('TASK_DEFN')
 REPO_ARCH = os.environ.get('REPO_ARCH')
+REPO_NAME = os.environ.get('REPO_NAME')
 PERSONAL_REPO_BUCKET = os.environ.get('PERSONAL_REPO_BUCKET')
 DEV_REPO_BUCKET = os.environ.get('DEV_REPO_BUCKET')
+PACKAGE_TABLE = os.environ.get('PACKAGE_TABLE')
+ARTIFACT_CACHE = os.environ.get('ARTIFACT_CACHE')
+REPO_DB_QUEUE = os.environ.get('REPO_DB_QUEUE')
 
 
 def lambda_handler(event, context):
+    """ Updates the packages within each repository which have a newer
+    version in the AUR.
+
+    The versions of the packages already built are compared against the AUR,
+    and an update task is only started for a repository if any of its
+    packages are outdated, updating only those packages. VCS packages, such
+    as those ending in -git, keep the same AUR version while their upstream
+    changes, so they're always updated.
+
+    If every outdated package has already been built from its latest sources
+    into the other repository, they're copied across and added to the
+    repository database by the repo DB writer instead, without starting an
+    update task.
+
+    Args:
+        event (dict): The scheduled event
+        context (object): Lambda context runtime methods and attributes
+
+    Returns:
+        dict: HTTP response containing the packages being updated
+    """
+
     print(json.dumps(event))
-    start_ecs_task(ECS_CLUSTER, TASK_DEFN, get_env_overrides(PERSONAL_REPO_BUCKET))
-    start_ecs_task(ECS_CLUSTER, TASK_DEFN, get_env_overrides(DEV_REPO_BUCKET))
-    return return_code(200, {'status': 'Repository updating'})
+    dynamo = get_dynamo_resource()
+    package_table = dynamo.Table(PACKAGE_TABLE)
+
+    updating = {}
+    for bucket in [PERSONAL_REPO_BUCKET, DEV_REPO_BUCKET]:
+        versions = get_versions(package_table, bucket)
+        aur_packages = get_aur_info(versions)
+        outdated = get_outdated_packages(versions, aur_packages)
+        outdated = sorted(set(outdated).union(
+            x for x in versions if is_vcs_package(x) and x in aur_packages))
+        if not outdated:
+            print(f"All packages in {bucket} are up to date")
+            continue
+
+        updating[bucket] = outdated
+        promoted = promote_cached_packages(bucket, outdated, aur_packages)
+        if promoted:
+            print(f"Adding {len(promoted)} cached packages to {bucket}")
+            send_to_queue(REPO_DB_QUEUE, json.dumps({
+                'bucket': bucket,
+                'add': promoted
+            }))
+            continue
+
+        print(f"Updating {len(outdated)} packages in {bucket}: {outdated}")
+        start_ecs_task(ECS_CLUSTER, TASK_DEFN, get_env_overrides(bucket, outdated))
+
+    return return_code(200, {'status': 'Repository updating', 'packages': updating})
+
+
+def promote_cached_packages(bucket, outdated, aur_packages):
+    """ Copies the builds of the latest version of every outdated package
+    into the repository bucket from the artifact cache.
+
+    The update task rewrites the whole repository database, so it can't run
+    alongside the repo DB writer. Packages are only promoted if all of them
+    have been built before, otherwise the update task builds all of them.
+    The sources of VCS packages aren't known until they're built, so none
+    are promoted if any of them are VCS packages. Nothing is promoted into a
+    signed repository either, as the repo DB writer can't sign its database.
+
+    Args:
+        bucket (str): The bucket of the repository being updated
+        outdated (list): Names of the outdated packages
+        aur_packages (dict): The AUR details of the packages
+
+    Returns:
+        (list): The PackageName and Version of each package promoted, or an
+                empty list if the update task is needed
+    """
+
+    if not ARTIFACT_CACHE or not REPO_DB_QUEUE:
+        return []
+    if any(is_vcs_package(x) for x in outdated):
+        return []
+    s3 = get_client('s3')
+    if is_repo_signed(s3, bucket, REPO_ARCH, REPO_NAME):
+        print(f"The database of {bucket} is signed, updating instead")
+        return []
+
+    source_keys = {}
+    for name in outdated:
+        pkg = aur_packages[name]
+        source_keys[name] = get_source_key({
+            'PackageBase': pkg.get('PackageBase', name),
+            'Version': pkg['Version'],
+            'SourceHash': get_source_hash(pkg)
+        })
+
+    dynamo = get_dynamo_resource()
+    cache_table = dynamo.Table(ARTIFACT_CACHE)
+    cached = get_cached_artifacts(cache_table, source_keys)
+    if set(cached) != set(outdated):
+        print(f"No cached builds of {sorted(set(outdated) - set(cached))}")
+        return []
+
+    promoted = []
+    for name in outdated:
+        version = aur_packages[name]['Version']
+        try:
+            if not promote_artifacts(s3, REPO_ARCH, name, version,
+                                     cached[name].get('Buckets', set()), bucket):
+                return []
+        except Exception as e:
+            print(f"Unable to promote {name}, updating instead: {e}")
+            return []
+        cache_artifact(cache_table, name, source_keys[name], bucket)
+        promoted.append({'PackageName': name, 'Version': version})
+
+    return promoted
+
+
+def get_versions(package_table, repo_name):
+    """ Gets the version of each package within a repository
+
+    Args:
+        package_table (Table): The table containing the packages
+        repo_name (str): Name of the repository
+
+    Returns:
+        dict: The version of each package, or None if it isn't known
+    """
+
+    items = query_items(package_table,
+                        projection=['PackageName', 'Version'],
+                        KeyConditionExpression=Key('Repository').eq(repo_name))
+    return {x['PackageName']: x.get('Version') for x in items}
+
+
+def get_env_overrides(bucket, packages):
+    """ Gets the overrides of the repository update task.
+
+    The task is passed the repository to update in REMOTE_PATH and the
+    space-separated packages to rebuild in PACKAGES. Update images from
+    before PACKAGES was added ignore it and rebuild every package, which is
+    slower but still correct.
+
+    Args:
+        bucket (str): The bucket of the repository being updated
+        packages (list): Names of the packages to rebuild
 
+    Returns:
+        (dict): The overrides of the update task's container
+    """
 
-def get_env_overrides(bucket):
     return {
         'containerOverrides': [{
             'name': 'aur-pkg-update',
             'environment': [{
                 'name': 'REMOTE_PATH',
                 'value': f's3://{bucket}/{REPO_ARCH}'
+            }, {
+                'name': 'PACKAGES',
+                'value': ' '.join(packages)
             }]
         }]
     }
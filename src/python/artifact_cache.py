@@ -0,0 +1,182 @@
+import hashlib
+import json
+import re
+import time
+
+from botocore.exceptions import ClientError
+
+from aws import batch_get_items
+
+# Fields of the AUR package, as generated from its .SRCINFO, which identify
+# the sources a package is built from. LastModified changes with every push
+# to the AUR package, so any change to the PKGBUILD changes the hash.
+SOURCE_FIELDS = ('PackageBase', 'Version', 'LastModified', 'Depends',
+                 'MakeDepends', 'CheckDepends', 'Provides', 'Conflicts',
+                 'Replaces')
+
+# The rest of the name of a package file or its signature, following the
+# package name and version, eg. 'x86_64.pkg.tar.zst.sig'
+ARTIFACT_SUFFIX_RE = re.compile(r'^[^-/]+\.pkg\.tar(?:\.[a-z0-9]+)?(?:\.sig)?$')
+
+
+def get_source_hash(aur_package):
+    """ Hashes the fields of an AUR package which identify the sources it's
+    built from.
+
+    Args:
+        aur_package (dict): The AUR details of the package
+
+    Returns:
+        (str): The SHA-256 hash of the package's sources
+    """
+
+    fields = {x: aur_package.get(x) for x in SOURCE_FIELDS}
+    data = json.dumps(fields, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_source_key(source):
+    """ Gets the key the artifacts built from a package's sources are cached
+    under.
+
+    Args:
+        source (dict): The PackageBase, Version and SourceHash of a package
+
+    Returns:
+        (str): The cache key, eg. 'unicorn/1.0.3-1/<hash>'
+    """
+
+    return f"{source['PackageBase']}/{source['Version']}/{source['SourceHash']}"
+
+
+def get_cached_artifacts(cache_table, source_keys):
+    """ Finds which packages have been built from the same sources before.
+
+    Args:
+        cache_table (Table): Table containing the buckets holding the
+                             artifacts of each package build
+        source_keys (dict): The cache key of each package
+
+    Returns:
+        (dict): The cache item of each package built before, keyed by the
+                package name
+    """
+
+    keys = [{'SourceKey': key, 'PackageName': name}
+            for name, key in source_keys.items()]
+    items = batch_get_items(cache_table, keys)
+    return {x['PackageName']: x for x in items}
+
+
+def cache_artifact(cache_table, package_name, source_key, bucket):
+    """ Records that a bucket holds the artifacts of a package built from the
+    sources specified.
+
+    Args:
+        cache_table (Table): Table containing the buckets holding the
+                             artifacts of each package build
+        package_name (str): Name of the package
+        source_key (str): The cache key of the package's sources
+        bucket (str): The bucket holding the artifacts
+    """
+
+    cache_table.update_item(
+        Key={'SourceKey': source_key, 'PackageName': package_name},
+        UpdateExpression="set UpdatedAt = :t ADD Buckets :b",
+        ExpressionAttributeValues={':t': int(time.time()), ':b': {bucket}}
+    )
+
+
+def find_artifacts(s3, bucket, arch, package_name, version):
+    """ Finds the package files and signatures of a package version within a
+    repository bucket.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        bucket (str): The repository bucket
+        arch (str): The architecture of the repository
+        package_name (str): Name of the package
+        version (str): The full version of the package, eg. '1:2.0-1'
+
+    Returns:
+        (list): The keys of the package's files
+    """
+
+    prefix = f"{arch}/{package_name}-{version}-"
+    paginator = s3.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(x['Key'] for x in page.get('Contents', [])
+                    if ARTIFACT_SUFFIX_RE.match(x['Key'][len(prefix):]))
+    return keys
+
+
+def copy_artifacts(s3, source_bucket, target_bucket, keys):
+    """ Copies the files of a package between repository buckets. The copy
+    happens within S3, so the files aren't downloaded.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        source_bucket (str): The bucket holding the files
+        target_bucket (str): The bucket to copy the files to
+        keys (list): The keys of the files to copy
+    """
+
+    for key in keys:
+        print(f"Copying s3://{source_bucket}/{key} to s3://{target_bucket}/{key}")
+        s3.copy({'Bucket': source_bucket, 'Key': key}, target_bucket, key)
+
+
+def promote_artifacts(s3, arch, package_name, version, buckets, repo):
+    """ Makes the cached build of a package available within a repository
+    bucket, copying it from another bucket if it isn't there already.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        arch (str): The architecture of the repository
+        package_name (str): Name of the package
+        version (str): The version of the package built
+        buckets (set): The buckets the package's build was cached in
+        repo (str): The bucket of the repository being built
+
+    Returns:
+        (bool): Whether the package is available within the repository
+    """
+
+    # Files already within the repository don't need to be copied
+    for bucket in sorted(buckets, key=lambda x: (x != repo, x)):
+        keys = find_artifacts(s3, bucket, arch, package_name, version)
+        if all(x.endswith('.sig') for x in keys):
+            print(f"Cached build of {package_name} is missing from {bucket}")
+            continue
+
+        if bucket != repo:
+            copy_artifacts(s3, bucket, repo, keys)
+        print(f"Promoted {package_name} {version} from {bucket}")
+        return True
+
+    return False
+
+
+def is_repo_signed(s3, bucket, arch, repo_name):
+    """ Checks whether the database of a repository is signed. Packages can
+    only be added to a signed database by repo-add, as the database has to be
+    signed again with the key of the repository.
+
+    Args:
+        s3 (BaseClient): The S3 client
+        bucket (str): The repository bucket
+        arch (str): The architecture of the repository
+        repo_name (str): Name of the repository
+
+    Returns:
+        (bool): Whether the database has a signature
+    """
+
+    try:
+        s3.head_object(Bucket=bucket, Key=f"{arch}/{repo_name}.db.sig")
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', 'NotFound', '404'):
+            raise
+        return False
+    return True
@@ -0,0 +1,90 @@
+import json
+import urllib.request
+
+from urllib.parse import urlencode
+
+from packages import vercmp
+
+AUR_RPC_URL = "https://aur.archlinux.org/rpc/"
+
+# Maximum number of packages requested in a single multi-info AUR RPC call,
+# keeping the URL within the length accepted by the AUR
+AUR_MAX_ARGS = 100
+
+# Suffixes of packages built from the latest commit of a version control
+# repository. Their AUR version only changes when the PKGBUILD does, rather
+# than when the upstream repository does.
+VCS_SUFFIXES = ('-git', '-svn', '-hg', '-bzr', '-cvs', '-darcs')
+
+
+def get_aur_info(packages):
+    """ Retrieves the details of each package from the AUR RPC interface,
+    requesting up to AUR_MAX_ARGS packages per call using multiple arg[]
+    parameters.
+
+    Args:
+        packages (list): Names of the packages to retrieve
+
+    Returns:
+        (dict): The AUR details of each package keyed by the package name.
+                Packages which aren't in the AUR are left out.
+    """
+
+    packages = sorted(set(packages))
+    results = {}
+    for i in range(0, len(packages), AUR_MAX_ARGS):
+        args = [('v', 5), ('type', 'info')]
+        args.extend(('arg[]', pkg) for pkg in packages[i:i + AUR_MAX_ARGS])
+        url = f"{AUR_RPC_URL}?{urlencode(args)}"
+
+        print(f"Retrieving AUR details from {url}")
+        with urllib.request.urlopen(url) as resp:
+            data = json.loads(resp.read())
+
+        if data.get('type') == 'error':
+            raise RuntimeError(f"AUR RPC error: {data.get('error')}")
+
+        for result in data['results']:
+            results[result['Name']] = result
+
+    return results
+
+
+def get_outdated_packages(versions, aur_packages=None):
+    """ Finds the packages which have a newer version within the AUR than the
+    version already built, comparing them in the same way as pacman.
+
+    Args:
+        versions (dict): The version of each package already built, or None
+                         if the version isn't known
+        aur_packages (dict): The AUR details of the packages, if they've
+                             already been retrieved
+
+    Returns:
+        (list): Names of the packages with a newer version in the AUR
+    """
+
+    if aur_packages is None:
+        aur_packages = get_aur_info(versions)
+    outdated = []
+    for name, version in versions.items():
+        if name not in aur_packages or version is None:
+            continue
+        if vercmp(aur_packages[name]['Version'], version) > 0:
+            print(f"{name} {version} is outdated, AUR has {aur_packages[name]['Version']}")
+            outdated.append(name)
+    return sorted(outdated)
+
+
+def is_vcs_package(name):
+    """ Checks whether a package is built from the latest commit of a
+    version control repository, so always needs rebuilding to be up to date.
+
+    Args:
+        name (str): Name of the package
+
+    Returns:
+        (bool): Whether the package is a VCS package
+    """
+
+    return name.endswith(VCS_SUFFIXES)
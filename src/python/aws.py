@@ -1,31 +1,130 @@
 import boto3
 import json
 import os
+import threading
+import time
 
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
-def send_to_queue_name(queue_name, message):
-    # Create SQS client
+# Endpoints used for each service when running locally within SAM
+LOCAL_ENDPOINTS = {
+    'sqs': 'http://localhost:4566',
+    'dynamodb': 'http://dynamodb:8000',
+}
+
+# Connection settings shared by every client, keeping connections alive
+# between calls and allowing one connection per ThreadPoolExecutor worker
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'max_attempts': 5, 'mode': 'adaptive'}
+)
+
+# Clients are thread-safe so a single one is shared by all threads, whereas
+# resources are not so they are cached per thread. Both are kept at module
+# level so they are reused across warm Lambda invocations.
+_clients = {}
+_clients_lock = threading.Lock()
+_resources = threading.local()
+_queue_urls = {}
+
+# Limits on the number and total size of messages in an SQS batch
+SQS_BATCH_MAX_MESSAGES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+SQS_BATCH_MAX_RETRIES = 5
+SQS_BATCH_MAX_WORKERS = 10
+
+# Limits on the number of keys in DynamoDB BatchGetItem and BatchWriteItem
+# requests
+DYNAMODB_BATCH_GET_MAX_KEYS = 100
+DYNAMODB_BATCH_WRITE_MAX_KEYS = 25
+DYNAMODB_BATCH_WRITE_MAX_WORKERS = 10
+DYNAMODB_MAX_RETRIES = 8
+
+# Limits on the number of tasks started by a single ECS RunTask call, and
+# the number of tasks described by a single DescribeTasks call
+ECS_RUN_TASK_MAX_COUNT = 10
+ECS_DESCRIBE_TASKS_MAX_ARNS = 100
+
+
+def _endpoint_url(service):
+    """ Gets the endpoint of a service depending on which environment the
+    function is running in, or None for the default AWS endpoint. """
     if os.getenv("AWS_SAM_LOCAL"):
-        sqs = boto3.resource('sqs', endpoint_url='http://localhost:4566')
-    else:
-        sqs = boto3.resource('sqs')
-    # Get queue
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
+        return LOCAL_ENDPOINTS.get(service)
+    return None
+
+
+def get_client(service):
+    """ Gets a cached boto3 client for the service specified, creating it on
+    first use.
+
+    Args:
+        service (str): The name of the AWS service, eg. 'sqs'
+
+    Returns:
+        (BaseClient): The client for the service
+    """
+
+    endpoint_url = _endpoint_url(service)
+    key = (service, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        # The default session isn't thread-safe when creating clients
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service, endpoint_url=endpoint_url,
+                                      config=CLIENT_CONFIG)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service):
+    """ Gets a boto3 resource for the service specified, cached per thread as
+    resources can't be shared between threads.
+
+    Args:
+        service (str): The name of the AWS service, eg. 'dynamodb'
+
+    Returns:
+        (ServiceResource): The resource for the service
+    """
+
+    endpoint_url = _endpoint_url(service)
+    key = (service, endpoint_url)
+    cache = getattr(_resources, 'cache', None)
+    if cache is None:
+        cache = _resources.cache = {}
+    resource = cache.get(key)
+    if resource is None:
+        session = boto3.session.Session()
+        resource = session.resource(service, endpoint_url=endpoint_url,
+                                    config=CLIENT_CONFIG)
+        cache[key] = resource
+    return resource
+
+
+def send_to_queue_name(queue_name, message):
+    # Look up the queue URL once and reuse it
+    sqs = get_client('sqs')
+    if queue_name not in _queue_urls:
+        resp = sqs.get_queue_url(QueueName=queue_name)
+        _queue_urls[queue_name] = resp['QueueUrl']
+
     # Send message
-    response = queue.send_message(
+    response = sqs.send_message(
+        QueueUrl=_queue_urls[queue_name],
         MessageBody=message
     )
     print(f"Message sent: {response['MessageId']}")
 
 
 def send_to_queue(queue_url, message):
-    # Create SQS client
     print(f"Sending the following message to SQS {queue_url}:")
     print(message)
-    if os.getenv("AWS_SAM_LOCAL"):
-        sqs = boto3.client('sqs', endpoint_url='http://localhost:4566')
-    else:
-        sqs = boto3.client('sqs')
+    sqs = get_client('sqs')
     response = sqs.send_message(
         QueueUrl=queue_url,
         MessageBody=(message)
@@ -33,39 +132,228 @@ def send_to_queue(queue_url, message):
     print(f"Message sent: {response['MessageId']}")
 
 
-def start_ecs_task(cluster, task_definition, overrides={}):
-    """Starts a new ECS task within a Fargate cluster to build the packages
+def _batch_messages(messages):
+    """ Groups messages into batches which fit within the SQS limits on the
+    number of messages and total payload size of a single batch.
 
-    The ECS task pulls each package built one by one from the queue and adds
-    them to the personal repository.
+    Args:
+        messages (list): The message bodies to group
+
+    Returns:
+        (list): Lists of (id, message) tuples, one list per batch
+
+    Raises:
+        ValueError: If a message is too large to be sent on its own
+    """
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for i, message in enumerate(messages):
+        size = len(message.encode('utf-8'))
+        if size > SQS_BATCH_MAX_BYTES:
+            raise ValueError(f"Message {i} is {size} bytes, over the SQS limit "
+                             f"of {SQS_BATCH_MAX_BYTES} bytes: {message[:100]}")
+        if len(batch) == SQS_BATCH_MAX_MESSAGES \
+                or batch_size + size > SQS_BATCH_MAX_BYTES:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append((str(i), message))
+        batch_size += size
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _send_batch(queue_url, batch):
+    """ Sends a single batch of messages to a queue, retrying only those
+    entries which failed with exponential backoff. Entries which failed
+    through a fault of the sender, such as an invalid message, would fail
+    again so they aren't retried.
+
+    Args:
+        queue_url (str): The URL of the queue to send the messages to
+        batch (list): The (id, message) tuples to send
+
+    Returns:
+        (int): The number of messages sent
+    """
+
+    sqs = get_client('sqs')
+    entries = [{'Id': msg_id, 'MessageBody': msg} for msg_id, msg in batch]
+    for retry_count in range(SQS_BATCH_MAX_RETRIES + 1):
+        if retry_count > 0:
+            time.sleep(0.1 * 2 ** retry_count)
+
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        sender_faults = [x for x in response.get('Failed', []) if x.get('SenderFault')]
+        if sender_faults:
+            errors = ', '.join(f"{x['Id']}: {x['Code']}" for x in sender_faults)
+            raise RuntimeError(f"SQS rejected {len(sender_faults)} messages to "
+                               f"{queue_url}: {errors}")
+
+        failed = {x['Id'] for x in response.get('Failed', [])}
+        entries = [x for x in entries if x['Id'] in failed]
+        if not entries:
+            return len(batch)
+
+        print(f"Retrying {len(entries)} failed messages to {queue_url}")
+
+    raise RuntimeError(f"Failed to send {len(entries)} messages to {queue_url}")
+
+
+def send_batch_to_queue(queue_url, messages):
+    """ Sends a collection of messages to a queue using SendMessageBatch,
+    grouping them 10 at a time within the 256 KB batch limit and sending the
+    batches concurrently.
+
+    Args:
+        queue_url (str): The URL of the queue to send the messages to
+        messages (list): The message bodies to send
+    """
+
+    if not messages:
+        return
+
+    print(f"Sending {len(messages)} messages to SQS {queue_url}:")
+    for message in messages:
+        print(message)
+
+    batches = _batch_messages(messages)
+    workers = min(len(batches), SQS_BATCH_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sent = sum(executor.map(lambda b: _send_batch(queue_url, b), batches))
+    print(f"{sent} messages sent in {len(batches)} batches")
+
+
+def start_ecs_task(cluster, task_definition, overrides={}, count=1,
+                   started_by=None):
+    """Starts new ECS tasks within a Fargate cluster to build the packages
+
+    Each ECS task pulls each package built one by one from the queue and adds
+    them to the personal repository. ECS starts at most ECS_RUN_TASK_MAX_COUNT
+    tasks per call, so larger counts are split between calls.
 
     Args:
         cluster (str): The name of the cluster to start the task in
         task_definition (str); The name of the task definition to run
         overrides (dict): Any ECS variable overrides to push to the container
+        count (int): The number of tasks to start
+        started_by (str): Tag the tasks are started with, used to count the
+                          tasks started for a single purpose
+
+    Returns:
+        (int): The number of tasks started
     """
 
-    print(f"Starting new ECS task to build the package(s)")
+    print(f"Starting {count} new ECS task(s) to build the package(s)")
 
     # Note: There's no ECS in the free version of localstack
-    client = boto3.client('ecs')
-    response = client.run_task(
-        cluster=cluster,
-        launchType='FARGATE',
-        taskDefinition=task_definition,
-        count=1,
-        platformVersion='LATEST',
-        networkConfiguration={
-            'awsvpcConfiguration': {
-                'subnets': [
-                    'subnet-9f4b60c6'
-                ],
-                'assignPublicIp': 'ENABLED'
-            }
-        },
-        overrides=overrides
-    )
-    print(f"Run task complete: {str(response)}")
+    client = get_client('ecs')
+    extra_args = {'startedBy': started_by} if started_by else {}
+    started = 0
+    for i in range(0, count, ECS_RUN_TASK_MAX_COUNT):
+        response = client.run_task(
+            cluster=cluster,
+            launchType='FARGATE',
+            taskDefinition=task_definition,
+            count=min(ECS_RUN_TASK_MAX_COUNT, count - i),
+            platformVersion='LATEST',
+            networkConfiguration={
+                'awsvpcConfiguration': {
+                    'subnets': [
+                        'subnet-9f4b60c6'
+                    ],
+                    'assignPublicIp': 'ENABLED'
+                }
+            },
+            overrides=overrides,
+            **extra_args
+        )
+        print(f"Run task complete: {str(response)}")
+        started += len(response.get('tasks', []))
+        for failure in response.get('failures', []):
+            print(f"Failed to start task: {failure}")
+
+    return started
+
+
+def get_task_counts(cluster, task_definition=None, started_by=None):
+    """ Retrieves the number of ECS tasks for a specified cluster and task
+    family that are currently either running or are in a pending state waiting
+    to be run, split by their last known status.
+
+    Args:
+        cluster (str): The name of the cluster containing the running tasks
+        task_definition (str): The family of task to search for
+        started_by (str): The tag the tasks were started with, which is
+                          searched for instead of the family if given
+
+    Returns:
+        (dict): The number of tasks with each status, eg. RUNNING or PENDING
+    """
+
+    # ECS doesn't allow startedBy to be combined with any other filter, and
+    # tasks are only listed if they're meant to be running by default
+    filters = {'startedBy': started_by} if started_by \
+        else {'family': task_definition, 'desiredStatus': 'RUNNING'}
+
+    return _count_task_statuses(cluster, filters)
+
+
+def get_untagged_task_counts(cluster, task_definition, prefix):
+    """ Retrieves the number of ECS tasks of a task family which weren't
+    started with a tag beginning with the prefix, such as those started
+    before tasks were tagged, split by their last known status.
+
+    Args:
+        cluster (str): The name of the cluster containing the running tasks
+        task_definition (str): The family of task to search for
+        prefix (str): The start of the tags of the tasks to leave out
+
+    Returns:
+        (dict): The number of tasks with each status, eg. RUNNING or PENDING
+    """
+
+    filters = {'family': task_definition, 'desiredStatus': 'RUNNING'}
+    return _count_task_statuses(
+        cluster, filters,
+        lambda task: not (task.get('startedBy') or '').startswith(prefix))
+
+
+def _count_task_statuses(cluster, filters, include=None):
+    """ Counts the tasks listed with the filters by their last known status,
+    describing them in pages of ECS_DESCRIBE_TASKS_MAX_ARNS tasks.
+
+    Args:
+        cluster (str): The name of the cluster containing the tasks
+        filters (dict): The filters of the ListTasks call
+        include (function): Takes a task and returns whether to count it,
+                            or None to count every task
+
+    Returns:
+        (dict): The number of tasks with each status
+    """
+
+    client = get_client('ecs')
+    paginator = client.get_paginator('list_tasks')
+    task_arns = [arn
+                 for page in paginator.paginate(cluster=cluster, **filters)
+                 for arn in page['taskArns']]
+
+    counts = {}
+    for i in range(0, len(task_arns), ECS_DESCRIBE_TASKS_MAX_ARNS):
+        response = client.describe_tasks(
+            cluster=cluster,
+            tasks=task_arns[i:i + ECS_DESCRIBE_TASKS_MAX_ARNS])
+        for task in response['tasks']:
+            if include is not None and not include(task):
+                continue
+            status = task.get('lastStatus', 'PENDING')
+            counts[status] = counts.get(status, 0) + 1
+    return counts
 
 
 def get_running_task_count(cluster, task_definition):
@@ -81,24 +369,212 @@ def get_running_task_count(cluster, task_definition):
         (int): The number of tasks in a running/soon to be running state
     """
 
-    client = boto3.client('ecs')
-    response = client.list_tasks(
-        cluster=cluster,
-        family=task_definition,
-        desiredStatus="RUNNING"
-    )
-    return len(response['taskArns'])
+    return sum(get_task_counts(cluster, task_definition).values())
+
+
+def get_queue_depth(queue_url):
+    """ Retrieves the approximate number of messages waiting to be received
+    from a queue, not including those already being processed.
+
+    Args:
+        queue_url (str): The URL of the queue
+
+    Returns:
+        (int): The approximate number of messages within the queue
+    """
+
+    client = get_client('sqs')
+    response = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages'])
+    return int(response['Attributes']['ApproximateNumberOfMessages'])
 
 
 def get_dynamo_resource():
     """
     Get a dynamodb resource depending on which environment the function is
-    running in
+    running in, reusing the one cached for the current thread
     """
 
-    if os.getenv("AWS_SAM_LOCAL"):
-        dynamo = boto3.resource('dynamodb', endpoint_url="http://dynamodb:8000")
-    else:
-        dynamo = boto3.resource('dynamodb')
-    return dynamo
+    return get_resource('dynamodb')
+
+
+def _projection_args(projection):
+    """ Builds the arguments needed to only retrieve the attributes specified,
+    using placeholders so reserved words such as 'repo' can be projected.
+
+    Args:
+        projection (list): Names of the attributes to retrieve
+
+    Returns:
+        (dict): The ProjectionExpression and ExpressionAttributeNames
+    """
+
+    if not projection:
+        return {}
+
+    names = {f"#p{i}": attr for i, attr in enumerate(projection)}
+    return {
+        'ProjectionExpression': ", ".join(names.keys()),
+        'ExpressionAttributeNames': names
+    }
+
+
+def _paginate(operation, kwargs):
+    """ Calls a DynamoDB query or scan operation, following LastEvaluatedKey
+    until every page of results has been returned.
+
+    Args:
+        operation (function): The table's query or scan method
+        kwargs (dict): Arguments to pass to the operation
+
+    Yields:
+        (dict): Each item returned by the operation
+    """
+
+    kwargs = dict(kwargs)
+    while True:
+        resp = operation(**kwargs)
+        yield from resp['Items']
+        if 'LastEvaluatedKey' not in resp:
+            return
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def query_items(table, projection=None, **kwargs):
+    """ Queries a DynamoDB table, streaming the items from every page of
+    results rather than only the first 1 MB.
+
+    Args:
+        table (Table): The table to query
+        projection (list): Names of the attributes to retrieve, or None for all
+        kwargs: Any other arguments to the query, eg. KeyConditionExpression
+
+    Yields:
+        (dict): Each item matching the query
+    """
+
+    kwargs.update(_projection_args(projection))
+    yield from _paginate(table.query, kwargs)
+
+
+def scan_items(table, projection=None, segments=1, **kwargs):
+    """ Scans a DynamoDB table, streaming the items from every page of results
+    rather than only the first 1 MB.
+
+    If more than one segment is requested the scan is split into that many
+    parallel segmented scans, each running in its own thread with its own
+    table resource, as boto3 resources can't be shared between threads.
+
+    Args:
+        table (Table): The table to scan
+        projection (list): Names of the attributes to retrieve, or None for all
+        segments (int): The number of parallel segments to scan the table with
+        kwargs: Any other arguments to the scan, eg. FilterExpression
+
+    Yields:
+        (dict): Each item within the table matching the scan
+    """
+
+    kwargs.update(_projection_args(projection))
+    if segments <= 1:
+        yield from _paginate(table.scan, kwargs)
+        return
+
+    def scan_segment(segment):
+        segment_table = get_resource('dynamodb').Table(table.name)
+        segment_args = dict(kwargs, Segment=segment, TotalSegments=segments)
+        return list(_paginate(segment_table.scan, segment_args))
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for items in executor.map(scan_segment, range(segments)):
+            yield from items
+
+
+def batch_get_items(table, keys, projection=None):
+    """ Retrieves the items with the keys specified using BatchGetItem, 100
+    keys per request, retrying any unprocessed keys with exponential backoff.
+    Keys which don't exist in the table are skipped.
+
+    Args:
+        table (Table): The table containing the items
+        keys (list): The primary key of each item to retrieve
+        projection (list): Names of the attributes to retrieve, or None for all
+
+    Returns:
+        (list): The items found within the table
+    """
+
+    dynamo = get_dynamo_resource()
+    items = []
+    for i in range(0, len(keys), DYNAMODB_BATCH_GET_MAX_KEYS):
+        request = dict(_projection_args(projection),
+                       Keys=keys[i:i + DYNAMODB_BATCH_GET_MAX_KEYS])
+        request_items = {table.name: request}
+
+        for retry_count in range(DYNAMODB_MAX_RETRIES + 1):
+            if retry_count > 0:
+                time.sleep(0.05 * 2 ** retry_count)
+
+            resp = dynamo.batch_get_item(RequestItems=request_items)
+            items.extend(resp['Responses'].get(table.name, []))
+            request_items = resp.get('UnprocessedKeys')
+            if not request_items:
+                break
+        else:
+            raise RuntimeError(f"Failed to read {len(keys)} keys from {table.name}")
+
+    return items
+
+
+def _batch_delete(table_name, keys):
+    """ Deletes a single batch of items using BatchWriteItem, retrying any
+    unprocessed items with exponential backoff.
+
+    Args:
+        table_name (str): The name of the table containing the items
+        keys (list): The primary key of each item to delete
+
+    Returns:
+        (int): The number of items deleted
+    """
+
+    dynamo = get_resource('dynamodb')
+    request_items = {
+        table_name: [{'DeleteRequest': {'Key': key}} for key in keys]
+    }
+    for retry_count in range(DYNAMODB_MAX_RETRIES + 1):
+        if retry_count > 0:
+            time.sleep(0.05 * 2 ** retry_count)
+
+        resp = dynamo.batch_write_item(RequestItems=request_items)
+        request_items = resp.get('UnprocessedItems')
+        if not request_items:
+            return len(keys)
+
+    raise RuntimeError(f"Failed to delete {len(keys)} items from {table_name}")
+
+
+def batch_delete_items(table, keys):
+    """ Deletes the items with the keys specified, splitting them into
+    BatchWriteItem requests of 25 keys which are sent in parallel.
+
+    Args:
+        table (Table): The table containing the items
+        keys (list): The primary key of each item to delete
+
+    Returns:
+        (int): The number of items deleted
+    """
+
+    if not keys:
+        return 0
 
+    batches = [keys[i:i + DYNAMODB_BATCH_WRITE_MAX_KEYS]
+               for i in range(0, len(keys), DYNAMODB_BATCH_WRITE_MAX_KEYS)]
+    workers = min(len(batches), DYNAMODB_BATCH_WRITE_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        deleted = sum(executor.map(lambda b: _batch_delete(table.name, b),
+                                   batches))
+    print(f"Deleted {deleted} items from {table.name} in {len(batches)} batches")
+    return deleted
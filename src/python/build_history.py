@@ -0,0 +1,148 @@
+import time
+
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from aws import batch_get_items
+from enums import Status
+
+# Metrics sent by the package builder along with the outcome of each build,
+# and the attribute each one is stored as within the build history
+BUILD_METRICS = {
+    'BuildDuration': 'LastDuration',    # Wall time of the build in seconds
+    'PeakMemory': 'PeakMemory',         # Peak memory used in MiB
+    'ArtifactSize': 'ArtifactSize',     # Size of the built package in bytes
+}
+
+# Sizes of ECS task which can be started to build packages, smallest first.
+# The largest matches the size of the task definition.
+TASK_SIZES = [
+    {'name': 'small', 'cpu': '1024', 'memory': '2048'},
+    {'name': 'medium', 'cpu': '2048', 'memory': '4096'},
+    {'name': 'large', 'cpu': '4096', 'memory': '8192'},
+]
+
+# Memory kept free on top of the peak memory of the previous build, as a
+# fraction of the peak
+MEMORY_HEADROOM = 0.5
+
+# Builds taking longer than this, in seconds, are given at least the
+# LONG_BUILD_TASK_SIZE so they have more CPU
+LONG_BUILD_DURATION = 30 * 60
+LONG_BUILD_TASK_SIZE = 'medium'
+
+
+def record_build(history_table, package_state):
+    """ Stores the outcome and metrics of a package build within the build
+    history, keeping the latest metrics along with counts of every build.
+
+    The ID of the fanout the build was part of is stored, so redelivered
+    messages aren't counted twice.
+
+    Args:
+        history_table (Table): Table containing the build history of each
+                               package
+        package_state (dict): The Complete or Failed message sent by the
+                              package builder
+
+    Returns:
+        (bool): Whether the build was recorded
+    """
+
+    status = package_state['BuildStatus']
+    values = {
+        ':s': status,
+        ':f': package_state.get('FanoutId', ''),
+        ':t': int(time.time()),
+        ':one': 1,
+        ':failed': 1 if status == Status.Failed.name else 0
+    }
+    update_expression = "set LastStatus = :s, LastFanoutId = :f, UpdatedAt = :t"
+    for metric, attribute in BUILD_METRICS.items():
+        if package_state.get(metric) is not None:
+            placeholder = f":{attribute.lower()}"
+            update_expression += f", {attribute} = {placeholder}"
+            values[placeholder] = Decimal(str(package_state[metric]))
+    update_expression += " ADD Builds :one, Failures :failed"
+
+    try:
+        history_table.update_item(
+            Key={'PackageName': package_state['PackageName']},
+            UpdateExpression=update_expression,
+            ConditionExpression="attribute_not_exists(LastFanoutId) "
+                                "OR LastFanoutId <> :f",
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Build of {package_state['PackageName']} already recorded")
+        return False
+    return True
+
+
+def get_build_history(history_table, package_names):
+    """ Retrieves the build history of each package.
+
+    Args:
+        history_table (Table): Table containing the build history of each
+                               package
+        package_names (list): Names of the packages to retrieve
+
+    Returns:
+        (dict): The build history of each package which has been built
+                before, keyed by the package name
+    """
+
+    keys = [{'PackageName': x} for x in set(package_names)]
+    items = batch_get_items(history_table, keys)
+    return {x['PackageName']: x for x in items}
+
+
+def get_predicted_duration(history):
+    """ Predicts how long a package will take to build from its last build.
+
+    Args:
+        history (dict): The build history of the package, or None if it
+                        hasn't been built before
+
+    Returns:
+        (float): The predicted duration in seconds, or None if unknown
+    """
+
+    if not history or history.get('LastDuration') is None:
+        return None
+    return float(history['LastDuration'])
+
+
+def get_task_size(history):
+    """ Picks the smallest task size with enough memory for a package, based
+    on the peak memory of its last build.
+
+    Packages which haven't been built before, or whose last build failed,
+    get the largest size, as the failure may have been down to the size of
+    the task.
+
+    Args:
+        history (dict): The build history of the package, or None if it
+                        hasn't been built before
+
+    Returns:
+        (int): The index of the task size within TASK_SIZES
+    """
+
+    largest = len(TASK_SIZES) - 1
+    if not history or history.get('PeakMemory') is None \
+            or history.get('LastStatus') == Status.Failed.name:
+        return largest
+
+    needed = float(history['PeakMemory']) * (1 + MEMORY_HEADROOM)
+    size = next((i for i, x in enumerate(TASK_SIZES)
+                 if int(x['memory']) >= needed), largest)
+
+    duration = get_predicted_duration(history)
+    if duration is not None and duration > LONG_BUILD_DURATION:
+        size = max(size, next(i for i, x in enumerate(TASK_SIZES)
+                              if x['name'] == LONG_BUILD_TASK_SIZE))
+    return size
@@ -6,3 +6,9 @@ class Status(Enum):
     Building = 2
     Complete = 3
     Failed = 4
+    Waiting = 5
+
+
+class Lane(Enum):
+    Default = 1
+    Long = 2
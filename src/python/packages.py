@@ -0,0 +1,178 @@
+import re
+
+# Suffix of the package table partition holding a repository's provides index
+PROVIDES_SUFFIX = '#provides'
+
+# Splits a dependency such as 'foo>=1.2' into its name, operator and version
+DEPENDENCY_RE = re.compile(r'^([^<>=]+)(?:(<=|>=|<|>|=)(.+))?$')
+
+
+def provides_partition(repo_name):
+    """ Gets the name of the partition containing the index of the virtual
+    packages provided by packages within the repository.
+
+    Args:
+        repo_name (str): Name of the repository
+
+    Returns:
+        (str): The partition key of the provides index
+    """
+
+    return f"{repo_name}{PROVIDES_SUFFIX}"
+
+
+def parse_dependency(dependency):
+    """ Splits a dependency into the package name and version constraint.
+
+    Args:
+        dependency (str): The dependency, eg. 'sh', 'foo>=1.2' or 'bar=2-1'
+
+    Returns:
+        (tuple): The name, operator and version of the dependency, with the
+                 operator and version set to None if it is unversioned
+    """
+
+    match = DEPENDENCY_RE.match(dependency.strip())
+    if match is None:
+        raise ValueError(f"Invalid dependency: {dependency}")
+
+    name, op, version = match.groups()
+    return name, op, version
+
+
+def _is_digit(c):
+    return '0' <= c <= '9'
+
+
+def _is_alpha(c):
+    return 'a' <= c <= 'z' or 'A' <= c <= 'Z'
+
+
+def _rpmvercmp(a, b):
+    """ Compares two version segments in the same way as pacman's rpmvercmp,
+    alternating between numeric and alphabetic blocks. """
+
+    if a == b:
+        return 0
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+
+        # Skip any separators, noting how many were found
+        start_i, start_j = i, j
+        while i < len(a) and not (_is_alpha(a[i]) or _is_digit(a[i])):
+            i += 1
+        while j < len(b) and not (_is_alpha(b[j]) or _is_digit(b[j])):
+            j += 1
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        if i - start_i != j - start_j:
+            return -1 if i - start_i < j - start_j else 1
+
+        # Grab the next completely numeric or completely alphabetic block
+        is_num = _is_digit(a[i])
+        is_block = _is_digit if is_num else _is_alpha
+        end_i, end_j = i, j
+        while end_i < len(a) and is_block(a[end_i]):
+            end_i += 1
+        while end_j < len(b) and is_block(b[end_j]):
+            end_j += 1
+
+        # Numeric blocks are always newer than alphabetic ones
+        if end_j == j:
+            return 1 if is_num else -1
+
+        one, two = a[i:end_i], b[j:end_j]
+        if is_num:
+            one, two = one.lstrip('0'), two.lstrip('0')
+            if len(one) != len(two):
+                return 1 if len(one) > len(two) else -1
+
+        if one != two:
+            return 1 if one > two else -1
+
+        i, j = end_i, end_j
+
+    if i >= len(a) and j >= len(b):
+        return 0
+
+    # A remaining alphabetic block never beats an empty one
+    if (i >= len(a) and not _is_alpha(b[j])) or (i < len(a) and _is_alpha(a[i])):
+        return -1
+    return 1
+
+
+def _parse_evr(version):
+    """ Splits a version into its epoch, version and release """
+
+    i = 0
+    while i < len(version) and _is_digit(version[i]):
+        i += 1
+
+    if i < len(version) and version[i] == ':':
+        epoch, rest = version[:i] or '0', version[i + 1:]
+    else:
+        epoch, rest = '0', version
+
+    ver, sep, rel = rest.rpartition('-')
+    if not sep:
+        return epoch, rest, None
+    return epoch, ver, rel
+
+
+def vercmp(a, b):
+    """ Compares two package versions using the same rules as pacman's vercmp.
+
+    Versions are in the format [epoch:]pkgver[-pkgrel], and the release is
+    only compared if both versions contain one.
+
+    Args:
+        a (str): The first version
+        b (str): The second version
+
+    Returns:
+        (int): -1 if a is older than b, 0 if they are equal, 1 if a is newer
+    """
+
+    if a == b:
+        return 0
+
+    epoch1, ver1, rel1 = _parse_evr(a)
+    epoch2, ver2, rel2 = _parse_evr(b)
+
+    ret = _rpmvercmp(epoch1, epoch2)
+    if ret == 0:
+        ret = _rpmvercmp(ver1, ver2)
+        if ret == 0 and rel1 is not None and rel2 is not None:
+            ret = _rpmvercmp(rel1, rel2)
+    return ret
+
+
+def satisfies(version, op, required):
+    """ Checks whether a version meets a dependency's version constraint.
+
+    Args:
+        version (str): The version available, or None if it is unversioned
+        op (str): The constraint operator, or None if the dependency is
+                  unversioned
+        required (str): The version required by the constraint
+
+    Returns:
+        (bool): Whether the version satisfies the constraint
+    """
+
+    if op is None:
+        return True
+    if version is None:
+        return False
+
+    cmp = vercmp(version, required)
+    return {
+        '<': cmp < 0,
+        '<=': cmp <= 0,
+        '=': cmp == 0,
+        '>=': cmp >= 0,
+        '>': cmp > 0,
+    }[op]
@@ -1,6 +1,8 @@
 import boto3
 import pytest
 
+from mock import patch
+
 from moto import mock_dynamodb
 
 @pytest.fixture()
@@ -45,10 +47,109 @@ def dynamodb_table():
         yield tbl
 
 
+@pytest.fixture()
+def build_history_table(dynamodb_table):
+
+    table_name = 'build-history'
+
+    client = boto3.client('dynamodb')
+    client.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'PackageName', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {"KeyType": "HASH", "AttributeName": "PackageName"}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 3,
+            'WriteCapacityUnits': 3
+        }
+    )
+
+    yield boto3.resource('dynamodb').Table(table_name)
+
+
+@pytest.fixture()
+def artifact_cache_table(dynamodb_table):
+
+    table_name = 'artifact-cache'
+
+    client = boto3.client('dynamodb')
+    client.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'SourceKey', 'AttributeType': 'S'},
+            {'AttributeName': 'PackageName', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {"KeyType": "HASH", "AttributeName": "SourceKey"},
+            {"KeyType": "RANGE", "AttributeName": "PackageName"}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 3,
+            'WriteCapacityUnits': 3
+        }
+    )
+
+    yield boto3.resource('dynamodb').Table(table_name)
+
+
+@pytest.fixture()
+def pkgbuild_cache_table(dynamodb_table):
+
+    table_name = 'pkgbuild-cache'
+
+    client = boto3.client('dynamodb')
+    client.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'GitUrl', 'AttributeType': 'S'},
+            {'AttributeName': 'GitBranch', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {"KeyType": "HASH", "AttributeName": "GitUrl"},
+            {"KeyType": "RANGE", "AttributeName": "GitBranch"}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 1,
+            'WriteCapacityUnits': 1
+        }
+    )
+
+    yield boto3.resource('dynamodb').Table(table_name)
+
+
+@pytest.fixture()
+def mirror_state_table(dynamodb_table):
+
+    import package_updater.update_packages as update_packages
+
+    table_name = 'mirror-state'
+
+    client = boto3.client('dynamodb')
+    client.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'Repository', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {"KeyType": "HASH", "AttributeName": "Repository"}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 1,
+            'WriteCapacityUnits': 1
+        }
+    )
+
+    with patch.object(update_packages, 'MIRROR_STATE_TABLE', table_name):
+        yield boto3.resource('dynamodb').Table(table_name)
+
+
 def pkgcomp(pkgdict1, pkgdict2):
-    """ Compare two package table entries """
-    def pkgsort(key):
-        return (key['Repository'], key['PackageName'])
+    """ Compare the keys of two package table entries """
+    def pkgkey(item):
+        return (item['Repository'], item['PackageName'])
 
-    return sorted(pkgdict1, key=pkgsort) == sorted(pkgdict2, key=pkgsort)
+    return sorted(map(pkgkey, pkgdict1)) == sorted(map(pkgkey, pkgdict2))
 
@@ -0,0 +1,279 @@
+import boto3
+import os
+import pytest
+import sys
+
+from boto3.dynamodb.conditions import Key
+from mock import patch
+from moto import mock_dynamodb, mock_sqs
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+
+@pytest.fixture()
+def dynamodb_table():
+
+    table_name = 'package-table'
+
+    with mock_dynamodb():
+        client = boto3.client('dynamodb')
+        client.create_table(
+            TableName=table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'Repository', 'AttributeType': 'S'},
+                {'AttributeName': 'PackageName', 'AttributeType': 'S'}
+            ],
+            KeySchema=[
+                {"KeyType": "HASH", "AttributeName": "Repository"},
+                {"KeyType": "RANGE", "AttributeName": "PackageName"}
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        )
+
+        tbl = boto3.resource('dynamodb').Table(table_name)
+        with tbl.batch_writer() as batch:
+            for i in range(50):
+                batch.put_item(Item={
+                    'Repository': 'personal-prod' if i % 2 else 'personal-dev',
+                    'PackageName': f'package-{i:02}',
+                    'repo': 'couldinho-test'
+                })
+
+        yield tbl
+
+
+def test_query_follows_every_page(dynamodb_table):
+
+    from aws import query_items
+
+    items = list(query_items(
+        dynamodb_table,
+        KeyConditionExpression=Key('Repository').eq('personal-prod'),
+        Limit=3))
+
+    assert len(items) == 25
+    assert all(x['Repository'] == 'personal-prod' for x in items)
+
+
+def test_scan_only_returns_projected_attributes(dynamodb_table):
+
+    from aws import scan_items
+
+    items = list(scan_items(dynamodb_table, projection=['PackageName', 'repo'],
+                            Limit=7))
+
+    assert len(items) == 50
+    assert all(set(x.keys()) == {'PackageName', 'repo'} for x in items)
+
+
+def test_parallel_scan_returns_every_item(dynamodb_table):
+
+    from aws import scan_items
+
+    items = list(scan_items(dynamodb_table, segments=4, Limit=5))
+
+    # Moto ignores the segment arguments and returns every item per segment
+    names = set(x['PackageName'] for x in items)
+    assert names == set(f'package-{i:02}' for i in range(50))
+
+
+def test_bulk_delete_removes_every_key(dynamodb_table):
+
+    from aws import batch_delete_items
+
+    keys = [{'Repository': 'personal-prod', 'PackageName': f'package-{i:02}'}
+            for i in range(1, 50, 2)]
+    keys += [{'Repository': 'personal-dev', 'PackageName': f'package-{i:02}'}
+             for i in range(0, 30, 2)]
+
+    assert batch_delete_items(dynamodb_table, keys) == 40
+    items = dynamodb_table.scan()['Items']
+    assert sorted(x['PackageName'] for x in items) == \
+        [f'package-{i:02}' for i in range(30, 50, 2)]
+
+
+def test_bulk_delete_retries_unprocessed_items():
+
+    import aws
+
+    class FakeResource:
+        calls = []
+
+        def batch_write_item(self, RequestItems):
+            self.calls.append(RequestItems)
+            if len(self.calls) == 1:
+                return {'UnprocessedItems': {'table': RequestItems['table'][:2]}}
+            return {'UnprocessedItems': {}}
+
+    class FakeTable:
+        name = 'table'
+
+    keys = [{'PackageName': f'package-{i}'} for i in range(5)]
+    with patch.object(aws, 'get_resource', lambda service: FakeResource()), \
+            patch('time.sleep'):
+        assert aws.batch_delete_items(FakeTable(), keys) == 5
+
+    assert len(FakeResource.calls) == 2
+    assert len(FakeResource.calls[1]['table']) == 2
+
+
+def test_clients_are_shared_between_threads():
+
+    from concurrent.futures import ThreadPoolExecutor
+    from aws import get_client, get_resource
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        clients = list(executor.map(lambda _: get_client('sqs'), range(8)))
+        resources = list(executor.map(lambda _: get_resource('dynamodb'), range(8)))
+
+    # Clients are thread-safe so they are shared, resources are per thread
+    assert all(c is clients[0] for c in clients)
+    assert get_resource('dynamodb') is get_resource('dynamodb')
+    assert len(set(map(id, resources))) <= 4
+
+
+def test_batches_respect_count_and_size_limits():
+
+    from aws import _batch_messages
+
+    batches = _batch_messages([f'message-{i}' for i in range(25)])
+    assert [len(b) for b in batches] == [10, 10, 5]
+
+    large = 'x' * (100 * 1024)
+    batches = _batch_messages([large] * 5)
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+
+def test_messages_too_large_to_send_throw_error():
+
+    from aws import SQS_BATCH_MAX_BYTES, _batch_messages
+
+    with pytest.raises(ValueError, match='Message 0 is'):
+        _batch_messages(['x' * (SQS_BATCH_MAX_BYTES + 1), 'small'])
+
+
+def test_sender_faults_are_not_retried():
+
+    import aws
+
+    class FakeSqsClient:
+        calls = []
+
+        def send_message_batch(self, QueueUrl, Entries):
+            self.calls.append(Entries)
+            return {'Failed': [
+                {'Id': '0', 'Code': 'InvalidMessageContents', 'SenderFault': True},
+                {'Id': '1', 'Code': 'InternalError', 'SenderFault': False}
+            ]}
+
+    with patch.object(aws, 'get_client', lambda service: FakeSqsClient()), \
+            patch('time.sleep'), \
+            pytest.raises(RuntimeError, match='0: InvalidMessageContents'):
+        aws._send_batch('queue', [('0', 'bad'), ('1', 'good')])
+
+    assert len(FakeSqsClient.calls) == 1
+
+
+@mock_sqs
+def test_batched_messages_are_all_sent():
+
+    from aws import send_batch_to_queue
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    send_batch_to_queue(queue.url, [f'package-{i}' for i in range(25)])
+
+    received = []
+    while messages := queue.receive_messages(MaxNumberOfMessages=10):
+        received.extend(m.body for m in messages)
+    assert sorted(received) == sorted(f'package-{i}' for i in range(25))
+
+
+class FakeEcsClient:
+    """ Fake ECS client starting every task requested """
+
+    def __init__(self, task_statuses=()):
+        self.run_task_calls = []
+        self.task_statuses = list(task_statuses)
+
+    def run_task(self, **kwargs):
+        self.run_task_calls.append(kwargs)
+        return {'tasks': [{}] * kwargs['count'], 'failures': []}
+
+    def get_paginator(self, operation):
+        arns = [f'arn:task/{i}' for i in range(len(self.task_statuses))]
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                for i in range(0, len(arns), 100):
+                    yield {'taskArns': arns[i:i + 100]}
+
+        return Paginator()
+
+    def describe_tasks(self, cluster, tasks):
+        assert len(tasks) <= 100
+        return {'tasks': [{'lastStatus': self.task_statuses[int(x.split('/')[-1])]}
+                          for x in tasks]}
+
+
+def test_large_task_counts_are_split_between_run_task_calls():
+
+    import aws
+
+    client = FakeEcsClient()
+    with patch.object(aws, 'get_client', lambda service: client):
+        assert aws.start_ecs_task('cluster', 'task', count=23) == 23
+
+    assert [x['count'] for x in client.run_task_calls] == [10, 10, 3]
+
+
+def test_task_counts_include_every_page():
+
+    import aws
+
+    client = FakeEcsClient(['RUNNING'] * 150 + ['PENDING'] * 60 + ['PROVISIONING'])
+    with patch.object(aws, 'get_client', lambda service: client):
+        assert aws.get_task_counts('cluster', 'family') == {
+            'RUNNING': 150, 'PENDING': 60, 'PROVISIONING': 1}
+        assert aws.get_running_task_count('cluster', 'family') == 211
+
+
+def test_untagged_task_counts_leave_out_tagged_tasks():
+
+    import aws
+
+    client = FakeEcsClient(['RUNNING', 'RUNNING', 'PENDING', 'RUNNING'])
+    started_by = [None, 'pkg-builder-default', 'ecs-svc/123', 'pkg-builder-long']
+    describe_tasks = client.describe_tasks
+
+    def describe_with_tags(cluster, tasks):
+        response = describe_tasks(cluster, tasks)
+        for arn, task in zip(tasks, response['tasks']):
+            if started_by[int(arn.split('/')[-1])]:
+                task['startedBy'] = started_by[int(arn.split('/')[-1])]
+        return response
+
+    client.describe_tasks = describe_with_tags
+    with patch.object(aws, 'get_client', lambda service: client):
+        assert aws.get_untagged_task_counts('cluster', 'family', 'pkg-builder-') == {
+            'RUNNING': 1, 'PENDING': 1}
+
+
+@mock_sqs
+def test_queue_depth_counts_waiting_messages():
+
+    from aws import get_queue_depth, send_batch_to_queue
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    queue = sqs.create_queue(QueueName="BuildQueue")
+
+    send_batch_to_queue(queue.url, [f'package-{i}' for i in range(12)])
+    queue.receive_messages(MaxNumberOfMessages=2)
+    assert get_queue_depth(queue.url) == 10
@@ -0,0 +1,54 @@
+import os
+import pytest
+import sys
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "tests"))
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+from test_common import build_history_table, dynamodb_table
+
+
+def _build(name, status, fanout_id, **metrics):
+    return dict({'PackageName': name, 'BuildStatus': status,
+                 'FanoutId': fanout_id}, **metrics)
+
+
+def test_builds_are_recorded_once_per_fanout(build_history_table):
+
+    from build_history import get_build_history, record_build
+
+    assert record_build(build_history_table, _build(
+        'chromium', 'Complete', 'fanout-1',
+        BuildDuration=14400.5, PeakMemory=7000, ArtifactSize=123456789))
+    assert not record_build(build_history_table, _build(
+        'chromium', 'Complete', 'fanout-1', BuildDuration=1))
+    assert record_build(build_history_table, _build(
+        'chromium', 'Failed', 'fanout-2', PeakMemory=7500))
+
+    history = get_build_history(build_history_table, ['chromium', 'unknown'])
+    assert list(history) == ['chromium']
+    assert history['chromium']['LastStatus'] == 'Failed'
+    assert float(history['chromium']['LastDuration']) == 14400.5
+    assert history['chromium']['PeakMemory'] == 7500
+    assert history['chromium']['ArtifactSize'] == 123456789
+    assert history['chromium']['Builds'] == 2
+    assert history['chromium']['Failures'] == 1
+
+
+@pytest.mark.parametrize('history,expected', [
+    (None, 'large'),
+    ({'LastStatus': 'Complete'}, 'large'),
+    ({'LastStatus': 'Complete', 'PeakMemory': 300, 'LastDuration': 60}, 'small'),
+    ({'LastStatus': 'Complete', 'PeakMemory': 2000, 'LastDuration': 60}, 'medium'),
+    ({'LastStatus': 'Complete', 'PeakMemory': 300, 'LastDuration': 7200}, 'medium'),
+    ({'LastStatus': 'Complete', 'PeakMemory': 7000, 'LastDuration': 60}, 'large'),
+    ({'LastStatus': 'Failed', 'PeakMemory': 300, 'LastDuration': 60}, 'large'),
+])
+def test_task_size_fits_peak_memory(history, expected):
+
+    from build_history import TASK_SIZES, get_task_size
+
+    assert TASK_SIZES[get_task_size(history)]['name'] == expected
@@ -0,0 +1,128 @@
+import boto3
+import json
+import os
+import sys
+
+from mock import patch
+from moto import mock_sqs
+from urllib.parse import urlparse, parse_qs
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "dependency_resolver"))
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+AUR_RPC = "https://aur.archlinux.org/rpc/"
+
+TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/sqs-template.json')
+INPUTS = {
+    'master_test': 'tests/inputs/dependency_resolver/master_test.json',
+    'aur_info': 'tests/inputs/dependency_resolver/aur_info.json',
+}
+
+
+def get_input(input_name):
+    input_location = INPUTS[input_name]
+    filename = os.path.join(ROOT_PATH, input_location)
+
+    with open(TEMPLATE, 'r') as f:
+        output = json.loads(f.read())
+
+    with open(filename, 'r') as f:
+        data = f.read()
+        for record in output["Records"]:
+            record['body'] = data
+
+    return output
+
+
+class AurRpcMock:
+    """ Mock of urlopen returning only the requested AUR packages """
+
+    requests = []
+
+    def __init__(self, url):
+        self.url = url
+        AurRpcMock.requests.append(url)
+
+    def __enter__(self):
+        if not self.url.startswith(AUR_RPC):
+            raise Exception(self.url)
+        return self
+
+    def read(self):
+        names = parse_qs(urlparse(self.url).query)['arg[]']
+        with open(os.path.join(ROOT_PATH, INPUTS['aur_info']), 'r') as f:
+            data = json.loads(f.read())
+        data['results'] = [x for x in data['results'] if x['Name'] in names]
+        return json.dumps(data).encode()
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_aur_dependencies_are_resolved_transitively():
+
+    from dependency_resolver.resolve_dependencies import get_aur_packages
+    from dependency_resolver.resolve_dependencies import get_dependency_graph
+
+    AurRpcMock.requests = []
+    aur_packages = get_aur_packages(['bash', 'vim', 'pwndbg', 'ghidra-bin>=9'])
+    graph = get_dependency_graph(aur_packages)
+
+    assert graph == {
+        'pwndbg': ['python-capstone', 'python-unicorn'],
+        'ghidra-bin': [],
+        'python-capstone': [],
+        'python-unicorn': ['unicorn-lib'],
+        'unicorn-lib': ['python-capstone'],
+    }
+
+    # One request per level of the dependency tree
+    assert len(AurRpcMock.requests) == 4
+
+
+@mock_sqs
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_transitive_dependencies_are_sent_to_starter():
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    new_queue = sqs.create_queue(QueueName="FanoutStarterQueue")
+
+    os.environ["NEXT_QUEUE"] = new_queue.url
+    from dependency_resolver.resolve_dependencies import lambda_handler
+
+    with patch('dependency_resolver.resolve_dependencies.NEXT_QUEUE', new_queue.url):
+        resp = lambda_handler(get_input('master_test'), None)
+    assert resp['statusCode'] == 200
+
+    messages = new_queue.receive_messages()
+    assert len(messages) == 1
+    body = json.loads(messages[0].body)
+
+    assert body['dependencies'] == [
+        "bash", "vim", "couldinho-base", "pwndbg", "ghidra-bin>=9",
+        "python-capstone", "python-unicorn", "unicorn-lib"]
+    assert body['graph']['python-unicorn'] == ['unicorn-lib']
+    assert body['git_branch'] == 'master'
+    assert body['versions']['pwndbg'] == '2022.01.05-1'
+    assert 'bash' not in body['versions']
+
+
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_sources_of_each_package_are_hashed():
+
+    from dependency_resolver.resolve_dependencies import run
+
+    body = json.loads(run(get_input('master_test')['Records'][0]['body']))
+
+    assert set(body['sources']) == set(body['versions'])
+    unicorn = body['sources']['python-unicorn']
+    assert unicorn['PackageBase'] == 'unicorn'
+    assert unicorn['Version'] == '1.0.3-1'
+    assert len(unicorn['SourceHash']) == 64
+
+    # Split packages from the same base have different dependencies
+    assert unicorn['SourceHash'] != body['sources']['unicorn-lib']['SourceHash']
@@ -7,14 +7,21 @@ import os
 import pytest
 import sys
 
+from mock import patch
 from moto import mock_sqs, mock_sts, mock_dynamodb
 
 # Get the root path of the project to allow importing
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "tests"))
 sys.path.append(os.path.join(ROOT_PATH, "fanout_controller"))
+sys.path.append(os.path.join(ROOT_PATH, "pkgbuild_retriever"))
 sys.path.append(os.path.join(ROOT_PATH, "src/python"))
 
+from test_common import artifact_cache_table, build_history_table
+from test_common import pkgbuild_cache_table
+
+FANOUT_ID = 'test-fanout'
 TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/sqs-template.json')
 INPUTS = {
     'initialized_package': 'tests/inputs/fanout_controller/initialized_package.json',
@@ -52,9 +59,13 @@ def dynamodb_table():
         client.create_table(
             TableName=package_name,
             AttributeDefinitions=[
+                {'AttributeName': 'FanoutId', 'AttributeType': 'S'},
                 {'AttributeName': 'PackageName', 'AttributeType': 'S'}
             ],
-            KeySchema=[{"KeyType": "HASH", "AttributeName": "PackageName"}],
+            KeySchema=[
+                {"KeyType": "HASH", "AttributeName": "FanoutId"},
+                {"KeyType": "RANGE", "AttributeName": "PackageName"}
+            ],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 5,
                 'WriteCapacityUnits': 5
@@ -70,6 +81,7 @@ def test_fanout_status_table_gets_updated_with_regular_package(dynamodb_table):
 
     # The item which should be in the table after running the function
     package_check = {
+        "FanoutId": FANOUT_ID,
         "PackageName": "mce-dev",
         "BuildStatus": "Initialized",
         "IsMeta": False,
@@ -133,7 +145,7 @@ def test_status_table_gets_cleared_on_completion(dynamodb_table):
 
     # Add a test item to the status table
     dynamodb_table.update_item(
-        Key={'PackageName': 'GIT_REPO'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'GIT_REPO'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Complete",
@@ -168,25 +180,27 @@ def test_metapackage_gets_built_after_other_packages(dynamodb_table):
     queue_output = {
         "git_branch": "dev",
         "git_url": "https://raw.githubusercontent.com/test_user/master/pkg/PKGBUILD",
-        "repo": "couldinho-test"
+        "repo": "couldinho-test",
+        "fanout_id": FANOUT_ID
     }
 
     # Add a test item to the status table
     dynamodb_table.update_item(
-        Key={'PackageName': 'GIT_REPO'},
-        UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, GitBranch = :b",
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'GIT_REPO'},
+        UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, GitBranch = :b, Pending = :p",
         ExpressionAttributeValues={
             ':s': "Initialized",
             ':m': True,
             ':g': "https://raw.githubusercontent.com/test_user/master/pkg/PKGBUILD",
             ':r': "couldinho-test",
-            ':b': "dev"
+            ':b': "dev",
+            ':p': 1
         }
     )
 
     # Add the package currently building
     dynamodb_table.update_item(
-        Key={'PackageName': 'mce-dev'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'mce-dev'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r, GitBranch = :b",
         ExpressionAttributeValues={
             ':s': "Building",
@@ -221,7 +235,7 @@ def test_no_metapackage_build_when_packages_still_building(dynamodb_table):
 
     # Add a test item to the status table
     dynamodb_table.update_item(
-        Key={'PackageName': 'GIT_REPO'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'GIT_REPO'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Initialized",
@@ -233,7 +247,7 @@ def test_no_metapackage_build_when_packages_still_building(dynamodb_table):
 
     # Add a different package than the one being sent in the message
     dynamodb_table.update_item(
-        Key={'PackageName': 'random-package'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'random-package'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Building",
@@ -267,7 +281,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add a test item to the status table
     dynamodb_table.update_item(
-        Key={'PackageName': 'GIT_REPO'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'GIT_REPO'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Initialized",
@@ -279,7 +293,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add a different package than the one being sent in the message
     dynamodb_table.update_item(
-        Key={'PackageName': 'random-package'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'random-package'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Building",
@@ -291,7 +305,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add the package that is going to fail
     dynamodb_table.update_item(
-        Key={'PackageName': 'mce-dev'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'mce-dev'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Building",
@@ -322,3 +336,562 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
     assert len(data['Items']) == 2
     assert 'mce-dev' not in [i['PackageName'] for i in data['Items']]
 
+
+
+def _put_package(table, name, status, depends_on=None, dependents=None,
+                 pending=0, fanout_id=FANOUT_ID):
+    item = {
+        'FanoutId': fanout_id,
+        'PackageName': name,
+        'BuildStatus': status,
+        'IsMeta': name == 'GIT_REPO',
+        'repo': 'couldinho-test'
+    }
+    if name == 'GIT_REPO':
+        item['GitUrl'] = "https://raw.githubusercontent.com/test_user/master/pkg/PKGBUILD"
+        item['GitBranch'] = "dev"
+        item['Pending'] = pending
+    if depends_on:
+        item['DependsOn'] = depends_on
+        item['Remaining'] = len(depends_on)
+    if dependents:
+        item['Dependents'] = dependents
+    table.put_item(Item=item)
+
+
+def _package_message(name, status):
+    message = get_input("completed_package")
+    body = json.loads(message['Records'][0]['body'])
+    body.update({'PackageName': name, 'BuildStatus': status})
+    message['Records'][0]['body'] = json.dumps(body)
+    return message
+
+
+@mock_sqs
+def test_waiting_packages_are_built_once_dependencies_complete(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=4)
+    _put_package(dynamodb_table, 'mce-dev', 'Building',
+                 dependents=['needs-both', 'needs-mce'])
+    _put_package(dynamodb_table, 'extra-pkg', 'Building',
+                 dependents=['needs-both'])
+    _put_package(dynamodb_table, 'needs-mce', 'Waiting', ['mce-dev'])
+    _put_package(dynamodb_table, 'needs-both', 'Waiting', ['mce-dev', 'extra-pkg'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        res = controller.lambda_handler(get_input("completed_package"), None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+
+    messages = build_function_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body) for m in messages] == [
+        {'PackageName': 'needs-mce', 'Repo': 'couldinho-test', 'FanoutId': FANOUT_ID}]
+
+    items = {x['PackageName']: x for x in dynamodb_table.scan()['Items']}
+    assert items['needs-mce']['BuildStatus'] == 'Building'
+    assert items['needs-both']['BuildStatus'] == 'Waiting'
+    assert items['needs-both']['Remaining'] == 1
+    assert items['GIT_REPO']['Pending'] == 3
+
+
+@mock_sqs
+def test_failed_dependencies_fail_waiting_packages(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=3)
+    _put_package(dynamodb_table, 'mce-dev', 'Building', dependents=['needs-mce'])
+    _put_package(dynamodb_table, 'needs-mce', 'Waiting', ['mce-dev'],
+                 dependents=['needs-needs-mce'])
+    _put_package(dynamodb_table, 'needs-needs-mce', 'Waiting', ['needs-mce'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        res = controller.lambda_handler(get_input("failed_package"), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+
+    # Every package depending on the failure is removed without being built
+    assert build_function_queue.receive_messages(MaxNumberOfMessages=10) == []
+    assert len(metapackage_queue.receive_messages(MaxNumberOfMessages=10)) == 1
+    assert [x['PackageName'] for x in dynamodb_table.scan()['Items']] == ['GIT_REPO']
+
+
+@mock_sqs
+def test_failure_cascades_to_dependents_stored_after_it(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=2)
+    _put_package(dynamodb_table, 'needs-mce', 'Waiting', ['mce-dev'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    # The package fails before the message carrying its dependents arrives
+    building = get_input("building_package")
+    body = json.loads(building['Records'][0]['body'])
+    body['Dependents'] = ['needs-mce']
+    building['Records'][0]['body'] = json.dumps(body)
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        res = controller.lambda_handler(get_input("failed_package"), None)
+        assert json.loads(res['body']) == {"status": "Items are still running"}
+        res = controller.lambda_handler(building, None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+
+    assert build_function_queue.receive_messages(MaxNumberOfMessages=10) == []
+    assert len(metapackage_queue.receive_messages(MaxNumberOfMessages=10)) == 1
+    assert [x['PackageName'] for x in dynamodb_table.scan()['Items']] == ['GIT_REPO']
+
+
+@mock_sqs
+def test_metapackage_is_only_built_once(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=2)
+    _put_package(dynamodb_table, 'mce-dev', 'Building')
+    _put_package(dynamodb_table, 'extra-pkg', 'Building')
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller.controller import lambda_handler
+
+    # Redelivered messages aren't counted twice
+    lambda_handler(_package_message('mce-dev', 'Complete'), None)
+    res = lambda_handler(_package_message('mce-dev', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+    assert metapackage_queue.receive_messages(MaxNumberOfMessages=10) == []
+
+    res = lambda_handler(_package_message('extra-pkg', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+    res = lambda_handler(_package_message('extra-pkg', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+
+    assert len(metapackage_queue.receive_messages(MaxNumberOfMessages=10)) == 1
+
+
+@mock_sqs
+def test_packages_finishing_before_fanout_starts(dynamodb_table):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller.controller import lambda_handler
+
+    res = lambda_handler(get_input("completed_package"), None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+
+    message = get_input("metapackage")
+    body = json.loads(message['Records'][0]['body'])
+    body['PackageCount'] = 1
+    message['Records'][0]['body'] = json.dumps(body)
+
+    res = lambda_handler(message, None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+    assert len(metapackage_queue.receive_messages(MaxNumberOfMessages=10)) == 1
+
+
+@mock_sqs
+def test_separate_fanouts_do_not_interfere(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=1)
+    _put_package(dynamodb_table, 'mce-dev', 'Complete')
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=1,
+                 fanout_id='other-fanout')
+    _put_package(dynamodb_table, 'mce-dev', 'Building',
+                 fanout_id='other-fanout')
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller.controller import lambda_handler
+
+    # Completing the package in one fanout leaves the other still building
+    res = lambda_handler(_package_message('mce-dev', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+
+    res = lambda_handler(get_input("complete-dev"), None)
+    assert res['statusCode'] == 200
+
+    items = dynamodb_table.scan()['Items']
+    assert {(x['FanoutId'], x['PackageName']) for x in items} == {
+        ('other-fanout', 'GIT_REPO'), ('other-fanout', 'mce-dev')}
+    assert {x['BuildStatus'] for x in items} == {'Initialized', 'Building'}
+
+
+@mock_sqs
+def test_batch_of_messages_is_handled_together(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=3)
+    _put_package(dynamodb_table, 'mce-dev', 'Building', dependents=['needs-both'])
+    _put_package(dynamodb_table, 'extra-pkg', 'Building', dependents=['needs-both'])
+    _put_package(dynamodb_table, 'needs-both', 'Waiting', ['mce-dev', 'extra-pkg'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    # Both dependencies finish within the same batch, along with a
+    # redelivered message and one which can't be parsed
+    records = [_package_message('mce-dev', 'Complete')['Records'][0],
+               _package_message('extra-pkg', 'Complete')['Records'][0],
+               _package_message('mce-dev', 'Complete')['Records'][0],
+               dict(_package_message('mce-dev', 'Complete')['Records'][0],
+                    body='not json')]
+    for i, record in enumerate(records):
+        record['messageId'] = f"message-{i}"
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        res = controller.lambda_handler({'Records': records}, None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+    assert res['batchItemFailures'] == [{'itemIdentifier': 'message-3'}]
+
+    messages = build_function_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body)['PackageName'] for m in messages] == ['needs-both']
+
+    items = {x['PackageName']: x for x in dynamodb_table.scan()['Items']}
+    assert items['mce-dev']['BuildStatus'] == 'Complete'
+    assert items['mce-dev']['Dependents'] == ['needs-both']
+    assert items['extra-pkg']['BuildStatus'] == 'Complete'
+    assert items['GIT_REPO']['Pending'] == 1
+    assert items['GIT_REPO']['CompletePackages'] == {'mce-dev', 'extra-pkg'}
+
+    # The metapackage is built once the last package finishes
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        res = controller.lambda_handler(_package_message('needs-both', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+    assert res['batchItemFailures'] == []
+    assert len(metapackage_queue.receive_messages(MaxNumberOfMessages=10)) == 1
+
+
+@mock_sqs
+def test_redelivered_message_in_batch_does_not_release_dependents(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=4)
+    for name in ['a', 'b', 'c']:
+        _put_package(dynamodb_table, name, 'Building', dependents=['w'])
+    _put_package(dynamodb_table, 'w', 'Waiting', ['a', 'b', 'c'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    # The message built for a is redelivered alongside the one for b
+    records = [_package_message('a', 'Complete')['Records'][0],
+               _package_message('b', 'Complete')['Records'][0]]
+    for i, record in enumerate(records):
+        record['messageId'] = f"message-{i}"
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        controller.lambda_handler(_package_message('a', 'Complete'), None)
+        res = controller.lambda_handler({'Records': records}, None)
+    assert json.loads(res['body']) == {"status": "Items are still running"}
+
+    # w is still waiting on c
+    assert build_function_queue.receive_messages(MaxNumberOfMessages=10) == []
+    item = dynamodb_table.get_item(
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'w'})['Item']
+    assert item['BuildStatus'] == 'Waiting'
+    assert item['Remaining'] == 1
+
+
+@mock_sqs
+@pytest.mark.parametrize('input_name', ['completed_package', 'complete-dev'])
+def test_messages_without_fanout_id_are_rejected(dynamodb_table, input_name):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=1)
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller.controller import lambda_handler
+
+    message = get_input(input_name)
+    body = json.loads(message['Records'][0]['body'])
+    del body['FanoutId']
+    message['Records'][0]['body'] = json.dumps(body)
+
+    res = lambda_handler(message, None)
+    assert res['batchItemFailures'] == [
+        {'itemIdentifier': message['Records'][0]['messageId']}]
+    assert package_update_queue.receive_messages(MaxNumberOfMessages=10) == []
+    assert len(dynamodb_table.scan()['Items']) == 1
+
+
+@mock_sqs
+def test_finished_fanouts_expire_when_ttl_is_set(dynamodb_table):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    with patch.object(controller, 'FANOUT_TTL', 3600):
+        controller.lambda_handler(get_input("building_package"), None)
+        controller.lambda_handler(get_input("completed_package"), None)
+
+        items = dynamodb_table.scan()['Items']
+        assert {x['PackageName'] for x in items} == {'GIT_REPO', 'mce-dev'}
+        assert all(x['ExpiresAt'] > 0 for x in items)
+
+        # The fanout is left in place for DynamoDB to expire
+        controller.lambda_handler(get_input("complete-dev"), None)
+        assert len(dynamodb_table.scan()['Items']) == 2
+
+
+def _build_fanout(controller, fanout_table, pkgbuild_hash, status):
+    """ Runs a fanout of a single package until the metapackage is built """
+
+    _put_package(fanout_table, 'mce-dev', 'Building')
+
+    message = get_input("metapackage")
+    body = json.loads(message['Records'][0]['body'])
+    body.update({'PackageCount': 1, 'GitBranch': 'dev', 'PkgbuildHash': pkgbuild_hash})
+    message['Records'][0]['body'] = json.dumps(body)
+
+    controller.lambda_handler(message, None)
+    res = controller.lambda_handler(_package_message('mce-dev', status), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+    return body
+
+
+@mock_sqs
+@pytest.mark.parametrize('status,succeeded', [('Complete', True), ('Failed', False)])
+def test_pkgbuild_is_cached_once_fanout_completes(dynamodb_table, pkgbuild_cache_table,
+                                                  status, succeeded):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    with patch.object(controller, 'PKGBUILD_CACHE', pkgbuild_cache_table.table_name):
+        body = _build_fanout(controller, dynamodb_table, 'abc123', status)
+
+        # Nothing is cached until the metapackage has been built
+        assert pkgbuild_cache_table.scan()['Items'] == []
+        controller.lambda_handler(get_input("complete-dev"), None)
+
+    items = pkgbuild_cache_table.scan()['Items']
+    assert len(items) == 1
+    assert items[0]['GitUrl'] == body['GitUrl']
+    assert items[0]['GitBranch'] == body['GitBranch']
+    assert items[0]['PkgbuildHash'] == 'abc123'
+    assert items[0]['Succeeded'] is succeeded
+
+
+@mock_sqs
+def test_reverted_pkgbuilds_are_rebuilt_after_a_failed_fanout(dynamodb_table,
+                                                              pkgbuild_cache_table):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    # The retriever reads its settings on import, so it's unloaded afterwards
+    # for its own tests to import it with theirs
+    with patch.dict(sys.modules), \
+            patch.object(controller, 'PKGBUILD_CACHE', pkgbuild_cache_table.table_name):
+        from pkgbuild_retriever.retrieve_pkgbuild import is_cached
+
+        def complete(pkgbuild_hash, status):
+            body = _build_fanout(controller, dynamodb_table, pkgbuild_hash, status)
+            controller.lambda_handler(get_input("complete-dev"), None)
+            return body['GitUrl'], body['GitBranch']
+
+        with patch('pkgbuild_retriever.retrieve_pkgbuild.PKGBUILD_CACHE',
+                   pkgbuild_cache_table.table_name):
+            git_url, branch = complete('hash-a', 'Complete')
+            assert is_cached(git_url, branch, 'hash-a')
+
+            # The partially built fanout replaced the metapackage built from A
+            complete('hash-b', 'Failed')
+            assert not is_cached(git_url, branch, 'hash-b')
+
+            # So reverting to A builds it again
+            assert not is_cached(git_url, branch, 'hash-a')
+
+
+@mock_sqs
+def test_build_metrics_are_recorded_in_the_build_history(dynamodb_table,
+                                                        build_history_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=2)
+    _put_package(dynamodb_table, 'mce-dev', 'Building')
+    _put_package(dynamodb_table, 'extra-pkg', 'Building')
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    complete = _package_message('mce-dev', 'Complete')
+    body = json.loads(complete['Records'][0]['body'])
+    body.update({'BuildDuration': 95, 'PeakMemory': 512, 'ArtifactSize': 2048})
+    complete['Records'][0]['body'] = json.dumps(body)
+
+    with patch.object(controller, 'BUILD_HISTORY', build_history_table.table_name):
+        controller.lambda_handler(complete, None)
+        controller.lambda_handler(complete, None)
+        controller.lambda_handler(_package_message('extra-pkg', 'Failed'), None)
+
+    items = {x['PackageName']: x for x in build_history_table.scan()['Items']}
+    assert items['mce-dev']['LastStatus'] == 'Complete'
+    assert items['mce-dev']['LastDuration'] == 95
+    assert items['mce-dev']['PeakMemory'] == 512
+    assert items['mce-dev']['ArtifactSize'] == 2048
+    assert items['mce-dev']['Builds'] == 1
+    assert items['extra-pkg']['LastStatus'] == 'Failed'
+    assert items['extra-pkg']['Failures'] == 1
+
+
+@mock_sqs
+def test_released_packages_keep_their_lane(dynamodb_table):
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=2)
+    _put_package(dynamodb_table, 'mce-dev', 'Building', dependents=['needs-mce'])
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    waiting = _package_message('needs-mce', 'Waiting')
+    body = json.loads(waiting['Records'][0]['body'])
+    body.update({'DependsOn': ['mce-dev'], 'Lane': 'Long'})
+    waiting['Records'][0]['body'] = json.dumps(body)
+
+    with patch.object(controller, 'BUILD_FUNCTION_QUEUE', build_function_queue.url):
+        controller.lambda_handler(waiting, None)
+        controller.lambda_handler(_package_message('mce-dev', 'Complete'), None)
+
+    messages = build_function_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body) for m in messages] == [{
+        'PackageName': 'needs-mce', 'Repo': 'couldinho-test',
+        'FanoutId': FANOUT_ID, 'Lane': 'Long'}]
+
+
+@mock_sqs
+def test_built_packages_are_added_to_the_artifact_cache(dynamodb_table,
+                                                       artifact_cache_table):
+
+
+    _put_package(dynamodb_table, 'GIT_REPO', 'Initialized', pending=2)
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    metapackage_queue = sqs.create_queue(QueueName="MetapackageQueue")
+    package_update_queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["METAPACKAGE_QUEUE"] = metapackage_queue.url
+    os.environ["PACKAGE_UPDATE_QUEUE"] = package_update_queue.url
+
+    from fanout_controller import controller
+
+    building = _package_message('mce-dev', 'Building')
+    body = json.loads(building['Records'][0]['body'])
+    body.update({'repo': 'couldinho-test', 'SourceKey': 'mce-dev/1.0-1/abc'})
+    building['Records'][0]['body'] = json.dumps(body)
+
+    promoted = _package_message('extra-pkg', 'Complete')
+    body = json.loads(promoted['Records'][0]['body'])
+    body.update({'repo': 'couldinho-test', 'Promoted': True})
+    promoted['Records'][0]['body'] = json.dumps(body)
+
+    with patch.object(controller, 'ARTIFACT_CACHE', artifact_cache_table.table_name):
+        controller.lambda_handler(building, None)
+        controller.lambda_handler(promoted, None)
+        res = controller.lambda_handler(
+            _package_message('mce-dev', 'Complete'), None)
+    assert json.loads(res['body']) == {"status": "All packages built"}
+
+    items = artifact_cache_table.scan()['Items']
+    assert len(items) == 1
+    assert items[0]['SourceKey'] == 'mce-dev/1.0-1/abc'
+    assert items[0]['PackageName'] == 'mce-dev'
+    assert items[0]['Buckets'] == {'couldinho-test'}
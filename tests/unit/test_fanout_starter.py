@@ -7,9 +7,7 @@ import os
 import pytest
 import sys
 
-from mock import patch
-from moto import mock_sqs, mock_sts, mock_dynamodb
-from urllib.parse import urlparse, parse_qs
+from moto import mock_s3, mock_sqs, mock_sts, mock_dynamodb
 
 # Get the root path of the project to allow importing
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
@@ -18,11 +16,10 @@ sys.path.append(os.path.join(ROOT_PATH, "tests"))
 sys.path.append(os.path.join(ROOT_PATH, "fanout_starter"))
 sys.path.append(os.path.join(ROOT_PATH, "src/python"))
 
-from test_common import dynamodb_table
+from test_common import artifact_cache_table, build_history_table, dynamodb_table
 
 PERSONAL_REPO = 'personal-prod'
 PERSONAL_REPO_DEV = 'personal-dev'
-OFFICIAL_PKG_API = "https://www.archlinux.org/packages/search/json"
 OFFICIAL_PKGS = ["bash", "linux", "vim", "zsh", "xorg-server"]
 
 TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/sqs-template.json')
@@ -31,8 +28,7 @@ INPUTS = {
     'dev_test': 'tests/inputs/fanout_starter/dev_test.json',
     'extra_pkg': 'tests/inputs/fanout_starter/extra_pkg.json',
     'no_build_pkg': 'tests/inputs/fanout_starter/no_build_pkg.json',
-    'official_api_vim': 'tests/inputs/fanout_starter/official_api_vim.json',
-    'official_api_empty': 'tests/inputs/fanout_starter/official_api_empty.json',
+    'dependency_graph': 'tests/inputs/fanout_starter/dependency_graph.json',
 }
 
 
@@ -51,39 +47,16 @@ def get_input(input_name):
     return output
 
 
-class UrlOpenMockContext:
-    """ Mock context for urlopen """
-
-    def __init__(self, *args, **kwargs):
-        self.url = args[0] if isinstance(args[0], str) \
-                   else args[0].get_full_url()
-
-    def __enter__(self, *args, **kwargs):
-        if self.url.startswith(OFFICIAL_PKG_API):
-            return self.parse_pkg_api()
-        else:
-            raise Exception(self.url)
-
-    def __exit__(self, *args, **kwargs):
-        pass
-
-    def parse_pkg_api(self):
-        qs = parse_qs(urlparse(self.url).query)
-        if 'name' not in qs:
-            raise Exception(f'"name" not in {self.url}')
-        if len(qs['name']) != 1:
-            raise Exception(f"More than one 'name' in {self.url}")
-
-        pkg = qs['name'][0]
-        if pkg in OFFICIAL_PKGS:
-            return open(INPUTS['official_api_vim'], 'rb')
-        else:
-            return open(INPUTS['official_api_empty'], 'rb')
+@pytest.fixture()
+def package_table(dynamodb_table):
+    """ Package table including an index of the official repositories """
+    for pkg in OFFICIAL_PKGS:
+        dynamodb_table.put_item(Item={'Repository': 'core', 'PackageName': pkg})
+    yield dynamodb_table
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_build_package_status_is_set_to_building(dynamodb_table):
+def test_build_package_status_is_set_to_building(package_table):
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
     fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
@@ -94,7 +67,6 @@ def test_build_package_status_is_set_to_building(dynamodb_table):
     os.environ["PACKAGE_TABLE"] = "package-table"
     os.environ["PERSONAL_REPO"] = PERSONAL_REPO
     os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
-    resp = dynamodb_table.scan()
 
     from fanout_starter.starter import lambda_handler
 
@@ -116,10 +88,14 @@ def test_build_package_status_is_set_to_building(dynamodb_table):
     assert mce_dev['BuildStatus'] == 'Building'
     assert metapkg['BuildStatus'] == 'Initialized'
 
+    # Both messages belong to the fanout run of the triggering message
+    fanout_id = message['Records'][0]['messageId']
+    assert mce_dev['FanoutId'] == fanout_id
+    assert metapkg['FanoutId'] == fanout_id
+
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_build_package_sends_message_to_build_function_queue(dynamodb_table):
+def test_build_package_sends_message_to_build_function_queue(package_table):
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
     fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
@@ -142,11 +118,11 @@ def test_build_package_sends_message_to_build_function_queue(dynamodb_table):
 
     assert mce_dev['PackageName'] == 'mce-dev'
     assert mce_dev['Repo'] == PERSONAL_REPO
+    assert mce_dev['FanoutId'] == message['Records'][0]['messageId']
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_two_packages_get_sent_to_build(dynamodb_table):
+def test_two_packages_get_sent_to_build(package_table):
 
     packages_to_test = ["mce-dev", "extra-pkg", "GIT_REPO"]
 
@@ -175,8 +151,7 @@ def test_two_packages_get_sent_to_build(dynamodb_table):
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_no_build_packages_builds_metapackage(dynamodb_table):
+def test_no_build_packages_builds_metapackage(package_table):
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
     fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
@@ -207,8 +182,7 @@ def test_no_build_packages_builds_metapackage(dynamodb_table):
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_dev_branch_uses_dev_repo(dynamodb_table):
+def test_dev_branch_uses_dev_repo(package_table):
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
     fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
@@ -245,8 +219,7 @@ def test_dev_branch_uses_dev_repo(dynamodb_table):
     assert metapkg['repo'] == PERSONAL_REPO_DEV
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_dev_branch_doesnt_use_prod_repo(dynamodb_table):
+def test_dev_branch_doesnt_use_prod_repo(package_table):
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
     fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
@@ -272,3 +245,265 @@ def test_dev_branch_doesnt_use_prod_repo(dynamodb_table):
     assert 'ida-free' in [pkg['PackageName'] for pkg in packages]
     assert 'GIT_REPO' in [pkg['PackageName'] for pkg in packages]
 
+
+@mock_sqs
+def test_packages_wait_for_their_dependencies(package_table):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_QUEUE"] = fanout_queue.url
+    os.environ["BUILD_FUNCTION_QUEUE"] = build_function_queue.url
+    os.environ["PACKAGE_TABLE"] = "package-table"
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter.starter import lambda_handler
+
+    message = get_input("dependency_graph")
+    lambda_handler(message, None)
+
+    messages = fanout_queue.receive_messages(MaxNumberOfMessages=10)
+    packages = {json.loads(m.body)['PackageName']: json.loads(m.body)
+                for m in messages}
+    assert set(packages) == {'mce-dev', 'extra-pkg', 'extra-pkg-lib', 'GIT_REPO'}
+
+    assert packages['extra-pkg-lib']['BuildStatus'] == 'Building'
+    assert 'DependsOn' not in packages['extra-pkg-lib']
+    assert packages['extra-pkg']['BuildStatus'] == 'Waiting'
+    assert packages['extra-pkg']['DependsOn'] == ['extra-pkg-lib']
+    assert packages['mce-dev']['BuildStatus'] == 'Waiting'
+    assert packages['mce-dev']['DependsOn'] == ['extra-pkg']
+    assert packages['extra-pkg-lib']['Dependents'] == ['extra-pkg']
+    assert packages['GIT_REPO']['PackageCount'] == 3
+
+    # Only the first layer is built straight away
+    messages = build_function_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body)['PackageName'] for m in messages] == ['extra-pkg-lib']
+
+
+def test_build_layers_handle_cycles():
+
+    from fanout_starter.starter import get_build_layers
+
+    graph = {'a': ['b'], 'b': ['a'], 'c': [], 'd': ['c', 'bash']}
+    layers = get_build_layers(['a', 'b', 'c', 'd'], graph)
+    assert layers == [['c'], ['d'], ['a', 'b']]
+
+
+def test_dependencies_satisfied_by_providers_are_not_built(package_table):
+
+    package_table.put_item(Item={
+        'Repository': 'core#provides',
+        'PackageName': 'sh',
+        'Providers': [{'Name': 'bash', 'Version': '5.1.016'}]
+    })
+    package_table.put_item(Item={
+        'Repository': 'core#provides',
+        'PackageName': 'java-runtime',
+        'Providers': [{'Name': 'jre11-openjdk', 'Version': '11'}]
+    })
+    package_table.put_item(Item={
+        'Repository': 'core#provides',
+        'PackageName': 'awk',
+        'Providers': [{'Name': 'gawk', 'Version': None}]
+    })
+
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter.starter import get_packages_to_build
+
+    deps = ['sh', 'java-runtime>=11', 'awk', 'awk>=5', 'java-runtime>=17',
+            'vim>=1', 'mce-dev']
+    to_build = get_packages_to_build(package_table, deps, 'prod')
+
+    # Unversioned providers can't satisfy versioned dependencies
+    assert set(to_build) == {'awk', 'java-runtime', 'mce-dev'}
+
+
+def test_outdated_packages_are_rebuilt(package_table):
+
+    package_table.put_item(Item={
+        'Repository': PERSONAL_REPO,
+        'PackageName': 'pwndbg',
+        'Version': '2022.01.05-1'
+    })
+    package_table.put_item(Item={
+        'Repository': PERSONAL_REPO,
+        'PackageName': 'ghidra-bin',
+        'Version': '1:10.1.4-1'
+    })
+
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter.starter import get_packages_to_build
+
+    # Packages without a version stored aren't rebuilt
+    deps = ['bash', 'pwndbg', 'ghidra-bin', 'ida-free']
+    aur_versions = {
+        'pwndbg': '2022.08.30-1',
+        'ghidra-bin': '10.2-1',
+        'ida-free': '8.0-1'
+    }
+    to_build = get_packages_to_build(package_table, deps, 'prod', aur_versions)
+    assert to_build == ['pwndbg']
+
+
+def test_long_builds_and_the_critical_path_use_the_long_lane():
+
+    from fanout_starter.starter import get_build_lanes
+
+    # a -> b -> c is the critical path, d is long on its own, e and f are quick
+    layers = [['a', 'd', 'e'], ['b', 'f'], ['c']]
+    depends_on = {'a': set(), 'd': set(), 'e': set(), 'b': {'a'},
+                  'f': {'e'}, 'c': {'b'}}
+    dependents = {'a': {'b'}, 'b': {'c'}, 'c': set(), 'd': set(),
+                  'e': {'f'}, 'f': set()}
+    durations = {'a': 1200, 'b': 600, 'c': 600, 'd': 1800, 'e': 60, 'f': 60}
+
+    lanes = get_build_lanes(layers, depends_on, dependents, durations)
+    assert lanes == {'a': 'Long', 'b': 'Long', 'c': 'Long', 'd': 'Long',
+                     'e': 'Default', 'f': 'Default'}
+
+    # Short critical paths don't need their own lane
+    durations = {'a': 60, 'b': 60, 'c': 60, 'd': 60, 'e': 60, 'f': 60}
+    lanes = get_build_lanes(layers, depends_on, dependents, durations)
+    assert set(lanes.values()) == {'Default'}
+
+    # Packages without any history are treated as quick
+    lanes = get_build_lanes(layers, depends_on, dependents, {})
+    assert set(lanes.values()) == {'Default'}
+
+
+@mock_sqs
+def test_lane_is_sent_with_each_package(package_table, build_history_table):
+
+    from mock import patch
+
+    build_history_table.put_item(Item={'PackageName': 'extra-pkg-lib',
+                                       'LastStatus': 'Complete',
+                                       'LastDuration': 7200})
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_QUEUE"] = fanout_queue.url
+    os.environ["BUILD_FUNCTION_QUEUE"] = build_function_queue.url
+    os.environ["PACKAGE_TABLE"] = "package-table"
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter import starter
+
+    with patch.object(starter, 'BUILD_HISTORY', build_history_table.table_name):
+        starter.lambda_handler(get_input("dependency_graph"), None)
+
+    messages = fanout_queue.receive_messages(MaxNumberOfMessages=10)
+    lanes = {json.loads(m.body)['PackageName']: json.loads(m.body).get('Lane')
+             for m in messages}
+
+    # Everything waiting on the long build is on the critical path
+    assert lanes == {'extra-pkg-lib': 'Long', 'extra-pkg': 'Long',
+                     'mce-dev': 'Long', 'GIT_REPO': None}
+
+    messages = build_function_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body)['Lane'] for m in messages] == ['Long']
+
+
+@mock_s3
+@mock_sqs
+def test_cached_builds_are_promoted_rather_than_built(package_table, artifact_cache_table):
+
+    from mock import patch
+    from artifact_cache import get_source_key
+
+    sources = {name: {'PackageBase': name, 'Version': '1.0-1', 'SourceHash': 'abc'}
+               for name in ['mce-dev', 'extra-pkg', 'extra-pkg-lib']}
+    for name in sources:
+        artifact_cache_table.put_item(Item={
+            'SourceKey': get_source_key(sources[name]),
+            'PackageName': name,
+            'Buckets': {PERSONAL_REPO_DEV}
+        })
+
+    s3 = boto3.client('s3')
+    for bucket in [PERSONAL_REPO, PERSONAL_REPO_DEV]:
+        s3.create_bucket(Bucket=bucket,
+                         CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    for name in sources:
+        for suffix in ['x86_64.pkg.tar.zst', 'x86_64.pkg.tar.zst.sig']:
+            s3.put_object(Bucket=PERSONAL_REPO_DEV, Body=b'pkg',
+                          Key=f"x86_64/{name}-1.0-1-{suffix}")
+    s3.put_object(Bucket=PERSONAL_REPO_DEV, Body=b'pkg',
+                  Key="x86_64/mce-dev-1.0-1-debug-1.0-1-x86_64.pkg.tar.zst")
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    fanout_queue = sqs.create_queue(QueueName="FanoutQueue")
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    os.environ["FANOUT_QUEUE"] = fanout_queue.url
+    os.environ["BUILD_FUNCTION_QUEUE"] = build_function_queue.url
+    os.environ["PACKAGE_TABLE"] = "package-table"
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter import starter
+
+    message = get_input("dependency_graph")
+    body = json.loads(message['Records'][0]['body'])
+    body['sources'] = sources
+    message['Records'][0]['body'] = json.dumps(body)
+
+    with patch.object(starter, 'ARTIFACT_CACHE', artifact_cache_table.table_name):
+        resp = starter.lambda_handler(message, None)
+
+    # Packages other packages depend on still need building, as the promoted
+    # packages aren't within the repository database yet
+    assert sorted(json.loads(resp['body'])['packages']) == ['extra-pkg', 'extra-pkg-lib']
+
+    keys = [x['Key'] for x in s3.list_objects_v2(Bucket=PERSONAL_REPO)['Contents']]
+    assert sorted(keys) == ['x86_64/mce-dev-1.0-1-x86_64.pkg.tar.zst',
+                            'x86_64/mce-dev-1.0-1-x86_64.pkg.tar.zst.sig']
+
+    messages = [json.loads(m.body)
+                for m in fanout_queue.receive_messages(MaxNumberOfMessages=10)]
+    states = {x['PackageName']: x for x in messages}
+    assert states['mce-dev']['BuildStatus'] == 'Complete'
+    assert states['mce-dev']['Promoted'] is True
+    assert states['extra-pkg']['SourceKey'] == 'extra-pkg/1.0-1/abc'
+    assert states['GIT_REPO']['PackageCount'] == 3
+
+    item = artifact_cache_table.get_item(Key={'SourceKey': 'mce-dev/1.0-1/abc',
+                                              'PackageName': 'mce-dev'})['Item']
+    assert item['Buckets'] == {PERSONAL_REPO, PERSONAL_REPO_DEV}
+
+
+@mock_s3
+@mock_sqs
+def test_missing_cached_builds_are_built(package_table, artifact_cache_table):
+
+    from mock import patch
+
+    sources = {'mce-dev': {'PackageBase': 'mce-dev', 'Version': '1.0-1',
+                           'SourceHash': 'abc'}}
+    artifact_cache_table.put_item(Item={'SourceKey': 'mce-dev/1.0-1/abc',
+                                        'PackageName': 'mce-dev',
+                                        'Buckets': {PERSONAL_REPO_DEV}})
+    for bucket in [PERSONAL_REPO, PERSONAL_REPO_DEV]:
+        boto3.client('s3').create_bucket(
+            Bucket=bucket,
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+
+    os.environ["PERSONAL_REPO"] = PERSONAL_REPO
+    os.environ["DEV_REPO"] = PERSONAL_REPO_DEV
+
+    from fanout_starter import starter
+
+    with patch.object(starter, 'ARTIFACT_CACHE', artifact_cache_table.table_name):
+        promoted = starter.promote_cached_packages(
+            ['mce-dev'], {}, sources, PERSONAL_REPO)
+    assert promoted == []
@@ -7,6 +7,7 @@ import os
 import pytest
 import sys
 
+from mock import patch
 from moto import mock_sqs, mock_sts, mock_dynamodb
 
 # Get the root path of the project to allow importing
@@ -15,6 +16,7 @@ sys.path.append(ROOT_PATH)
 sys.path.append(os.path.join(ROOT_PATH, "metapackage_builder"))
 sys.path.append(os.path.join(ROOT_PATH, "src/python"))
 
+FANOUT_ID = 'test-fanout'
 TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/sqs-template.json')
 INPUTS = {
     'metapackage': 'tests/inputs/metapackage_builder/metapackage.json',
@@ -46,9 +48,13 @@ def dynamodb_table():
         client.create_table(
             TableName=package_name,
             AttributeDefinitions=[
+                {'AttributeName': 'FanoutId', 'AttributeType': 'S'},
                 {'AttributeName': 'PackageName', 'AttributeType': 'S'}
             ],
-            KeySchema=[{"KeyType": "HASH", "AttributeName": "PackageName"}],
+            KeySchema=[
+                {"KeyType": "HASH", "AttributeName": "FanoutId"},
+                {"KeyType": "RANGE", "AttributeName": "PackageName"}
+            ],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 5,
                 'WriteCapacityUnits': 5
@@ -64,7 +70,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add a test item to the status table
     dynamodb_table.update_item(
-        Key={'PackageName': 'GIT_REPO'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'GIT_REPO'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Initialized",
@@ -76,7 +82,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add a different package than the one being sent in the message
     dynamodb_table.update_item(
-        Key={'PackageName': 'random-package'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'random-package'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Complete",
@@ -88,7 +94,7 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
 
     # Add the package that is going to fail
     dynamodb_table.update_item(
-        Key={'PackageName': 'mce-dev'},
+        Key={'FanoutId': FANOUT_ID, 'PackageName': 'mce-dev'},
         UpdateExpression="set BuildStatus = :s, IsMeta = :m, GitUrl = :g, repo = :r",
         ExpressionAttributeValues={
             ':s': "Complete",
@@ -120,5 +126,38 @@ def test_failed_packages_get_removed_from_table(dynamodb_table):
     assert msg['PackageName'] == 'GIT_REPO'
     assert msg['Repo'] == 'couldinho-test'
     assert msg['git_url'] == 'https://raw.githubusercontent.com/test_user/master/pkg/PKGBUILD'
+    assert msg['FanoutId'] == FANOUT_ID
     assert set(['random-package', 'mce-dev']) == set(msg['built_packages'])
 
+
+
+@mock_sqs
+def test_promoted_packages_are_added_to_the_repo_db_first(dynamodb_table):
+
+    for name, promoted in [('mce-dev', False), ('extra-pkg', True)]:
+        item = {'FanoutId': FANOUT_ID, 'PackageName': name,
+                'BuildStatus': 'Complete', 'IsMeta': False,
+                'repo': 'couldinho-test'}
+        if promoted:
+            item.update({'Promoted': True, 'Version': '1.0-1'})
+        dynamodb_table.put_item(Item=item)
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+    repo_db_queue = sqs.create_queue(QueueName="RepoDbQueue")
+
+    os.environ["FANOUT_STATUS"] = dynamodb_table.table_name
+    os.environ["BUILD_FUNCTION_QUEUE"] = build_function_queue.url
+
+    from metapackage_builder import metapackage
+
+    with patch.object(metapackage, 'REPO_DB_QUEUE', repo_db_queue.url):
+        metapackage.lambda_handler(get_input("metapackage"), None)
+
+    assert build_function_queue.receive_messages() == []
+
+    messages = repo_db_queue.receive_messages(MaxNumberOfMessages=10)
+    msg = json.loads(messages[0].body)
+    assert msg['bucket'] == 'couldinho-test'
+    assert msg['add'] == [{'PackageName': 'extra-pkg', 'Version': '1.0-1'}]
+    assert set(msg['build_event']['built_packages']) == {'mce-dev', 'extra-pkg'}
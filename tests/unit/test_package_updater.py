@@ -7,7 +7,7 @@ import sys
 from datetime import datetime
 from io import BytesIO
 from mock import patch
-from moto import mock_dynamodb2
+from moto import mock_dynamodb2, mock_sqs
 
 # Get the root path of the project to allow importing
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
@@ -16,7 +16,7 @@ sys.path.append(os.path.join(ROOT_PATH, "tests"))
 sys.path.append(os.path.join(ROOT_PATH, "package_updater"))
 sys.path.append(os.path.join(ROOT_PATH, "src/python"))
 
-from test_common import dynamodb_table, pkgcomp
+from test_common import dynamodb_table, mirror_state_table, pkgcomp
 
 PERSONAL_REPO = 'https://test-repo.s3.amazonaws.com'
 PERSONAL_REPO_DEV = 'https://test-repo-dev.s3.amazonaws.com'
@@ -43,6 +43,12 @@ def get_input(input_name):
     return output
 
 
+def get_package_items(table):
+    """ Get all packages within the table, excluding the provides indexes """
+    return [x for x in table.scan()['Items']
+            if not x['Repository'].endswith('#provides')]
+
+
 class UrlOpenMockContext:
     """ Mock context for urlopen """
 
@@ -63,7 +69,7 @@ class UrlOpenMockContext:
 
 
 @patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_packages_in_prod_repo_get_added_and_removed(dynamodb_table):
+def test_packages_in_prod_repo_get_added_and_removed(dynamodb_table, mirror_state_table):
 
     pre_packages = [
         {'Repository': 'personal-prod', 'PackageName': 'couldinho-base'},
@@ -97,12 +103,12 @@ def test_packages_in_prod_repo_get_added_and_removed(dynamodb_table):
     message = get_input("prod_test")
     lambda_handler(message, None)
 
-    packages = dynamodb_table.scan()
-    assert pkgcomp(packages['Items'], post_packages)
+    packages = get_package_items(dynamodb_table)
+    assert pkgcomp(packages, post_packages)
 
 
 @patch('urllib.request.urlopen', UrlOpenMockContext)
-def test_packages_in_dev_repo_get_added_and_removed(dynamodb_table):
+def test_packages_in_dev_repo_get_added_and_removed(dynamodb_table, mirror_state_table):
 
     pre_packages = [
         {'Repository': 'personal-prod', 'PackageName': 'couldinho-base'},
@@ -136,6 +142,266 @@ def test_packages_in_dev_repo_get_added_and_removed(dynamodb_table):
     message = get_input("dev_test")
     lambda_handler(message, None)
 
-    packages = dynamodb_table.scan()
-    assert pkgcomp(packages['Items'], post_packages)
+    packages = get_package_items(dynamodb_table)
+    assert pkgcomp(packages, post_packages)
+
+
+
+class NonSeekableStream:
+    """ A file-like object which can only be read forwards, like a socket """
+
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        return self.stream.readinto(b)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        pass
+
+    @property
+    def closed(self):
+        return False
+
+
+def test_archive_is_streamed_without_seeking():
+
+    import lzma
+    from zstandard import ZstdCompressor
+    from package_updater.arch_packages import _extract_archive_from_stream
+    from package_updater.arch_packages import iter_packages
+
+    filename = os.path.join(ROOT_PATH, 'tests/inputs/package_updater/not_zipped/core.db')
+    with open(filename, 'rb') as f:
+        data = f.read()
 
+    for compressed in [data, lzma.compress(data), ZstdCompressor().compress(data)]:
+        stream = NonSeekableStream(compressed)
+        with _extract_archive_from_stream(stream) as tar:
+            packages = [p.name for p in iter_packages(tar)]
+        assert 'bash' in packages
+        assert 'linux' in packages
+
+
+def test_every_frame_of_a_zstd_archive_is_read():
+
+    from zstandard import ZstdCompressor
+    from package_updater.arch_packages import _extract_archive_from_stream
+    from package_updater.arch_packages import _open_decompressed_stream
+    from package_updater.arch_packages import iter_packages
+
+    filename = os.path.join(ROOT_PATH, 'tests/inputs/package_updater/not_zipped/core.db')
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    # Split the archive on a block boundary, compressing each half separately
+    middle = len(data) // 1024 * 512
+    compressed = ZstdCompressor().compress(data[:middle]) + \
+        ZstdCompressor().compress(data[middle:])
+
+    decompressed = _open_decompressed_stream(NonSeekableStream(compressed))
+    assert decompressed.read(len(data)) == data
+
+    stream = NonSeekableStream(compressed)
+    with _extract_archive_from_stream(stream) as tar:
+        packages = [p.name for p in iter_packages(tar)]
+    with _extract_archive_from_stream(NonSeekableStream(data)) as tar:
+        assert packages == [p.name for p in iter_packages(tar)]
+
+
+def test_unknown_compression_format_throws_error():
+
+    from package_updater.arch_packages import _extract_archive_from_stream
+
+    stream = NonSeekableStream(b'BZh91AY&SY' + bytes(512))
+    with pytest.raises(ValueError):
+        _extract_archive_from_stream(stream)
+
+
+def test_desc_file_is_parsed_into_package_record():
+
+    from package_updater.arch_packages import get_packages
+
+    filename = os.path.join(ROOT_PATH, 'tests/inputs/package_updater/test-repo.db')
+    with patch('urllib.request.urlopen', lambda url: open(filename, 'rb')):
+        repo = get_packages({'repo': 'personal-prod', 'mirror': PERSONAL_REPO})
+
+    packages = {p.name: p for p in repo['packages']}
+    editor = packages['010editor']
+    assert editor.base == '010editor'
+    assert editor.version == '10.0.2-1'
+    assert editor.depends == ('libpng',)
+    assert editor.makedepends == ('fakechroot',)
+    assert editor.provides == ()
+    assert editor.csize == 16056484
+    assert editor.isize == 38309767
+    assert editor.builddate == 1589155302
+    assert editor.sha256sum == \
+        '7a4a1fe61626faf536778a0cc9c962ad28a8a6fa315a1ea7ed70ad3823932554'
+
+
+@patch('urllib.request.urlopen', UrlOpenMockContext)
+def test_unchanged_repo_db_is_not_written_twice(dynamodb_table, mirror_state_table):
+
+    os.environ['PACKAGE_TABLE'] = 'package-table'
+
+    from package_updater.update_packages import lambda_handler
+
+    message = get_input("prod_test")
+    lambda_handler(message, None)
+
+    # Remove a package so we can tell if the table has been written again
+    dynamodb_table.delete_item(
+        Key={'Repository': 'personal-prod', 'PackageName': 'vivaldi'})
+
+    resp = lambda_handler(message, None)
+    body = json.loads(resp['body'])
+    assert body['personal-prod'] == \
+        {'modified': False, 'new': 0, 'changed': 0, 'deleted': 0}
+
+    packages = [x['PackageName'] for x in get_package_items(dynamodb_table)]
+    assert 'vivaldi' not in packages
+
+    # The mirror state is kept out of the package table
+    state = mirror_state_table.get_item(Key={'Repository': 'personal-prod'})
+    assert state['Item']['Sha256']
+    assert {x['Repository'] for x in dynamodb_table.scan()['Items']} == \
+        {'personal-prod', 'personal-prod#provides', 'personal-dev'}
+
+
+@patch('urllib.request.urlopen', UrlOpenMockContext)
+def test_mirror_state_from_older_version_forces_sync(dynamodb_table, mirror_state_table):
+
+    os.environ['PACKAGE_TABLE'] = 'package-table'
+
+    from boto3.dynamodb.conditions import Key
+    from package_updater.update_packages import lambda_handler
+
+    message = get_input("prod_test")
+    lambda_handler(message, None)
+
+    # Mimic a DB synced before the provides index existed
+    provides = dynamodb_table.query(
+        KeyConditionExpression=Key('Repository').eq('personal-prod#provides'))
+    for item in provides['Items']:
+        dynamodb_table.delete_item(
+            Key={'Repository': item['Repository'], 'PackageName': item['PackageName']})
+    mirror_state_table.update_item(
+        Key={'Repository': 'personal-prod'},
+        UpdateExpression='REMOVE SchemaVersion')
+
+    resp = lambda_handler(message, None)
+    body = json.loads(resp['body'])
+    assert body['personal-prod']['modified']
+    assert body['personal-prod']['provides'] == len(provides['Items'])
+
+
+def test_not_modified_response_skips_parsing(dynamodb_table):
+
+    from urllib.error import HTTPError
+    from package_updater.arch_packages import get_packages
+
+    requests = []
+
+    def not_modified(request):
+        requests.append(request)
+        raise HTTPError(request.get_full_url(), 304, 'Not Modified', {}, None)
+
+    cache = {'etag': '"abcd"', 'last_modified': None, 'sha256': '1234'}
+    with patch('urllib.request.urlopen', not_modified):
+        repo = get_packages({'repo': 'personal-prod', 'mirror': PERSONAL_REPO}, cache)
+
+    assert not repo['modified']
+    assert repo['packages'] is None
+    assert requests[0].get_header('If-none-match') == '"abcd"'
+
+
+@patch('urllib.request.urlopen', UrlOpenMockContext)
+def test_only_package_differences_are_counted(dynamodb_table, mirror_state_table):
+
+    os.environ['PACKAGE_TABLE'] = 'package-table'
+
+    from package_updater.update_packages import lambda_handler
+
+    message = get_input("prod_test")
+    resp = lambda_handler(message, None)
+    body = json.loads(resp['body'])['personal-prod']
+
+    # couldinho-base exists without a version, and ida-free isn't in the DB
+    assert body['current'] == 2
+    assert body['new'] == 9
+    assert body['changed'] == 1
+    assert body['deleted'] == 1
+
+    item = dynamodb_table.get_item(
+        Key={'Repository': 'personal-prod', 'PackageName': '010editor'})
+    assert item['Item']['Version'] == '10.0.2-1'
+
+
+@mock_sqs
+def test_official_repositories_are_indexed_on_schedule(dynamodb_table, mirror_state_table):
+
+    import package_updater.update_packages as update_packages
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    queue = sqs.create_queue(QueueName="PackageUpdateQueue")
+
+    mirror = 'https://mirror.example.com/archlinux'
+    official_dbs = {
+        f'{mirror}/core/os/x86_64/core.db': 'zipped/core.db',
+        f'{mirror}/extra/os/x86_64/extra.db': 'zipped/extra.db',
+    }
+
+    def official_mirror(request):
+        filename = official_dbs[request.get_full_url()]
+        return open(os.path.join(ROOT_PATH, 'tests/inputs/package_updater', filename), 'rb')
+
+    with patch('urllib.request.urlopen', official_mirror), \
+            patch.object(update_packages, 'PACKAGE_TABLE', 'package-table'), \
+            patch.object(update_packages, 'OFFICIAL_REPOS', 'core,extra'), \
+            patch.object(update_packages, 'OFFICIAL_MIRROR', mirror), \
+            patch.object(update_packages, 'PACKAGE_UPDATE_QUEUE', queue.url):
+        resp = update_packages.lambda_handler({'detail-type': 'Scheduled Event'}, None)
+        assert json.loads(resp['body']) == {'queued': ['core', 'extra']}
+        assert not any(x['Repository'] in ('core', 'extra')
+                       for x in get_package_items(dynamodb_table))
+
+        # Each repository is synced by an invocation of its own
+        messages = queue.receive_messages(MaxNumberOfMessages=10)
+        assert len(messages) == 2
+        for message in messages:
+            resp = update_packages.lambda_handler(
+                {'Records': [{'body': message.body}]}, None)
+            assert resp['statusCode'] == 200
+
+    packages = get_package_items(dynamodb_table)
+    core = [x['PackageName'] for x in packages if x['Repository'] == 'core']
+    extra = [x['PackageName'] for x in packages if x['Repository'] == 'extra']
+    assert 'bash' in core
+    assert 'vim' in extra
+
+
+def test_provides_and_replaces_are_indexed():
+
+    from package_updater.arch_packages import parse_desc
+    from package_updater.update_packages import get_provides_index
+
+    bash = parse_desc('%NAME%\nbash\n\n%VERSION%\n5.1.016-1\n\n'
+                      '%PROVIDES%\nsh\n\n')
+    jre = parse_desc('%NAME%\njre11-openjdk\n\n%VERSION%\n11.0.15-1\n\n'
+                     '%PROVIDES%\njava-runtime=11\njre11=11\n\n'
+                     '%REPLACES%\njre11-old\n\n')
+
+    index = get_provides_index([bash, jre])
+    assert index['sh'] == [{'Name': 'bash', 'Version': None}]
+    assert index['java-runtime'] == [{'Name': 'jre11-openjdk', 'Version': '11'}]
+    assert index['jre11-old'] == [{'Name': 'jre11-openjdk', 'Version': None}]
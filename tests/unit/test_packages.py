@@ -0,0 +1,46 @@
+import os
+import pytest
+import sys
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+from packages import parse_dependency, satisfies, vercmp
+
+
+def test_versions_are_ordered_like_pacman():
+
+    ordered = ['1.0a', '1.0b', '1.0beta', '1.0p', '1.0pre', '1.0rc', '1.0',
+               '1.0.a', '1.0.1', '1.1', '2.0', '1:0.5']
+
+    for i, a in enumerate(ordered):
+        for j, b in enumerate(ordered):
+            assert vercmp(a, b) == (i > j) - (i < j), (a, b)
+
+
+def test_release_is_only_compared_when_both_have_one():
+
+    assert vercmp('1.0-1', '1.0-2') == -1
+    assert vercmp('1.0', '1.0-2') == 0
+    assert vercmp('1.0-10', '1.0-9') == 1
+
+
+def test_dependency_constraints_are_parsed():
+
+    assert parse_dependency('sh') == ('sh', None, None)
+    assert parse_dependency('foo>=1.2') == ('foo', '>=', '1.2')
+    assert parse_dependency('bar=2:1.0-1') == ('bar', '=', '2:1.0-1')
+
+    with pytest.raises(ValueError):
+        parse_dependency('>=1.0')
+
+
+def test_constraints_are_satisfied():
+
+    assert satisfies('1.2', None, None)
+    assert satisfies('1.2', '>=', '1.2')
+    assert not satisfies('1.1', '>=', '1.2')
+    assert satisfies('1.1', '<', '1.2')
+    assert not satisfies(None, '>=', '1.2')
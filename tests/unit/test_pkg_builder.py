@@ -0,0 +1,190 @@
+import json
+import os
+import pytest
+import sys
+
+from mock import patch
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "tests"))
+sys.path.append(os.path.join(ROOT_PATH, "pkg_builder"))
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+from test_common import build_history_table, dynamodb_table
+
+TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/sqs-template.json')
+
+os.environ.setdefault('MAX_TASK_COUNT', '10')
+
+
+@pytest.mark.parametrize('backlog,task_counts,packages_per_task,expected', [
+    # A burst of builds reaches full parallelism in one step
+    (100, {}, 1, 10),
+    # Running tasks have already taken their packages from the queue
+    (4, {'RUNNING': 3}, 1, 4),
+    # Pending tasks will build packages still in the queue
+    (4, {'RUNNING': 3, 'PENDING': 3}, 1, 1),
+    (4, {'PROVISIONING': 5}, 1, 0),
+    # Each task builds several packages
+    (9, {}, 4, 3),
+    # The maximum number of tasks is never exceeded
+    (20, {'RUNNING': 8, 'PENDING': 1}, 1, 1),
+    (20, {'RUNNING': 12}, 1, 0),
+])
+def test_enough_tasks_are_started_for_the_backlog(backlog, task_counts,
+                                                  packages_per_task, expected):
+
+    from pkg_builder import build_package
+
+    settings = {'max_tasks': 10, 'packages_per_task': packages_per_task}
+    assert build_package.get_tasks_to_start(backlog, task_counts, settings) == expected
+
+
+def test_every_task_needed_is_started_at_once():
+
+    from pkg_builder import build_package
+
+    with open(TEMPLATE, 'r') as f:
+        event = json.loads(f.read())
+    event['Records'] = [dict(event['Records'][0], body=json.dumps({'PackageName': f'pkg-{i}'}))
+                        for i in range(3)]
+
+    with patch.object(build_package, 'MAX_TASK_COUNT', 10), \
+            patch.object(build_package, 'send_batch_to_queue') as send, \
+            patch.object(build_package, 'get_queue_depth', return_value=0), \
+            patch.object(build_package, 'get_task_counts', return_value={}), \
+            patch.object(build_package, 'get_untagged_task_counts', return_value={}), \
+            patch.object(build_package, 'start_ecs_task') as start_ecs_task:
+        res = build_package.lambda_handler(event, None)
+
+    assert res['statusCode'] == 200
+    assert len(send.call_args[0][1]) == 3
+
+    # The queue depth may lag behind, so the batch itself is counted
+    assert start_ecs_task.call_count == 1
+    assert start_ecs_task.call_args[1]['count'] == 3
+
+
+def test_packages_are_only_built_on_tasks_sized_for_them(build_history_table):
+
+    from pkg_builder import build_package
+
+    for name, duration, memory in [('tiny', 30, 200), ('medium', 600, 1000),
+                                   ('big', 900, 1800)]:
+        build_history_table.put_item(Item={
+            'PackageName': name,
+            'LastStatus': 'Complete',
+            'LastDuration': duration,
+            'PeakMemory': memory
+        })
+
+    with open(TEMPLATE, 'r') as f:
+        event = json.loads(f.read())
+    event['Records'] = [dict(event['Records'][0], body=json.dumps({'PackageName': x}))
+                        for x in ['tiny', 'medium', 'big', 'new']]
+
+    task_counts = {
+        'pkg-builder-default': {},
+        'pkg-builder-default-small': {'RUNNING': 8},
+    }
+    with patch.object(build_package, 'MAX_TASK_COUNT', 10), \
+            patch.object(build_package, 'BUILD_HISTORY', build_history_table.table_name), \
+            patch.object(build_package, 'BUILD_QUEUE', 'build-queue'), \
+            patch.object(build_package, 'SMALL_BUILD_QUEUE', 'small-build-queue'), \
+            patch.object(build_package, 'MEDIUM_BUILD_QUEUE', None), \
+            patch.object(build_package, 'send_batch_to_queue') as send, \
+            patch.object(build_package, 'get_queue_depth', return_value=0), \
+            patch.object(build_package, 'get_task_counts',
+                         lambda cluster, started_by: task_counts[started_by]), \
+            patch.object(build_package, 'get_untagged_task_counts', return_value={}), \
+            patch.object(build_package, 'start_ecs_task') as start_ecs_task:
+        build_package.lambda_handler(event, None)
+
+    # Packages needing a size without its own queue use the task definition
+    sent = {x[0][0]: [json.loads(m)['PackageName'] for m in x[0][1]]
+            for x in send.call_args_list}
+    assert sent == {
+        'small-build-queue': ['medium', 'tiny'],
+        'build-queue': ['new', 'big'],
+    }
+
+    # The lane's maximum covers the tasks of every size
+    started = {x[1]['started_by']: x for x in start_ecs_task.call_args_list}
+    small = started['pkg-builder-default-small']
+    assert (small[0][2]['cpu'], small[0][2]['memory']) == ('1024', '2048')
+    assert small[0][2]['containerOverrides'][0]['environment'] == \
+        [{'name': 'SQS_QUEUE_URL', 'value': 'small-build-queue'}]
+    assert small[1]['count'] == 2
+    assert 'pkg-builder-default' not in started
+
+
+def test_each_lane_is_scaled_on_its_own():
+
+    from pkg_builder import build_package
+
+    with open(TEMPLATE, 'r') as f:
+        event = json.loads(f.read())
+    packages = [('chromium', 'Long'), ('tiny', 'Default'), ('small', None),
+                ('unknown-lane', 'Other')]
+    event['Records'] = [
+        dict(event['Records'][0], body=json.dumps(dict({'PackageName': name},
+                                                       **({'Lane': lane} if lane else {}))))
+        for name, lane in packages]
+
+    task_counts = {
+        'pkg-builder-default': {'RUNNING': 1},
+        'pkg-builder-long': {'RUNNING': 1},
+    }
+    with patch.object(build_package, 'MAX_TASK_COUNT', 10), \
+            patch.object(build_package, 'MAX_LONG_TASK_COUNT', 1), \
+            patch.object(build_package, 'BUILD_QUEUE', 'build-queue'), \
+            patch.object(build_package, 'LONG_BUILD_QUEUE', 'long-build-queue'), \
+            patch.object(build_package, 'send_batch_to_queue') as send, \
+            patch.object(build_package, 'get_queue_depth', return_value=0), \
+            patch.object(build_package, 'get_task_counts',
+                         lambda cluster, started_by: task_counts[started_by]), \
+            patch.object(build_package, 'get_untagged_task_counts', return_value={}), \
+            patch.object(build_package, 'start_ecs_task') as start_ecs_task:
+        build_package.lambda_handler(event, None)
+
+    sent = {x[0][0]: sorted(json.loads(m)['PackageName'] for m in x[0][1])
+            for x in send.call_args_list}
+    assert sent == {
+        'build-queue': ['small', 'tiny', 'unknown-lane'],
+        'long-build-queue': ['chromium'],
+    }
+
+    # The long lane already has as many tasks as it's allowed
+    assert start_ecs_task.call_count == 1
+    assert start_ecs_task.call_args[1]['count'] == 3
+    assert start_ecs_task.call_args[1]['started_by'] == 'pkg-builder-default'
+    container = start_ecs_task.call_args[0][2]['containerOverrides'][0]
+    assert container['environment'] == [{'name': 'SQS_QUEUE_URL', 'value': 'build-queue'}]
+
+
+def test_untagged_tasks_count_towards_the_default_lane():
+
+    from pkg_builder import build_package
+
+    with open(TEMPLATE, 'r') as f:
+        event = json.loads(f.read())
+    event['Records'] = [dict(event['Records'][0], body=json.dumps({'PackageName': x}))
+                        for x in ['a', 'b', 'c']]
+
+    # Tasks still running from before tasks were tagged with their lane
+    with patch.object(build_package, 'MAX_TASK_COUNT', 4), \
+            patch.object(build_package, 'BUILD_QUEUE', 'build-queue'), \
+            patch.object(build_package, 'SMALL_BUILD_QUEUE', None), \
+            patch.object(build_package, 'MEDIUM_BUILD_QUEUE', None), \
+            patch.object(build_package, 'send_batch_to_queue'), \
+            patch.object(build_package, 'get_queue_depth', return_value=0), \
+            patch.object(build_package, 'get_task_counts', return_value={}), \
+            patch.object(build_package, 'get_untagged_task_counts',
+                         return_value={'RUNNING': 2}) as get_untagged_task_counts, \
+            patch.object(build_package, 'start_ecs_task') as start_ecs_task:
+        build_package.lambda_handler(event, None)
+
+    assert get_untagged_task_counts.call_args[0][2] == 'pkg-builder-'
+    assert start_ecs_task.call_args[1]['count'] == 2
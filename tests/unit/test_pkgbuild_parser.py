@@ -123,5 +123,152 @@ def test_incorrect_pkgbuild_throws_error():
 
     message = get_input('incorrect_pkgbuild_test')
 
-    with pytest.raises(AssertionError):
+    from pkgbuild import PkgbuildParseError
+
+    with pytest.raises(PkgbuildParseError):
         resp = lambda_handler(message, None)
+
+
+PKGBUILD = """
+pkgbase=couldinho
+pkgname=(couldinho-base couldinho-dev)
+depends=('glibc>=2.35' "bash")  # Shared by every package
+makedepends=(git) checkdepends=('python-pytest')
+depends_x86_64=(lib32-glibc)
+depends_aarch64=(raspberrypi-firmware)
+optdepends=('zsh-completions: more completions'
+            "vim: editor")
+
+package_couldinho-base() {
+    depends+=(
+        linux \\
+        'linux-firmware'   # Firmware )
+    )
+    echo "depends=(not-a-dependency)" > "${pkgdir}/file"
+}
+
+package_couldinho-dev() {
+    if true; then
+        depends=(gcc 'clang=15.0.7-1')
+    fi
+}
+"""
+
+
+def test_tokenizer_finds_every_dependency_array():
+
+    from pkgbuild import get_dependencies
+
+    deps = get_dependencies(PKGBUILD)
+    summary = [(d.name, d.constraint, d.kind, d.arch, d.package) for d in deps]
+
+    assert summary == [
+        ('glibc', '>=2.35', 'depends', None, None),
+        ('bash', None, 'depends', None, None),
+        ('git', None, 'makedepends', None, None),
+        ('python-pytest', None, 'checkdepends', None, None),
+        ('lib32-glibc', None, 'depends', 'x86_64', None),
+        ('raspberrypi-firmware', None, 'depends', 'aarch64', None),
+        ('zsh-completions', None, 'optdepends', None, None),
+        ('vim', None, 'optdepends', None, None),
+        ('linux', None, 'depends', None, 'couldinho-base'),
+        ('linux-firmware', None, 'depends', None, 'couldinho-base'),
+        ('gcc', None, 'depends', None, 'couldinho-dev'),
+        ('clang', '=15.0.7-1', 'depends', None, 'couldinho-dev'),
+    ]
+    assert deps[6].description == 'more completions'
+
+
+def test_only_build_dependencies_for_the_architecture_are_sent():
+
+    from pkgbuild_parser.parse_pkgbuild import _get_dependencies
+
+    assert _get_dependencies(PKGBUILD) == [
+        'glibc>=2.35', 'bash', 'git', 'python-pytest', 'lib32-glibc',
+        'linux', 'linux-firmware', 'gcc', 'clang=15.0.7-1']
+
+
+@pytest.mark.parametrize('pkgbuild', [
+    'depends=(foo',
+    'depends=(foo (bar))',
+    'depends=("foo)',
+    "depends=('foo)",
+    'depends=("foo\\\\\\" bar)',
+])
+def test_invalid_dependency_arrays_raise_errors(pkgbuild):
+
+    from pkgbuild import get_dependencies, PkgbuildParseError
+
+    with pytest.raises(PkgbuildParseError):
+        get_dependencies(pkgbuild)
+
+
+def test_heredocs_and_escaped_quotes_are_skipped():
+
+    from pkgbuild import get_dependencies
+
+    pkgbuild = """
+package() {
+    cat <<EOF > "${pkgdir}/README"
+depends=(not-a-dependency "unclosed
+EOF
+    cat <<-'END' > "${pkgdir}/other"
+\tmakedepends=(also-not-a-dependency)
+\tEND
+    echo "a \\"quoted\\" \\\\" >> "${pkgdir}/file"
+    depends=(bash)
+}
+"""
+    deps = get_dependencies(pkgbuild)
+    assert [(d.name, d.package) for d in deps] == [('bash', None)]
+
+
+def test_package_variables_are_expanded_within_dependencies():
+
+    from pkgbuild import get_dependencies
+
+    pkgbuild = """
+pkgbase=couldinho
+pkgname=("${pkgbase}-base" "${pkgbase}-dev")
+pkgver=1.2
+pkgrel=3
+depends=("${pkgbase}-common=${pkgver}-${pkgrel}" "$pkgname" "${_unknown}")
+"""
+    deps = get_dependencies(pkgbuild)
+    assert [d.name + (d.constraint or '') for d in deps] == [
+        'couldinho-common=1.2-3', 'couldinho-base']
+
+
+def test_large_pkgbuilds_are_parsed_in_linear_time():
+
+    import time
+    from pkgbuild import get_dependencies
+
+    def parse_time(count):
+        pkgbuild = "depends=(\n" + "".join(
+            f"    'package-{i}>=1.{i}'  # Comment {i}\n" for i in range(count)) + ")\n"
+        start = time.perf_counter()
+        assert len(get_dependencies(pkgbuild)) == count
+        return time.perf_counter() - start
+
+    parse_time(1000)
+    assert parse_time(40000) < parse_time(4000) * 40
+
+
+def test_dependencies_from_every_pkgbuild_are_merged():
+
+    from pkgbuild_parser.parse_pkgbuild import run
+
+    message = json.dumps({
+        "pkgbuilds": {
+            "pkg/PKGBUILD": "depends=(bash 'glibc>=2.35')",
+            "desktop/PKGBUILD": "depends=(bash xorg-server)\nmakedepends=(git)",
+        },
+        "git_url": "https://github.com/kontax/arch-packages.git",
+        "git_branch": "master",
+        "stage": "prod"
+    })
+
+    output = json.loads(run(message))
+    assert output['dependencies'] == ['bash', 'glibc>=2.35', 'xorg-server', 'git']
+    assert 'pkgbuilds' not in output
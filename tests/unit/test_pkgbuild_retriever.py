@@ -14,9 +14,12 @@ from moto import mock_sqs, mock_sts
 # Get the root path of the project to allow importing
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "tests"))
 sys.path.append(os.path.join(ROOT_PATH, "pkgbuild_retriever"))
 sys.path.append(os.path.join(ROOT_PATH, "src/python"))
 
+from test_common import dynamodb_table, pkgbuild_cache_table
+
 TEMPLATE = os.path.join(ROOT_PATH, 'tests/inputs/webhook-template.json')
 INPUTS = {
     'dev_commit': 'tests/inputs/pkgbuild_retriever/dev_commit.json',
@@ -25,11 +28,13 @@ INPUTS = {
     'random_branch': 'tests/inputs/pkgbuild_retriever/random_branch.json',
     'multiple_commits': 'tests/inputs/pkgbuild_retriever/multiple_commits.json',
     'no_pkgbuild': 'tests/inputs/pkgbuild_retriever/no_pkgbuild.json',
+    'multiple_pkgbuilds': 'tests/inputs/pkgbuild_retriever/multiple_pkgbuilds.json',
 }
+MASTER_COMMIT = '3d18b1d287147d1df1e62f1d698be0b5b376ade7'
 PKGBUILDS = {
-    'master': 'tests/inputs/pkgbuild_retriever/master_pkgbuild.json',
-    'dev': 'tests/inputs/pkgbuild_retriever/dev_pkgbuild.json',
-    'random': 'tests/inputs/pkgbuild_retriever/random_pkgbuild.json',
+    MASTER_COMMIT: 'tests/inputs/pkgbuild_retriever/master_pkgbuild.json',
+    'f1d2912ae638c3759eda9dd74950560f9de7938a': 'tests/inputs/pkgbuild_retriever/master_pkgbuild.json',
+    'c9e3a42bc268a35f32bc451403604ebbfa5c18f9': 'tests/inputs/pkgbuild_retriever/dev_pkgbuild.json',
 }
 
 
@@ -55,33 +60,35 @@ def get_input(input_name, token):
 
     return output
 
-class UrlOpenMockContext:
-    """ Mock context for urlopen """
+class PoolManagerResponse:
+    """ Mock response for urllib3 requests """
+
+    def __init__(self, status, data=b''):
+        self.status = status
+        self.data = data
+
+
+def mock_request(self, method, url, *args, **kwargs):
+    """ Mock request for urllib3, returning the PKGBUILD for the commit """
 
-    def __init__(self, *args, **kwargs):
-        self.url = args[0] if isinstance(args[0], str) \
-                   else args[0].get_full_url()
+    REQUESTED.append(url)
+    match = re.search(
+        'https://raw.githubusercontent.com/(.+/.+)/(.+)/(.+/.*)',
+        url,
+        re.IGNORECASE)
 
-        if match := re.search(
-                    'https://raw.githubusercontent.com/(.+/.+)/(.+)/(.+/.*)',
-                    self.url,
-                    re.IGNORECASE):
-            self.repo_name = match.group(1)
-            self.branch = match.group(2)
-            self.location = match.group(3)
+    if match is None or match.group(2) not in PKGBUILDS:
+        return PoolManagerResponse(404)
 
-    def __enter__(self, *args, **kwargs):
-        if self.branch in PKGBUILDS:
-            return open(PKGBUILDS[self.branch], 'rb')
-        else:
-            raise Exception(self.url)
+    with open(PKGBUILDS[match.group(2)], 'rb') as f:
+        return PoolManagerResponse(200, f.read())
 
-    def __exit__(self, *args, **kwargs):
-        pass
+
+REQUESTED = []
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_git_url_is_correct():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -105,7 +112,7 @@ def test_git_url_is_correct():
     assert url == 'https://github.com/kontax/arch-packages.git'
 
 
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_validation_fails_on_incorrect_token():
 
     os.environ['GITHUB_WEBHOOK_SECRET'] = "ABCD1234ABCD1234"
@@ -119,7 +126,7 @@ def test_validation_fails_on_incorrect_token():
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_git_branch_is_master():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -146,7 +153,7 @@ def test_git_branch_is_master():
     assert stage == 'prod'
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_git_branch_is_dev():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -174,7 +181,7 @@ def test_git_branch_is_dev():
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_git_branch_is_random():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -201,7 +208,7 @@ def test_git_branch_is_random():
     assert stage == 'dev'
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_payload_gets_correctly_received():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -221,13 +228,13 @@ def test_payload_gets_correctly_received():
     assert len(messages) == 1
 
     pkgbuild = json.loads(messages[0].body)
-    payload = pkgbuild['payload']
+    payload = pkgbuild['pkgbuilds']['pkg/PKGBUILD']
     payload_first_line = payload.split()[0]
     assert payload_first_line == "pkgbase='couldinho'"
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_no_commit_throws_401():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -246,7 +253,7 @@ def test_no_commit_throws_401():
 
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_mutiple_commits_parses_pkgbuild():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -273,7 +280,7 @@ def test_mutiple_commits_parses_pkgbuild():
     assert stage == 'prod'
 
 @mock_sqs
-@patch('urllib.request.urlopen', UrlOpenMockContext)
+@patch('urllib3.PoolManager.request', mock_request)
 def test_no_pkgbuild_returns_401():
 
     sqs = boto3.resource("sqs", region_name='eu-west-1')
@@ -290,3 +297,164 @@ def test_no_pkgbuild_returns_401():
     resp = lambda_handler(webhook, None)
     assert resp['statusCode'] == 401
 
+
+
+@mock_sqs
+@patch('urllib3.PoolManager.request', mock_request)
+def test_every_changed_pkgbuild_is_retrieved_once():
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    new_queue = sqs.create_queue(QueueName="PkgbuildParserQueue")
+
+    os.environ["NEXT_QUEUE"] = new_queue.url
+    os.environ['GITHUB_WEBHOOK_SECRET'] = "ABCD1234ABCD1234"
+    from pkgbuild_retriever.retrieve_pkgbuild import lambda_handler
+
+    webhook = get_input(
+        'multiple_pkgbuilds',
+        os.environ.get('GITHUB_WEBHOOK_SECRET'))
+
+    REQUESTED.clear()
+    resp = lambda_handler(webhook, None)
+    assert resp['statusCode'] == 200
+    messages = new_queue.receive_messages()
+    assert len(messages) == 1
+
+    pkgbuilds = json.loads(messages[0].body)['pkgbuilds']
+    assert sorted(pkgbuilds) == ['desktop/PKGBUILD', 'pkg/PKGBUILD']
+    assert sorted(REQUESTED) == [
+        f'https://raw.githubusercontent.com/kontax/arch-packages/{MASTER_COMMIT}/desktop/PKGBUILD',
+        f'https://raw.githubusercontent.com/kontax/arch-packages/{MASTER_COMMIT}/pkg/PKGBUILD',
+    ]
+
+
+def test_removed_pkgbuilds_are_ignored():
+
+    from pkgbuild_retriever.retrieve_pkgbuild import get_pkgbuild_locations
+
+    payload = {'commits': [
+        {'added': ['old/PKGBUILD', 'new/PKGBUILD'], 'modified': [], 'removed': []},
+        {'added': [], 'modified': ['new/PKGBUILD', 'README.md'], 'removed': ['old/PKGBUILD']},
+    ]}
+    assert get_pkgbuild_locations(payload) == ['new/PKGBUILD']
+
+
+@mock_sqs
+@patch('urllib3.PoolManager.request', mock_request)
+def test_unchanged_pkgbuilds_are_not_rebuilt(pkgbuild_cache_table):
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    new_queue = sqs.create_queue(QueueName="PkgbuildParserQueue")
+
+    os.environ["NEXT_QUEUE"] = new_queue.url
+    os.environ['GITHUB_WEBHOOK_SECRET'] = "ABCD1234ABCD1234"
+    from pkgbuild_retriever import retrieve_pkgbuild
+
+    webhook = get_input(
+        'master_commit',
+        os.environ.get('GITHUB_WEBHOOK_SECRET'))
+
+    with patch.object(retrieve_pkgbuild, 'PKGBUILD_CACHE', pkgbuild_cache_table.table_name):
+
+        # Nothing has been built yet, so the PKGBUILD is sent on with its hash
+        resp = retrieve_pkgbuild.lambda_handler(webhook, None)
+        assert resp['statusCode'] == 200
+        messages = new_queue.receive_messages()
+        assert len(messages) == 1
+        pkgbuild_hash = json.loads(messages[0].body)['pkgbuild_hash']
+        messages[0].delete()
+
+        # Once built, the same PKGBUILD is skipped
+        pkgbuild_cache_table.put_item(Item={
+            'GitUrl': 'https://github.com/kontax/arch-packages.git',
+            'GitBranch': 'master',
+            'PkgbuildHash': pkgbuild_hash,
+            'Succeeded': True
+        })
+        resp = retrieve_pkgbuild.lambda_handler(webhook, None)
+        assert resp['statusCode'] == 200
+        assert json.loads(resp['body']) == {'status': 'PKGBUILD unchanged'}
+        assert new_queue.receive_messages() == []
+
+
+def test_pkgbuild_hash_depends_on_contents_and_paths():
+
+    from pkgbuild_retriever.retrieve_pkgbuild import get_pkgbuild_hash
+
+    pkgbuilds = {'a/PKGBUILD': 'depends=(foo)', 'b/PKGBUILD': 'depends=(bar)'}
+    reordered = {'b/PKGBUILD': 'depends=(bar)', 'a/PKGBUILD': 'depends=(foo)'}
+    assert get_pkgbuild_hash(pkgbuilds) == get_pkgbuild_hash(reordered)
+    assert get_pkgbuild_hash(pkgbuilds) != \
+        get_pkgbuild_hash({'a/PKGBUILD': 'depends=(bar)', 'b/PKGBUILD': 'depends=(foo)'})
+    assert get_pkgbuild_hash({'a/PKGBUILD': 'x'}) != \
+        get_pkgbuild_hash({'b/PKGBUILD': 'x'})
+
+
+def _signed_webhook(sha1=None, sha256=None, body=None):
+    webhook = get_input('master_commit', "ABCD1234ABCD1234")
+    if body is not None:
+        webhook['body'] = body
+    del webhook['headers']['X-Hub-Signature']
+    if sha1 is not None:
+        webhook['headers']['X-Hub-Signature'] = "sha1=" + hmac.new(
+            sha1.encode(), webhook['body'].encode(), hashlib.sha1).hexdigest()
+    if sha256 is not None:
+        webhook['headers']['X-Hub-Signature-256'] = "sha256=" + hmac.new(
+            sha256.encode(), webhook['body'].encode(), hashlib.sha256).hexdigest()
+    return webhook
+
+
+@pytest.mark.parametrize('sha1,sha256,status_code', [
+    (None, "ABCD1234ABCD1234", 200),
+    ("ABCD1234ABCD1234", "ABCD1234ABCD1234", 200),
+    (None, "INCORRECT_SECRET", 401),
+    ("ABCD1234ABCD1234", "INCORRECT_SECRET", 401),
+    (None, None, 401),
+])
+def test_sha256_signature_is_preferred(sha1, sha256, status_code):
+
+    import github_token_validator
+
+    webhook = _signed_webhook(sha1, sha256)
+    with patch.object(github_token_validator, '_KEY', b"ABCD1234ABCD1234"):
+        resp = github_token_validator.validate(webhook)
+    assert resp['statusCode'] == status_code
+
+
+def test_malformed_signature_is_rejected():
+
+    import github_token_validator
+
+    webhook = _signed_webhook(sha256="ABCD1234ABCD1234")
+    webhook['headers']['X-Hub-Signature-256'] = "sha1=" + "é" * 64
+    with patch.object(github_token_validator, '_KEY', b"ABCD1234ABCD1234"):
+        resp = github_token_validator.validate(webhook)
+    assert resp['statusCode'] == 401
+
+    webhook['headers']['X-Hub-Signature-256'] = "sha256=" + "é" * 64
+    with patch.object(github_token_validator, '_KEY', b"ABCD1234ABCD1234"):
+        resp = github_token_validator.validate(webhook)
+    assert resp['statusCode'] == 401
+
+
+def test_oversized_webhooks_are_rejected_before_hashing():
+
+    import github_token_validator
+
+    webhook = _signed_webhook(sha256="ABCD1234ABCD1234", body="x" * 1025)
+    with patch.object(github_token_validator, '_KEY', b"ABCD1234ABCD1234"), \
+            patch.object(github_token_validator, 'MAX_BODY_SIZE', 1024), \
+            patch('hmac.new') as hmac_new:
+        resp = github_token_validator.validate(webhook)
+    assert resp['statusCode'] == 413
+    hmac_new.assert_not_called()
+
+
+def test_missing_secret_is_rejected():
+
+    import github_token_validator
+
+    webhook = _signed_webhook(sha256="ABCD1234ABCD1234")
+    with patch.object(github_token_validator, '_KEY', None):
+        resp = github_token_validator.validate(webhook)
+    assert resp['statusCode'] == 401
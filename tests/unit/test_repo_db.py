@@ -0,0 +1,305 @@
+import base64
+import boto3
+import hashlib
+import io
+import json
+import os
+import sys
+import pytest
+import tarfile
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from mock import patch
+from moto import mock_s3, mock_sqs
+from zstandard import ZstdCompressor
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "package_updater"))
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+BUCKET = 'personal-prod'
+REPO_NAME = 'personal'
+TEST_REPO_DB = os.path.join(ROOT_PATH, 'tests/inputs/package_updater/test-repo.db')
+
+PKGINFO = """# Generated by makepkg
+pkgname = foo
+pkgbase = foo
+pkgver = 1.2-1
+pkgdesc = A test package
+url = https://example.com
+builddate = 1650000000
+packager = Package Builder <aur@example.com>
+size = 1024
+arch = x86_64
+license = MIT
+depend = bash
+depend = zlib>=1.2
+makedepend = cmake
+"""
+
+
+def _read_db(data):
+    """ Gets the files within each entry of a database """
+    from repo_db import _extract_archive_from_stream
+
+    entries = {}
+    with _extract_archive_from_stream(io.BytesIO(data)) as tar:
+        for member in tar:
+            if member.isfile():
+                path = member.name[2:] if member.name.startswith('./') else member.name
+                entry, name = path.split('/', 1)
+                entries.setdefault(entry, {})[name] = tar.extractfile(member).read()
+    return entries
+
+
+def _make_package():
+    """ Creates a zstd compressed package file containing a .PKGINFO """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, content in [('.PKGINFO', PKGINFO.encode()),
+                              ('usr/bin/foo', b'#!/bin/sh\n')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return ZstdCompressor().compress(buf.getvalue())
+
+
+def test_changes_are_applied_without_rewriting_other_entries():
+
+    from repo_db import apply_changes
+
+    with open(TEST_REPO_DB, 'rb') as f:
+        original = f.read()
+    before = _read_db(original)
+    assert '010editor-10.0.2-1' in before
+
+    target = io.BytesIO()
+    desc = "%NAME%\nfoo\n\n%VERSION%\n1.2-1\n\n"
+    counts = apply_changes(io.BytesIO(original), target, '.tar.zst',
+                           [('foo-1.2-1', {'desc': desc})], ['010editor'])
+
+    after = _read_db(target.getvalue())
+    assert counts == {'added': 1, 'removed': 1, 'kept': len(before) - 1}
+    assert '010editor-10.0.2-1' not in after
+    assert after['foo-1.2-1']['desc'] == desc.encode()
+
+    # Every other entry is copied as it was
+    del before['010editor-10.0.2-1']
+    del after['foo-1.2-1']
+    assert after == before
+
+
+def test_added_packages_replace_older_versions():
+
+    from repo_db import apply_changes
+
+    first = io.BytesIO()
+    apply_changes(None, first, '.tar.gz',
+                  [('foo-1.0-1', {'desc': "%NAME%\nfoo\n\n%VERSION%\n1.0-1\n\n"})], [])
+
+    second = io.BytesIO()
+    counts = apply_changes(io.BytesIO(first.getvalue()), second, '.tar.gz',
+                           [('foo-1.2-1', {'desc': "%NAME%\nfoo\n\n%VERSION%\n1.2-1\n\n"})], [])
+
+    assert counts == {'added': 1, 'removed': 0, 'kept': 0}
+    assert list(_read_db(second.getvalue())) == ['foo-1.2-1']
+
+
+@mock_s3
+@mock_sqs
+def test_packages_are_added_to_the_repo_db():
+
+    # Moto doesn't decode the chunked uploads made to send checksums
+    s3 = boto3.client('s3', config=Config(request_checksum_calculation='when_required'))
+    s3.create_bucket(Bucket=BUCKET,
+                     CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    package = _make_package()
+    s3.put_object(Bucket=BUCKET, Key='x86_64/foo-1.2-1-x86_64.pkg.tar.zst',
+                  Body=package)
+    s3.put_object(Bucket=BUCKET, Key='x86_64/foo-1.2-1-x86_64.pkg.tar.zst.sig',
+                  Body=b'signature')
+    with open(TEST_REPO_DB, 'rb') as f:
+        s3.put_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.tar.zst',
+                      Body=f.read())
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    import repo_db
+
+    message = {'Records': [{'body': json.dumps({
+        'bucket': BUCKET,
+        'add': [{'PackageName': 'foo', 'Version': '1.2-1'}],
+        'remove': ['010editor'],
+        'build_event': {'PackageName': 'GIT_REPO'}
+    })}]}
+    with patch.object(repo_db, 'REPO_NAME', REPO_NAME), \
+            patch.object(repo_db, 'BUILD_FUNCTION_QUEUE', build_function_queue.url), \
+            patch.object(repo_db, 'get_client', lambda service: s3):
+        resp = repo_db.lambda_handler(message, None)
+
+    # There's no files database to update
+    body = json.loads(resp['body'])
+    assert body[BUCKET]['db']['added'] == 1
+    assert body[BUCKET]['db']['removed'] == 1
+    assert body[BUCKET]['files'] is None
+
+    # The database is available under both names
+    db = s3.get_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db')['Body'].read()
+    assert db == s3.get_object(Bucket=BUCKET,
+                               Key=f'x86_64/{REPO_NAME}.db.tar.zst')['Body'].read()
+
+    entries = _read_db(db)
+    assert '010editor-10.0.2-1' not in entries
+    desc = entries['foo-1.2-1']['desc'].decode()
+    package_record = repo_db.parse_desc(desc)
+    assert package_record.name == 'foo'
+    assert package_record.version == '1.2-1'
+    assert package_record.depends == ('bash', 'zlib>=1.2')
+    assert package_record.makedepends == ('cmake',)
+    assert package_record.csize == len(package)
+    assert package_record.isize == 1024
+    assert package_record.sha256sum == hashlib.sha256(package).hexdigest()
+    assert "%FILENAME%\nfoo-1.2-1-x86_64.pkg.tar.zst\n" in desc
+    assert f"%PGPSIG%\n{base64.b64encode(b'signature').decode()}\n" in desc
+
+    messages = build_function_queue.receive_messages()
+    assert json.loads(messages[0].body) == {'PackageName': 'GIT_REPO'}
+
+
+def _create_repo_bucket():
+    """ Creates the repository bucket containing the foo package and the
+    test repository database """
+
+    # Moto doesn't decode the chunked uploads made to send checksums
+    s3 = boto3.client('s3', config=Config(request_checksum_calculation='when_required'))
+    s3.create_bucket(Bucket=BUCKET,
+                     CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    s3.put_object(Bucket=BUCKET, Key='x86_64/foo-1.2-1-x86_64.pkg.tar.zst',
+                  Body=_make_package())
+    with open(TEST_REPO_DB, 'rb') as f:
+        s3.put_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.tar.zst',
+                      Body=f.read())
+    return s3
+
+
+class ConflictingClient:
+    """ S3 client which writes another version of the database just before
+    the first conditional write to it, as repo-add would in an update task.
+    Moto doesn't check the conditions of writes, so the write fails as S3
+    would. """
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.conditions = []
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+    def put_object(self, **kwargs):
+        from repo_db import apply_changes
+
+        self.conditions.append({x: kwargs[x] for x in ('IfMatch', 'IfNoneMatch')
+                                if x in kwargs})
+        if len(self.conditions) > 1:
+            return self.s3.put_object(**kwargs)
+
+        key = f'x86_64/{REPO_NAME}.db.tar.zst'
+        current = self.s3.get_object(Bucket=BUCKET, Key=key)['Body']
+        changed = io.BytesIO()
+        apply_changes(current, changed, '.tar.zst',
+                      [('bar-2.0-1', {'desc': "%NAME%\nbar\n\n%VERSION%\n2.0-1\n\n"})], [])
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=changed.getvalue())
+        raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+
+
+@mock_s3
+def test_changes_are_applied_again_if_the_database_changes():
+
+    s3 = _create_repo_bucket()
+    etag = s3.head_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.tar.zst')['ETag']
+    client = ConflictingClient(s3)
+
+    import repo_db
+
+    with patch.object(repo_db, 'REPO_NAME', REPO_NAME), \
+            patch.object(repo_db, 'get_client', lambda service: client):
+        results = repo_db.update_repo_db(
+            BUCKET, [{'PackageName': 'foo', 'Version': '1.2-1'}], [])
+
+    # The second write is only made if the database written by repo-add
+    # hasn't changed again
+    changed_etag = s3.head_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.tar.zst')['ETag']
+    assert client.conditions[0] == {'IfMatch': etag}
+    assert client.conditions[1]['IfMatch'] != etag
+    assert len(client.conditions) == 2
+    assert results['db']['added'] == 1
+
+    # Neither writer's changes are lost
+    entries = _read_db(s3.get_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db')['Body'].read())
+    assert 'foo-1.2-1' in entries
+    assert 'bar-2.0-1' in entries
+    assert '010editor-10.0.2-1' in entries
+    assert changed_etag != etag
+
+
+@mock_s3
+@mock_sqs
+def test_signed_databases_are_not_updated():
+
+    s3 = _create_repo_bucket()
+    s3.put_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.sig', Body=b'signature')
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    import repo_db
+
+    message = {'Records': [{'body': json.dumps({
+        'bucket': BUCKET,
+        'add': [{'PackageName': 'foo', 'Version': '1.2-1'}],
+        'build_event': {'PackageName': 'GIT_REPO'}
+    })}]}
+    with patch.object(repo_db, 'REPO_NAME', REPO_NAME), \
+            patch.object(repo_db, 'BUILD_FUNCTION_QUEUE', build_function_queue.url), \
+            patch.object(repo_db, 'get_client', lambda service: s3), \
+            pytest.raises(ValueError, match='is signed'):
+        repo_db.lambda_handler(message, None)
+
+    keys = [x['Key'] for x in s3.list_objects_v2(Bucket=BUCKET)['Contents']]
+    assert f'x86_64/{REPO_NAME}.db' not in keys
+    assert build_function_queue.receive_messages() == []
+
+
+@mock_s3
+@mock_sqs
+def test_packages_without_files_are_not_added():
+
+    s3 = _create_repo_bucket()
+    with open(TEST_REPO_DB, 'rb') as f:
+        original = f.read()
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    build_function_queue = sqs.create_queue(QueueName="BuildFunctionQueue")
+
+    import repo_db
+
+    message = {'Records': [{'body': json.dumps({
+        'bucket': BUCKET,
+        'add': [{'PackageName': 'foo', 'Version': '1.2-1'},
+                {'PackageName': 'missing', 'Version': '1.0-1'}],
+        'build_event': {'PackageName': 'GIT_REPO'}
+    })}]}
+    with patch.object(repo_db, 'REPO_NAME', REPO_NAME), \
+            patch.object(repo_db, 'BUILD_FUNCTION_QUEUE', build_function_queue.url), \
+            patch.object(repo_db, 'get_client', lambda service: s3), \
+            pytest.raises(ValueError, match='No files found for missing 1.0-1'):
+        repo_db.lambda_handler(message, None)
+
+    # The message is retried without anything being written or sent on
+    db = s3.get_object(Bucket=BUCKET, Key=f'x86_64/{REPO_NAME}.db.tar.zst')['Body'].read()
+    assert db == original
+    assert build_function_queue.receive_messages() == []
@@ -0,0 +1,180 @@
+import boto3
+import json
+import os
+import sys
+
+from mock import patch
+from moto import mock_s3, mock_sqs
+from urllib.parse import urlparse, parse_qs
+
+# Get the root path of the project to allow importing
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.append(ROOT_PATH)
+sys.path.append(os.path.join(ROOT_PATH, "tests"))
+sys.path.append(os.path.join(ROOT_PATH, "repo_updater"))
+sys.path.append(os.path.join(ROOT_PATH, "src/python"))
+
+from test_common import artifact_cache_table, dynamodb_table
+
+PERSONAL_REPO = 'personal-prod'
+PERSONAL_REPO_DEV = 'personal-dev'
+
+AUR_VERSIONS = {
+    'couldinho-base': '1.1-1',
+    'ida-free': '7.7-1',
+    'rr': '5.6.0-1',
+    'gef-git': '2022.01-1',
+}
+
+
+class AurRpcMock:
+    """ Mock of urlopen returning the AUR versions of the packages requested """
+
+    def __init__(self, url):
+        self.names = parse_qs(urlparse(url).query)['arg[]']
+
+    def __enter__(self):
+        return self
+
+    def read(self):
+        results = [{'Name': x, 'Version': AUR_VERSIONS[x]}
+                   for x in self.names if x in AUR_VERSIONS]
+        return json.dumps({'type': 'multiinfo', 'results': results}).encode()
+
+    def __exit__(self, *args, **kwargs):
+        pass
+
+
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_only_outdated_packages_are_updated(dynamodb_table):
+
+    versions = [
+        (PERSONAL_REPO, 'couldinho-base', '1.0-1'),
+        (PERSONAL_REPO, 'ida-free', '7.7-1'),
+        (PERSONAL_REPO_DEV, 'couldinho-base', '1.1-1'),
+        (PERSONAL_REPO_DEV, 'rr', '5.6.0-2'),
+        (PERSONAL_REPO_DEV, 'gef-git', '2022.01-1'),
+    ]
+    for repo, name, version in versions:
+        dynamodb_table.put_item(Item={
+            'Repository': repo,
+            'PackageName': name,
+            'Version': version
+        })
+
+    os.environ["PACKAGE_TABLE"] = dynamodb_table.table_name
+    os.environ["PERSONAL_REPO_BUCKET"] = PERSONAL_REPO
+    os.environ["DEV_REPO_BUCKET"] = PERSONAL_REPO_DEV
+    os.environ["REPO_ARCH"] = 'x86_64'
+
+    from repo_updater import update_repo
+
+    with patch.object(update_repo, 'PACKAGE_TABLE', dynamodb_table.table_name), \
+            patch.object(update_repo, 'PERSONAL_REPO_BUCKET', PERSONAL_REPO), \
+            patch.object(update_repo, 'DEV_REPO_BUCKET', PERSONAL_REPO_DEV), \
+            patch.object(update_repo, 'start_ecs_task') as start_ecs_task:
+        resp = update_repo.lambda_handler({}, None)
+
+    # VCS packages are always updated, even with the same version
+    assert json.loads(resp['body'])['packages'] == {
+        PERSONAL_REPO: ['couldinho-base'],
+        PERSONAL_REPO_DEV: ['gef-git']
+    }
+
+    assert start_ecs_task.call_count == 2
+    packages = []
+    for call in start_ecs_task.call_args_list:
+        environment = call[0][2]['containerOverrides'][0]['environment']
+        packages.extend(x['value'] for x in environment if x['name'] == 'PACKAGES')
+    assert packages == ['couldinho-base', 'gef-git']
+
+
+def _create_cached_update(dynamodb_table, cache_table):
+    """ Creates an update of couldinho-base within the personal repository
+    which has been built before for the dev repository """
+
+    from artifact_cache import get_source_hash, get_source_key
+
+    dynamodb_table.put_item(Item={'Repository': PERSONAL_REPO,
+                                  'PackageName': 'couldinho-base',
+                                  'Version': '1.0-1'})
+    dynamodb_table.put_item(Item={'Repository': PERSONAL_REPO_DEV,
+                                  'PackageName': 'couldinho-base',
+                                  'Version': '1.1-1'})
+
+    aur_package = {'Name': 'couldinho-base', 'Version': AUR_VERSIONS['couldinho-base']}
+    source_key = get_source_key({'PackageBase': 'couldinho-base',
+                                 'Version': '1.1-1',
+                                 'SourceHash': get_source_hash(aur_package)})
+
+    cache_table.put_item(Item={'SourceKey': source_key,
+                               'PackageName': 'couldinho-base',
+                               'Buckets': {PERSONAL_REPO_DEV}})
+
+    s3 = boto3.client('s3')
+    for bucket in [PERSONAL_REPO, PERSONAL_REPO_DEV]:
+        s3.create_bucket(Bucket=bucket,
+                         CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    s3.put_object(Bucket=PERSONAL_REPO_DEV, Body=b'pkg',
+                  Key='x86_64/couldinho-base-1.1-1-any.pkg.tar.zst')
+
+    sqs = boto3.resource("sqs", region_name='eu-west-1')
+    return s3, sqs.create_queue(QueueName="RepoDbQueue")
+
+
+@mock_s3
+@mock_sqs
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_cached_updates_are_added_without_an_update_task(dynamodb_table,
+                                                        artifact_cache_table):
+
+    s3, repo_db_queue = _create_cached_update(dynamodb_table, artifact_cache_table)
+
+    from repo_updater import update_repo
+
+    with patch.object(update_repo, 'PACKAGE_TABLE', dynamodb_table.table_name), \
+            patch.object(update_repo, 'PERSONAL_REPO_BUCKET', PERSONAL_REPO), \
+            patch.object(update_repo, 'DEV_REPO_BUCKET', PERSONAL_REPO_DEV), \
+            patch.object(update_repo, 'REPO_ARCH', 'x86_64'), \
+            patch.object(update_repo, 'ARTIFACT_CACHE', artifact_cache_table.table_name), \
+            patch.object(update_repo, 'REPO_DB_QUEUE', repo_db_queue.url), \
+            patch.object(update_repo, 'start_ecs_task') as start_ecs_task:
+        resp = update_repo.lambda_handler({}, None)
+
+    assert json.loads(resp['body'])['packages'] == {PERSONAL_REPO: ['couldinho-base']}
+    assert start_ecs_task.call_count == 0
+
+    keys = [x['Key'] for x in s3.list_objects_v2(Bucket=PERSONAL_REPO)['Contents']]
+    assert keys == ['x86_64/couldinho-base-1.1-1-any.pkg.tar.zst']
+
+    messages = repo_db_queue.receive_messages()
+    assert json.loads(messages[0].body) == {
+        'bucket': PERSONAL_REPO,
+        'add': [{'PackageName': 'couldinho-base', 'Version': '1.1-1'}]
+    }
+
+
+@mock_s3
+@mock_sqs
+@patch('urllib.request.urlopen', AurRpcMock)
+def test_cached_updates_to_signed_repos_use_an_update_task(dynamodb_table,
+                                                          artifact_cache_table):
+
+    s3, repo_db_queue = _create_cached_update(dynamodb_table, artifact_cache_table)
+    s3.put_object(Bucket=PERSONAL_REPO, Key='x86_64/personal.db.sig', Body=b'sig')
+
+    from repo_updater import update_repo
+
+    with patch.object(update_repo, 'PACKAGE_TABLE', dynamodb_table.table_name), \
+            patch.object(update_repo, 'PERSONAL_REPO_BUCKET', PERSONAL_REPO), \
+            patch.object(update_repo, 'DEV_REPO_BUCKET', PERSONAL_REPO_DEV), \
+            patch.object(update_repo, 'REPO_ARCH', 'x86_64'), \
+            patch.object(update_repo, 'REPO_NAME', 'personal'), \
+            patch.object(update_repo, 'ARTIFACT_CACHE', artifact_cache_table.table_name), \
+            patch.object(update_repo, 'REPO_DB_QUEUE', repo_db_queue.url), \
+            patch.object(update_repo, 'start_ecs_task') as start_ecs_task:
+        update_repo.lambda_handler({}, None)
+
+    # The update task signs the database again after repo-add
+    assert start_ecs_task.call_count == 1
+    assert repo_db_queue.receive_messages() == []